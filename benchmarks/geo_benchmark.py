@@ -0,0 +1,132 @@
+"""Compares the pruned lookups of common.geo with a naive scan that computes the distance to every brewery.
+
+Builds a synthetic geo artifact the way the gold stage does (sorted by cell key, small row groups) and runs the
+same random radius and nearest queries both ways, checking that they return the same breweries.
+
+    python benchmarks/geo_benchmark.py --rows 1000000 --queries 50
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import duckdb
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from common.geo import CELL_SIZE_METADATA_KEY, BreweryGeoIndex, get_cell_key_sql, get_haversine_sql
+
+
+def write_synthetic_geo_artifact(con, path, rows, cell_size_degrees, row_group_size):
+    """Breweries clustered around 200 random towns in the continental US, like the real data."""
+    cell_key = get_cell_key_sql("latitude", "longitude", cell_size_degrees)
+    con.sql(f"""
+        COPY (
+            WITH towns AS (
+                SELECT range AS town, 25 + random() * 24 AS town_latitude, -125 + random() * 58 AS town_longitude
+                FROM range(200)
+            ),
+            breweries AS (
+                SELECT uuid() AS id, 'Brewery ' || b.range AS name, 'micro' AS brewery_type,
+                    'Town ' || t.town AS city, 'State' AS state, 'United States' AS country,
+                    t.town_latitude + (random() - 0.5) * 2 AS latitude,
+                    t.town_longitude + (random() - 0.5) * 2 AS longitude
+                FROM range({rows}) b
+                JOIN towns t ON t.town = b.range % 200
+            )
+            SELECT *, {cell_key} AS cell_key FROM breweries ORDER BY cell_key, id
+        ) TO '{path}' (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size},
+                       KV_METADATA {{{CELL_SIZE_METADATA_KEY}: '{cell_size_degrees}'}});
+    """)
+
+
+def naive_within_radius(con, source, latitude, longitude, radius_km):
+    return con.sql(f"""
+        SELECT id FROM (SELECT id, {get_haversine_sql(latitude, longitude)} AS distance_km FROM {source})
+        WHERE distance_km <= {radius_km}
+        ORDER BY distance_km, id
+    """).fetchall()
+
+
+def naive_nearest(con, source, latitude, longitude, k):
+    return con.sql(f"""
+        SELECT id FROM (SELECT id, {get_haversine_sql(latitude, longitude)} AS distance_km FROM {source})
+        ORDER BY distance_km, id
+        LIMIT {k}
+    """).fetchall()
+
+
+def time_queries(queries, run_query):
+    timings_ms, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(run_query(*query))
+        timings_ms.append((time.perf_counter() - start) * 1000)
+    return timings_ms, results
+
+
+def report(name, indexed_ms, naive_ms):
+    indexed_median, naive_median = statistics.median(indexed_ms), statistics.median(naive_ms)
+    print(
+        f"{name:<28} indexed p50 {indexed_median:8.2f} ms   naive p50 {naive_median:8.2f} ms   "
+        f"speedup x{naive_median / indexed_median:.1f}"
+    )
+
+
+def run_benchmark(args):
+    # Same Parquet metadata caching as the pipeline connections (duckdb section of project-settings.yaml)
+    con = duckdb.connect(config={"enable_object_cache": True})
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "breweries_geo.parquet")
+        start = time.perf_counter()
+        write_synthetic_geo_artifact(con, path, args.rows, args.cell_size_degrees, args.row_group_size)
+        print(f"Wrote {args.rows} breweries in {time.perf_counter() - start:.1f} s to {path}")
+
+        con.sql("SELECT setseed(0.42)")
+        queries = con.sql(f"SELECT 25 + random() * 24, -125 + random() * 58 FROM range({args.queries})").fetchall()
+        sources = {
+            "parquet": (BreweryGeoIndex.from_parquet(con, path), f"read_parquet('{path}')"),
+            "in-memory table": (BreweryGeoIndex.from_parquet(con, path, table_name="brewery_geo"), "brewery_geo"),
+        }
+        mismatches = 0
+        for source_name, (index, naive_source) in sources.items():
+            indexed_ms, indexed = time_queries(
+                queries,
+                lambda lat, lon, index=index: [row["id"] for row in index.within_radius(lat, lon, args.radius_km)],
+            )
+            naive_ms, naive = time_queries(
+                queries,
+                lambda lat, lon, source=naive_source: [
+                    row[0] for row in naive_within_radius(con, source, lat, lon, args.radius_km)
+                ],
+            )
+            mismatches += sum(a != b for a, b in zip(indexed, naive))
+            report(f"{source_name} radius {args.radius_km:g} km", indexed_ms, naive_ms)
+
+            indexed_ms, indexed = time_queries(
+                queries, lambda lat, lon, index=index: [row["id"] for row in index.nearest(lat, lon, args.k)]
+            )
+            naive_ms, naive = time_queries(
+                queries,
+                lambda lat, lon, source=naive_source: [row[0] for row in naive_nearest(con, source, lat, lon, args.k)],
+            )
+            mismatches += sum(a != b for a, b in zip(indexed, naive))
+            report(f"{source_name} {args.k} nearest", indexed_ms, naive_ms)
+
+    if mismatches:
+        raise ValueError(f"{mismatches} queries returned different breweries with and without the index")
+    print("Indexed and naive lookups returned the same breweries for every query.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--radius-km", type=float, default=25.0)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--cell-size-degrees", type=float, default=0.25)
+    parser.add_argument("--row-group-size", type=int, default=2048)
+    run_benchmark(parser.parse_args())
@@ -0,0 +1,125 @@
+"""Local stand-in for the Open Brewery DB endpoints used by the bronze stage, serving a synthetic catalog.
+
+    python benchmarks/mock_api.py --rows 1000000 --port 8765
+
+Point api_url and meta_url of src/bronze/settings.yaml at http://localhost:8765/breweries and
+http://localhost:8765/breweries/meta to fetch it. Pages carry an ETag and answer 304 to a matching
+If-None-Match, like the real API.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import duckdb
+from synthetic_data import create_catalog, get_catalog_metadata, get_catalog_page_json
+
+logger = logging.getLogger(__name__)
+
+
+class MockBreweryAPI:
+    """Serves the synthetic_breweries table of con on a background thread and counts the bytes it sends."""
+
+    def __init__(self, con, host="127.0.0.1", port=0):
+        self.con = con
+        self.lock = threading.Lock()
+        self.requests_served = 0
+        self.bytes_sent = 0
+        self.server = ThreadingHTTPServer((host, port), get_request_handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-api", daemon=True)
+        self.thread.start()
+        logger.info(f"Mock brewery API listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        """Returns the requests and bytes served since the last reset."""
+        with self.lock:
+            counters = {"requests": self.requests_served, "bytes_sent": self.bytes_sent}
+            self.requests_served, self.bytes_sent = 0, 0
+        return counters
+
+    def record(self, body_size):
+        with self.lock:
+            self.requests_served += 1
+            self.bytes_sent += body_size
+
+    def get_response(self, path, params, if_none_match):
+        """Returns (status, body, etag) for a GET request."""
+        cursor = self.con.cursor()
+        try:
+            if path == "/breweries/meta":
+                return 200, json.dumps(get_catalog_metadata(cursor)), None
+            if path == "/breweries":
+                page = int(params.get("page", ["1"])[0])
+                per_page = int(params.get("per_page", ["50"])[0])
+                body = get_catalog_page_json(cursor, page, per_page)
+                etag = f'"{hashlib.sha256(body.encode()).hexdigest()[:32]}"'
+                if if_none_match == etag:
+                    return 304, "", etag
+                return 200, body, etag
+            return 404, json.dumps({"message": f"Unknown path {path}"}), None
+        finally:
+            cursor.close()
+
+
+def get_request_handler(api):
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                status, body, etag = api.get_response(
+                    url.path.rstrip("/"), parse_qs(url.query), self.headers.get("If-None-Match")
+                )
+            except ValueError as e:
+                status, body, etag = 400, json.dumps({"message": str(e)}), None
+            payload = body.encode()
+            self.send_response(status)
+            if etag:
+                self.send_header("ETag", etag)
+            if status != 304:
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            api.record(len(payload))
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return RequestHandler
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    con = duckdb.connect()
+    create_catalog(con, args.rows)
+    api = MockBreweryAPI(con, args.host, args.port).start()
+    try:
+        api.thread.join()
+    except KeyboardInterrupt:
+        api.stop()
@@ -0,0 +1,135 @@
+"""Compares read queries over three Parquet layouts of silver/current_values.
+
+Writes the same synthetic catalog partitioned by state three ways: unsorted with the DuckDB defaults (the layout
+before the silver_parquet settings), fragmented into several small files per partition (what repeated partial
+writes leave behind before compaction), and sorted with the silver_parquet settings of project-settings.yaml.
+Each layout runs the same queries, and the CPU time of the last run comes from the DuckDB profiler, so the work
+saved by skipping row groups on their min/max statistics shows up even when the files are cached in memory.
+
+    python benchmarks/parquet_layout_benchmark.py --rows 1000000 --repeats 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import duckdb
+import yaml
+from synthetic_data import create_catalog
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from silver.main import get_parquet_write_options
+
+SETTINGS_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "config", "project-settings.yaml")
+
+
+def write_layout(con, directory, order_by=None, write_options="", slices=1):
+    """Writes the catalog partitioned by state, in `slices` separate writes so every partition gets one file per
+    slice."""
+    for slice_number in range(slices):
+        con.sql(f"""
+            COPY (
+                SELECT * EXCLUDE (rn) FROM synthetic_breweries
+                WHERE hash(id) % {slices} = {slice_number}
+                {f"ORDER BY {order_by}" if order_by else ""}
+            ) TO '{directory}'
+            (FORMAT parquet, PARTITION_BY (state), OVERWRITE_OR_IGNORE,
+             FILENAME_PATTERN 'data_{slice_number}_{{i}}'{write_options});
+        """)
+
+
+def get_layout_summary(con, directory):
+    return con.sql(f"""
+        SELECT COUNT(*) AS files, SUM(num_row_groups) AS row_groups, SUM(file_size_bytes) AS bytes
+        FROM parquet_file_metadata('{directory}/*/*.parquet')
+    """).fetchone()
+
+
+def get_queries(con):
+    """Queries shaped like the readers of silver: the gold aggregates, an id lookup and filters on the sort
+    columns. The filter values are picked from the catalog."""
+    brewery_id, city, state, brewery_type = con.sql("""
+        SELECT id, city, state, brewery_type FROM synthetic_breweries USING SAMPLE 1 ROWS (reservoir, 42)
+    """).fetchone()
+    return {
+        "gold aggregate": "SELECT state, brewery_type, COUNT(*) FROM silver GROUP BY ALL ORDER BY ALL",
+        "id lookup": f"SELECT * FROM silver WHERE id = '{brewery_id}'",
+        "city filter": f"SELECT id, name FROM silver WHERE city = '{city}' ORDER BY id",
+        "state and brewery type": (
+            f"SELECT id, name FROM silver WHERE state = '{state}' AND brewery_type = '{brewery_type}' ORDER BY id"
+        ),
+    }
+
+
+def run_query(con, directory, query, repeats):
+    """Median latency in ms, CPU time in ms of the last run and the result of the query."""
+    con.sql(f"""
+        CREATE OR REPLACE VIEW silver AS
+        SELECT * FROM read_parquet('{directory}/*/*.parquet', hive_partitioning = true,
+                                   hive_types = {{'state': 'VARCHAR'}})
+    """)
+    timings_ms = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = con.sql(query).fetchall()
+        timings_ms.append((time.perf_counter() - start) * 1000)
+    cpu_time_ms = json.loads(con.get_profiling_information(format="json"))["cpu_time"] * 1000
+    return statistics.median(timings_ms), cpu_time_ms, result
+
+
+def run_benchmark(args):
+    with open(SETTINGS_PATH) as f:
+        parquet_settings = yaml.safe_load(f).get("silver_parquet") or {}
+    # Same Parquet metadata caching as the pipeline connections (duckdb section of project-settings.yaml)
+    con = duckdb.connect(config={"enable_object_cache": True})
+    start = time.perf_counter()
+    create_catalog(con, args.rows)
+    print(f"Generated {args.rows} breweries in {time.perf_counter() - start:.1f} s")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        layouts = {
+            "unsorted": {},
+            "fragmented": {"slices": args.fragments},
+            "sorted": {
+                "order_by": ", ".join(["state", *parquet_settings.get("sort_by", [])]),
+                "write_options": get_parquet_write_options(parquet_settings),
+            },
+        }
+        for layout, options in layouts.items():
+            directory = os.path.join(temp_dir, layout)
+            start = time.perf_counter()
+            write_layout(con, directory, **options)
+            files, row_groups, size_bytes = get_layout_summary(con, directory)
+            print(
+                f"{layout:<11} written in {time.perf_counter() - start:5.1f} s   {files:4d} files   "
+                f"{row_groups:5d} row groups   {size_bytes / 1024 / 1024:7.1f} MB"
+            )
+
+        con.sql("SET enable_profiling = 'no_output'")
+        con.sql("SET profiling_coverage = 'ALL'")
+        results = {}
+        for query_name, query in get_queries(con).items():
+            for layout in layouts:
+                median_ms, cpu_time_ms, result = run_query(con, os.path.join(temp_dir, layout), query, args.repeats)
+                results.setdefault(query_name, []).append(result)
+                print(f"{query_name:<23} {layout:<11} p50 {median_ms:8.2f} ms   cpu {cpu_time_ms:8.2f} ms")
+
+    mismatches = [
+        query_name for query_name, layout_results in results.items() if len(set(map(str, layout_results))) > 1
+    ]
+    if mismatches:
+        raise ValueError(f"Layouts returned different rows for: {', '.join(mismatches)}")
+    print("Every layout returned the same rows for every query.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--fragments", type=int, default=8, help="Files per partition of the fragmented layout")
+    run_benchmark(parser.parse_args())
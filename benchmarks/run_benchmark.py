@@ -0,0 +1,311 @@
+"""End-to-end benchmark of the bronze, silver and gold stages on a synthetic brewery catalog.
+
+Serves the catalog through a local mock of the API (mock_api.py) and runs every stage as its own process,
+once per simulated day, with the daily churn of synthetic_data.py applied between days. For each stage it
+reports the wall time, the time of its main steps, the peak RSS, the bytes served by the API and the bytes
+read from and written to storage.
+
+    python benchmarks/run_benchmark.py --rows 10000 --days 3
+    python benchmarks/run_benchmark.py --rows 1000000 --days 2 --output results.json
+    python benchmarks/run_benchmark.py --rows 10000000 --per-page 1000 --s3-endpoint http://localhost:9000
+    python benchmarks/run_benchmark.py --rows 1000000 --storage local
+
+Storage is an S3 stand-in: moto runs in this process unless --s3-endpoint points at another S3-compatible
+server (MinIO, ...), whose bucket must already exist. Bytes read from storage are only counted with the
+embedded moto server. With --storage local every stage reads and writes a temporary directory instead.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+import duckdb
+import yaml
+from mock_api import MockBreweryAPI
+from synthetic_data import DailyChurn, advance_catalog, create_catalog
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["bronze", "silver", "gold"]
+STAGE_RUNNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stage_runner.py")
+PROJECT_SETTINGS_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "config", "project-settings.yaml")
+# Exit code of a stage with nothing to do (common.run_manifest.NO_CHANGES_EXIT_CODE)
+NO_CHANGES_EXIT_CODE = 99
+# Turns on the opt-in bronze features and keeps the stand-in API from being throttled by the bronze rate limiter
+BRONZE_SETTINGS_OVERRIDES = {
+    "api_fetch_mode": "concurrent",
+    "incremental_mode": True,
+    "output_format": "parquet",
+    "keep_raw_json": False,
+    "api_request_delay_seconds": 0,
+    "api_rate_limit_initial_per_second": 1000,
+    "api_rate_limit_max_per_second": 1000,
+    "api_rate_limit_burst": 100,
+}
+
+
+class ByteCountingMiddleware:
+    """WSGI middleware counting the request bodies received (writes) and the GET responses sent (reads)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] in ("PUT", "POST"):
+            self._add(written=int(environ.get("CONTENT_LENGTH") or 0))
+        for chunk in self.app(environ, start_response):
+            if environ["REQUEST_METHOD"] == "GET":
+                self._add(read=len(chunk))
+            yield chunk
+
+    def _add(self, read=0, written=0):
+        with self.lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def reset_counters(self):
+        with self.lock:
+            counters = {"storage_bytes_read": self.bytes_read, "storage_bytes_written": self.bytes_written}
+            self.bytes_read, self.bytes_written = 0, 0
+        return counters
+
+
+class EmbeddedS3Server:
+    """moto S3 server on a background thread, with byte counters."""
+
+    def __init__(self, host="127.0.0.1"):
+        try:
+            from moto.moto_server.werkzeug_app import DomainDispatcherApplication, create_backend_app
+            from werkzeug.serving import make_server
+        except ImportError as e:
+            raise ImportError(
+                "The embedded S3 stand-in needs moto[server]. Install the benchmarks group "
+                "(poetry install --with benchmarks) or pass --s3-endpoint."
+            ) from e
+        self.counter = ByteCountingMiddleware(DomainDispatcherApplication(create_backend_app))
+        self.server = make_server(host, 0, self.counter, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="s3-stand-in", daemon=True)
+
+    @property
+    def endpoint_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Embedded S3 stand-in listening on {self.endpoint_url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def get_storage_size(storage, location):
+    """Bytes stored under a local directory or in an S3 bucket."""
+    if storage == "local":
+        return sum(
+            os.path.getsize(os.path.join(root, file_name))
+            for root, _, files in os.walk(location)
+            for file_name in files
+        )
+    paginator = boto3.client("s3").get_paginator("list_objects_v2")
+    return sum(item["Size"] for page in paginator.paginate(Bucket=location) for item in page.get("Contents", []))
+
+
+def run_stage(stage, environment, log_path, metrics_path):
+    """Runs a stage in a child process and returns its status, wall time and the metrics it reported."""
+    start = time.perf_counter()
+    with open(log_path, "w") as log_file:
+        return_code = subprocess.run(
+            [sys.executable, STAGE_RUNNER_PATH, stage],
+            env={**environment, "BENCHMARK_METRICS_PATH": metrics_path},
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            check=False,
+        ).returncode
+    wall_seconds = time.perf_counter() - start
+
+    if return_code not in (0, NO_CHANGES_EXIT_CODE):
+        with open(log_path) as log_file:
+            log_tail = "".join(log_file.readlines()[-20:])
+        raise RuntimeError(f"{stage} failed with exit code {return_code}. Last lines of {log_path}:\n{log_tail}")
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    return {
+        "status": "no changes" if return_code == NO_CHANGES_EXIT_CODE else "ok",
+        "wall_seconds": round(wall_seconds, 3),
+        **metrics,
+        "steps": {step: round(seconds, 3) for step, seconds in metrics["steps"].items()},
+    }
+
+
+def format_bytes(value):
+    if value is None:
+        return "-"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(value) < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def print_result(result):
+    steps = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in result["steps"].items())
+    worker_rss = f" (workers {result['peak_worker_rss_mb']:.1f} MB)" if result.get("peak_worker_rss_mb") else ""
+    print(
+        f"day {result['day']:<3} {result['stage']:<7} {result['status']:<10} {result['wall_seconds']:8.2f} s  "
+        f"rss {result['peak_rss_mb']:8.1f} MB{worker_rss}  api {format_bytes(result['api_bytes_sent']):>9}  "
+        f"read {format_bytes(result['storage_bytes_read']):>9}  "
+        f"written {format_bytes(result['storage_bytes_written']):>9}  [{steps}]",
+        flush=True,
+    )
+
+
+def get_project_settings(section):
+    with open(PROJECT_SETTINGS_PATH) as f:
+        return yaml.safe_load(f).get(section) or {}
+
+
+def get_stage_environment(args, work_directory, s3_endpoint_url, api_base_url):
+    overrides = {
+        "stage": {
+            **BRONZE_SETTINGS_OVERRIDES,
+            "api_url": f"{api_base_url}/breweries",
+            "meta_url": f"{api_base_url}/breweries/meta",
+        },
+        "global": {"local_data_path": os.path.join(work_directory, "data")},
+    }
+    # Overrides replace whole sections, so they start from the project settings
+    if args.profile_queries:
+        overrides["global"]["instrumentation"] = {**get_project_settings("instrumentation"), "profile_queries": True}
+    if args.cache_directory:
+        overrides["global"]["storage"] = {**get_project_settings("storage"), "cache_directory": args.cache_directory}
+    if args.silver_shards:
+        overrides["global"]["silver_sharding"] = {
+            **get_project_settings("silver_sharding"),
+            "shard_count": args.silver_shards,
+        }
+    if args.per_page:
+        overrides["stage"]["api_param_itens_per_page"] = args.per_page
+    environment = {**os.environ, "OUTPUT_ENV": args.storage, "PYTHONUNBUFFERED": "1"}
+    if args.storage == "s3":
+        environment.update(
+            {
+                "AWS_ENDPOINT_URL": s3_endpoint_url,
+                "S3_BUCKET_NAME": args.bucket,
+                "AWS_ACCESS_KEY_ID": os.environ.get("AWS_ACCESS_KEY_ID", "benchmark"),
+                "AWS_SECRET_ACCESS_KEY": os.environ.get("AWS_SECRET_ACCESS_KEY", "benchmark"),
+                "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+            }
+        )
+    return environment, overrides
+
+
+def run_benchmark(args):
+    churn = DailyChurn(args.update_fraction, args.delete_fraction, args.insert_fraction)
+    work_directory = tempfile.mkdtemp(prefix="brewery_benchmark_")
+    catalog_con = duckdb.connect()
+    start = time.perf_counter()
+    create_catalog(catalog_con, args.rows)
+    logger.info(f"Generated {args.rows} synthetic breweries in {time.perf_counter() - start:.1f} s")
+    api = MockBreweryAPI(catalog_con).start()
+
+    s3_server = None
+    s3_endpoint_url = args.s3_endpoint
+    if args.storage == "s3" and s3_endpoint_url is None:
+        s3_server = EmbeddedS3Server().start()
+        s3_endpoint_url = s3_server.endpoint_url
+    environment, overrides = get_stage_environment(args, work_directory, s3_endpoint_url, api.base_url)
+    # boto3 calls of this process (bucket creation and size) go to the same storage as the stages
+    os.environ.update({key: value for key, value in environment.items() if key.startswith("AWS_")})
+    if s3_server is not None:
+        boto3.client("s3").create_bucket(Bucket=args.bucket)
+    storage_location = args.bucket if args.storage == "s3" else os.path.join(work_directory, "data")
+
+    results = []
+    try:
+        for day in range(args.days):
+            if day > 0:
+                logger.info(f"Day {day} churn: {advance_catalog(catalog_con, day, churn)}")
+            for stage in STAGES:
+                api.reset_counters()
+                if s3_server is not None:
+                    s3_server.counter.reset_counters()
+                size_before = get_storage_size(args.storage, storage_location)
+                # The stage overrides are bronze settings, the other stages only get the global ones
+                stage_overrides = overrides if stage == "bronze" else {"global": overrides["global"]}
+                result = run_stage(
+                    stage,
+                    {**environment, "BENCHMARK_SETTINGS_OVERRIDES": json.dumps(stage_overrides)},
+                    os.path.join(work_directory, f"{stage}_day{day}.log"),
+                    os.path.join(work_directory, f"{stage}_day{day}_metrics.json"),
+                )
+                storage_counters = {"storage_bytes_read": None, "storage_bytes_written": None}
+                if s3_server is not None:
+                    storage_counters = s3_server.counter.reset_counters()
+                else:
+                    # Without the embedded server only the growth of the storage is known
+                    size_after = get_storage_size(args.storage, storage_location)
+                    storage_counters["storage_bytes_written"] = max(size_after - size_before, 0)
+                result = {
+                    "day": day,
+                    "stage": stage,
+                    **result,
+                    "api_bytes_sent": api.reset_counters()["bytes_sent"],
+                    **storage_counters,
+                }
+                results.append(result)
+                print_result(result)
+    finally:
+        api.stop()
+        if s3_server is not None:
+            s3_server.stop()
+        if args.keep_work_directory:
+            logger.info(f"Stage logs and local data kept in {work_directory}")
+        else:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=4)
+        logger.info(f"Results saved to {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    # One line per request of the stages to the embedded S3 server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    logging.getLogger("botocore").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000, help="Breweries on day 0, e.g. 10000, 1000000, 10000000")
+    parser.add_argument("--days", type=int, default=3, help="Day 0 is the initial load, later days apply the churn")
+    parser.add_argument("--update-fraction", type=float, default=DailyChurn.update_fraction)
+    parser.add_argument("--delete-fraction", type=float, default=DailyChurn.delete_fraction)
+    parser.add_argument("--insert-fraction", type=float, default=DailyChurn.insert_fraction)
+    parser.add_argument("--per-page", type=int, default=None, help="Overrides api_param_itens_per_page")
+    parser.add_argument("--storage", choices=["s3", "local"], default="s3")
+    parser.add_argument("--s3-endpoint", default=None, help="S3-compatible endpoint used instead of embedded moto")
+    parser.add_argument("--bucket", default="brewery-benchmark")
+    parser.add_argument(
+        "--cache-directory", default=None, help="Local read-through cache of the S3 objects read by the stages"
+    )
+    parser.add_argument(
+        "--silver-shards", type=int, default=None, help="Runs the silver merge in this many shards (silver_sharding)"
+    )
+    parser.add_argument("--output", default=None, help="Saves the results as JSON")
+    parser.add_argument(
+        "--profile-queries", action="store_true", help="Adds the DuckDB profiles of the heavy queries to the results"
+    )
+    parser.add_argument("--keep-work-directory", action="store_true", help="Keeps stage logs and local data")
+    run_benchmark(parser.parse_args())
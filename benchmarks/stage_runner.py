@@ -0,0 +1,79 @@
+"""Runs one pipeline stage the way its container does and reports its metrics. Started by run_benchmark.py.
+
+    python benchmarks/stage_runner.py silver
+
+Settings overrides are read as JSON ({"stage": {...}, "global": {...}}) from BENCHMARK_SETTINGS_OVERRIDES and
+the time of the top-level steps (common.instrumentation) and the resource usage are written as JSON to
+BENCHMARK_METRICS_PATH, also when the stage exits without changes.
+"""
+
+import functools
+import importlib
+import json
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from common.instrumentation import metrics
+
+
+def apply_settings_overrides(module, overrides):
+    """Wraps load_all_settings so the stage sees the overridden values. Every stage returns its own settings
+    first and the global settings last."""
+    load_all_settings = module.load_all_settings
+
+    @functools.wraps(load_all_settings)
+    def load_overridden_settings():
+        stage_settings, *other_settings, global_settings = load_all_settings()
+        return (
+            {**stage_settings, **overrides.get("stage", {})},
+            *other_settings,
+            {**global_settings, **overrides.get("global", {})},
+        )
+
+    module.load_all_settings = load_overridden_settings
+
+
+def get_resource_usage():
+    """Peak RSS and storage I/O of this process, from /proc (Linux). getrusage is not used because its
+    ru_maxrss starts from the RSS of the parent process at fork time."""
+    usage = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                usage["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    with open("/proc/self/io") as f:
+        io_counters = dict(line.split(": ") for line in f.read().splitlines())
+    # Largest peak RSS of the processes the stage started and waited for, such as the silver shard workers
+    usage["peak_worker_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    usage["disk_bytes_read"] = int(io_counters["read_bytes"])
+    usage["disk_bytes_written"] = int(io_counters["write_bytes"])
+    return usage
+
+
+def run_stage(stage):
+    module = importlib.import_module(f"{stage}.main")
+    apply_settings_overrides(module, json.loads(os.environ.get("BENCHMARK_SETTINGS_OVERRIDES", "{}")))
+    try:
+        getattr(module, f"run_{stage}_pipeline")()
+    finally:
+        metrics_path = os.environ.get("BENCHMARK_METRICS_PATH")
+        if metrics_path:
+            with open(metrics_path, "w") as f:
+                stage_metrics = metrics.to_dict()
+                steps = {name: seconds for name, seconds in stage_metrics["step_totals"].items() if "/" not in name}
+                json.dump(
+                    {
+                        "steps": steps,
+                        "counters": stage_metrics["counters"],
+                        "query_profiles": stage_metrics["query_profiles"],
+                        **get_resource_usage(),
+                    },
+                    f,
+                )
+
+
+if __name__ == "__main__":
+    run_stage(sys.argv[1])
@@ -0,0 +1,171 @@
+"""Synthetic brewery catalog shaped like expected_bronze_schema, with a deterministic daily churn.
+
+The catalog lives in a DuckDB table. Day 0 holds `rows` breweries and every following day updates, deletes and
+inserts a fraction of them, chosen by hashing the brewery id with the day, so two runs with the same arguments
+serve exactly the same data.
+"""
+
+from dataclasses import dataclass
+
+BREWERY_TYPES = [
+    "micro",
+    "brewpub",
+    "planning",
+    "closed",
+    "regional",
+    "contract",
+    "large",
+    "proprietor",
+    "nano",
+    "taproom",
+    "bar",
+    "location",
+]
+STATES = [
+    "California",
+    "Washington",
+    "Colorado",
+    "Oregon",
+    "New York",
+    "Michigan",
+    "Pennsylvania",
+    "Texas",
+    "Florida",
+    "North Carolina",
+    "Ohio",
+    "Virginia",
+    "Illinois",
+    "Wisconsin",
+    "Massachusetts",
+    "Minnesota",
+    "Indiana",
+    "Arizona",
+    "Georgia",
+    "Maine",
+    "Missouri",
+    "New Jersey",
+    "Vermont",
+    "Montana",
+    "Idaho",
+    "Utah",
+    "Iowa",
+    "Kentucky",
+    "Tennessee",
+    "Maryland",
+]
+# Share of the catalog that is not in the United States, like the Irish and Scottish breweries of the real API
+INTERNATIONAL_FRACTION = 0.05
+# Share of breweries without coordinates
+MISSING_COORDINATES_FRACTION = 0.25
+HASH_BUCKETS = 1_000_000
+
+
+@dataclass
+class DailyChurn:
+    """Fractions of the catalog updated, deleted and inserted every day."""
+
+    update_fraction: float = 0.01
+    delete_fraction: float = 0.001
+    insert_fraction: float = 0.002
+
+
+def _sql_list(values):
+    return "[" + ", ".join(f"'{value}'" for value in values) + "]"
+
+
+def _get_brewery_rows_sql(seed_sql, day):
+    """Columns of expected_bronze_schema for rows identified by seed_sql, a unique string expression."""
+    bucket = f"(hash({seed_sql}, 'bucket') % {HASH_BUCKETS}) / {HASH_BUCKETS}"
+    return f"""
+        CAST(md5({seed_sql}) AS UUID) AS id,
+        'Brewery ' || substr(md5({seed_sql} || 'name'), 1, 8) AS name,
+        {_sql_list(BREWERY_TYPES)}[1 + CAST(hash({seed_sql}, 'type') % {len(BREWERY_TYPES)} AS INTEGER)] AS brewery_type,
+        (hash({seed_sql}, 'street') % 9000 + 100) || ' Main St' AS address_1,
+        NULL::VARCHAR AS address_2,
+        NULL::VARCHAR AS address_3,
+        'City ' || hash({seed_sql}, 'city') % 2000 AS city,
+        CASE WHEN {bucket} < {INTERNATIONAL_FRACTION} THEN 'Dublin'
+             ELSE {_sql_list(STATES)}[1 + CAST(hash({seed_sql}, 'state') % {len(STATES)} AS INTEGER)] END AS state_province,
+        lpad(CAST(hash({seed_sql}, 'zip') % 100000 AS VARCHAR), 5, '0') AS postal_code,
+        CASE WHEN {bucket} < {INTERNATIONAL_FRACTION} THEN 'Ireland' ELSE 'United States' END AS country,
+        CASE WHEN {bucket} >= 1 - {MISSING_COORDINATES_FRACTION} THEN NULL
+             ELSE -125 + (hash({seed_sql}, 'lon') % {HASH_BUCKETS}) / {HASH_BUCKETS} * 58 END AS longitude,
+        CASE WHEN {bucket} >= 1 - {MISSING_COORDINATES_FRACTION} THEN NULL
+             ELSE 25 + (hash({seed_sql}, 'lat') % {HASH_BUCKETS}) / {HASH_BUCKETS} * 24 END AS latitude,
+        CAST(hash({seed_sql}, 'phone', {day}) % 10000000000 AS VARCHAR) AS phone,
+        'http://www.brewery-' || substr(md5({seed_sql} || 'url'), 1, 8) || '.com' AS website_url,
+        state_province AS state,
+        address_1 AS street
+    """
+
+
+def create_catalog(con, rows, table_name="synthetic_breweries"):
+    """Day 0 catalog. rn is the position of the brewery in the API order (id:asc), used to serve pages."""
+    con.sql(f"""
+        CREATE OR REPLACE TABLE {table_name} AS
+        SELECT row_number() OVER (ORDER BY id) AS rn, *
+        FROM (SELECT {_get_brewery_rows_sql("'day-0-' || range", 0)} FROM range({rows}))
+        ORDER BY rn
+    """)
+
+
+def _is_chosen_sql(day, action, fraction):
+    return f"hash(id, {day}, '{action}') % {HASH_BUCKETS} < {int(fraction * HASH_BUCKETS)}"
+
+
+def advance_catalog(con, day, churn, table_name="synthetic_breweries"):
+    """Applies the churn of `day` to the catalog and returns how many breweries were updated, deleted and
+    inserted."""
+    row_count = con.sql(f"SELECT count(*) FROM {table_name}").fetchone()[0]
+    inserted = round(row_count * churn.insert_fraction)
+    counts = con.sql(f"""
+        SELECT count(*) FILTER (WHERE {_is_chosen_sql(day, "delete", churn.delete_fraction)}),
+               count(*) FILTER (WHERE {_is_chosen_sql(day, "update", churn.update_fraction)}
+                                AND NOT {_is_chosen_sql(day, "delete", churn.delete_fraction)})
+        FROM {table_name}
+    """).fetchone()
+    # Updated breweries change phone and website, the columns most often edited in the real catalog
+    con.sql(f"""
+        CREATE OR REPLACE TABLE {table_name} AS
+        SELECT row_number() OVER (ORDER BY id) AS rn, * EXCLUDE (rn)
+        FROM (
+            SELECT * REPLACE (
+                CASE WHEN {_is_chosen_sql(day, "update", churn.update_fraction)}
+                     THEN CAST(hash(id, 'phone', {day}) % 10000000000 AS VARCHAR) ELSE phone END AS phone,
+                CASE WHEN {_is_chosen_sql(day, "update", churn.update_fraction)}
+                     THEN 'http://www.brewery-' || substr(md5(id || '{day}'), 1, 8) || '.com'
+                     ELSE website_url END AS website_url
+            )
+            FROM {table_name}
+            WHERE NOT {_is_chosen_sql(day, "delete", churn.delete_fraction)}
+            UNION ALL BY NAME
+            SELECT {_get_brewery_rows_sql(f"'day-{day}-' || range", day)} FROM range({inserted})
+        )
+        ORDER BY rn
+    """)
+    return {"deleted": counts[0], "updated": counts[1], "inserted": inserted}
+
+
+def get_catalog_metadata(con, table_name="synthetic_breweries"):
+    """Body of /breweries/meta. Like the real API, the total is a string."""
+    total, by_state, by_type = con.sql(f"""
+        SELECT
+            (SELECT count(*) FROM {table_name}),
+            (SELECT map_from_entries(list((state, n) ORDER BY state))
+             FROM (SELECT state, count(*) AS n FROM {table_name} GROUP BY state)),
+            (SELECT map_from_entries(list((brewery_type, n) ORDER BY brewery_type))
+             FROM (SELECT brewery_type, count(*) AS n FROM {table_name} GROUP BY brewery_type))
+    """).fetchone()
+    return {"total": str(total), "page": "1", "per_page": "50", "by_state": by_state, "by_type": by_type}
+
+
+def get_catalog_page_json(con, page, per_page, table_name="synthetic_breweries"):
+    """JSON array of one page of /breweries, in id order."""
+    first_rn = (page - 1) * per_page + 1
+    return con.execute(
+        f"""
+        SELECT coalesce(to_json(list(t ORDER BY t.id))::VARCHAR, '[]')
+        FROM (SELECT * EXCLUDE (rn) FROM {table_name} WHERE rn BETWEEN ? AND ?) t
+        """,
+        [first_rn, first_rn + per_page - 1],
+    ).fetchone()[0]
@@ -1,6 +1,11 @@
+from datetime import datetime, timedelta
+
 from airflow import DAG
 from airflow.providers.docker.operators.docker import DockerOperator
-from datetime import datetime, timedelta
+from airflow.utils.trigger_rule import TriggerRule
+
+# Exit code of a stage that found nothing to do (common/run_manifest.py). The task is marked as skipped.
+NO_CHANGES_EXIT_CODE = 99
 
 default_args = {
     "retries": 2,
@@ -36,6 +41,7 @@ with DAG(
         env_file="./.env",
         mount_tmp_dir=False,
         execution_timeout=timedelta(minutes=180),
+        skip_on_exit_code=NO_CHANGES_EXIT_CODE,
     )
 
     gold = DockerOperator(
@@ -47,6 +53,10 @@ with DAG(
         env_file="./.env",
         mount_tmp_dir=False,
         execution_timeout=timedelta(minutes=60),
+        skip_on_exit_code=NO_CHANGES_EXIT_CODE,
+        # Gold still starts when silver is skipped and skips itself after one manifest read, unless it has not
+        # consumed the current silver files yet (e.g. its previous run failed)
+        trigger_rule=TriggerRule.NONE_FAILED,
     )
 
     bronze >> silver >> gold
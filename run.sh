@@ -4,6 +4,7 @@ sudo service docker start
 sudo docker build -f src/bronze/Dockerfile -t study-case-20250521-bronze-pipeline .
 sudo docker build -f src/silver/Dockerfile -t study-case-20250521-silver-pipeline .
 sudo docker build -f src/gold/Dockerfile -t study-case-20250521-gold-pipeline .
+sudo docker build -f src/serving/Dockerfile -t study-case-20250521-serving-api .
 sudo docker compose up -d
 
 
@@ -16,6 +17,9 @@ sudo docker compose up -d
 # sudo docker run --env-file .env study-case-20250521-silver-pipeline
 # sudo docker run --env-file .env study-case-20250521-gold-pipeline
 
+# To start the serving API (reads the gold and silver outputs):
+# sudo docker run -d -p 8080:8080 --env-file .env study-case-20250521-serving-api
+
 # Commands to create buckets automatically:
 # terraform -chdir=terraform init
 # terraform -chdir=terraform apply
\ No newline at end of file
@@ -1,14 +1,29 @@
+import contextlib
+import gzip
+import hashlib
+import io
 import json
 import logging
 import math
 import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
-import boto3
+import duckdb
 import requests
 import yaml
 from dotenv import load_dotenv
+from urllib3.util import make_headers
+
+from common.instrumentation import metrics
+from common.storage import get_storage
 
 load_dotenv()
 
@@ -16,6 +31,10 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 
+class BreweryApiError(Exception):
+    """The brewery API returned no metadata, unparsable metadata or an empty first page."""
+
+
 def load_all_settings():
     """Loads all necessary configuration files."""
     bronze_settings_path = os.path.join(os.path.dirname(__file__), "settings.yaml")
@@ -29,83 +48,715 @@ def load_all_settings():
     return bronze_s, global_s
 
 
-class APIRequestHandler:
+class AdaptiveRateLimiter:
+    """Token bucket shared by all fetch workers.
+
+    The refill rate is cut multiplicatively when the API answers with 429/5xx (or the request fails
+    without a response) and grows additively on every healthy response, bounded by min/max settings.
+    """
+
     def __init__(self, bronze_settings):
-        self.headers = bronze_settings["api_request_header"]
+        self.min_rate = bronze_settings["api_rate_limit_min_per_second"]
+        self.max_rate = bronze_settings["api_rate_limit_max_per_second"]
+        self.increase_step = bronze_settings["api_rate_limit_increase_step"]
+        self.backoff_factor = bronze_settings["api_rate_limit_backoff_factor"]
+        self.capacity = bronze_settings["api_rate_limit_burst"]
+        self.rate = bronze_settings["api_rate_limit_initial_per_second"]
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """Blocks until a token is available."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def record_response(self, status_code):
+        """Adapts the refill rate to the outcome of a request (status_code is None on connection errors)."""
+        with self.lock:
+            self._refill()
+            if status_code is None or status_code == 429 or status_code >= 500:
+                new_rate = max(self.min_rate, self.rate * self.backoff_factor)
+                # Drop any accumulated burst so the slower rate takes effect immediately
+                self.tokens = min(self.tokens, 0.0)
+                if new_rate != self.rate:
+                    logger.warning(
+                        f"API is struggling (status {status_code}). Rate limit lowered to {new_rate:.2f} req/s"
+                    )
+            else:
+                new_rate = min(self.max_rate, self.rate + self.increase_step)
+            self.rate = new_rate
+
+
+class APIRequestHandler:
+    """Fetches API resources through a pooled keep-alive session with exponential-backoff retries."""
+
+    # Client errors worth retrying. Any other 4xx is returned to the caller straight away
+    RETRYABLE_CLIENT_STATUS_CODES = frozenset({408, 429})
+
+    def __init__(self, bronze_settings, rate_limiter=None):
         self.max_retries = bronze_settings["api_request_max_retries"]
         self.retry_delay_seconds = bronze_settings["api_request_retry_delay_seconds"]
+        self.retry_max_delay_seconds = bronze_settings["api_request_retry_max_delay_seconds"]
+        self.timeout = (bronze_settings["api_connect_timeout_seconds"], bronze_settings["api_read_timeout_seconds"])
+        self.rate_limiter = rate_limiter
+
+        pool_size = bronze_settings["api_connection_pool_size"]
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # make_headers advertises br/zstd only when the matching decoder package is installed
+        self.session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+        self.session.headers.update(bronze_settings["api_request_header"])
+
+        self.request_stats = []
+        self.stats_lock = threading.Lock()
+
+    def _get_backoff_delay(self, attempt, response=None):
+        """Exponential backoff with full jitter, never shorter than the server's Retry-After."""
+        delay = random.uniform(0, min(self.retry_max_delay_seconds, self.retry_delay_seconds * 2**attempt))
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                retry_after_seconds = float(retry_after)
+            except ValueError:
+                try:
+                    retry_after_date = parsedate_to_datetime(retry_after)
+                    retry_after_seconds = (retry_after_date - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    retry_after_seconds = 0
+            delay = max(delay, retry_after_seconds)
+        return delay
+
+    def _record_stats(self, url, params, response, latency_seconds, retries):
+        # Content-Length is the size on the wire (compressed), response.content is already decoded
+        bytes_decoded = len(response.content)
+        bytes_received = int(response.headers.get("Content-Length", bytes_decoded))
+        stats = {
+            "url": url,
+            "page": (params or {}).get("page"),
+            "status_code": response.status_code,
+            "latency_seconds": latency_seconds,
+            "bytes_received": bytes_received,
+            "bytes_decoded": bytes_decoded,
+            "retries": retries,
+        }
+        with self.stats_lock:
+            self.request_stats.append(stats)
+        metrics.observe("api_request_latency_seconds", latency_seconds)
+        metrics.increment("api_requests")
+        metrics.increment(f"api_responses_{response.status_code}")
+        metrics.increment("api_bytes_received", bytes_received)
+        metrics.increment("api_bytes_decoded", bytes_decoded)
+        metrics.increment("api_retries", retries)
+        logger.info(
+            f"GET {url} page={stats['page']} status={response.status_code} in {latency_seconds:.3f}s, "
+            f"{bytes_received} bytes received ({bytes_decoded} decoded), {retries} retries"
+        )
 
     def make_request(self, url, params=None):
+        response = self._get_with_retries(url, params)
+        return response.text if response is not None else None  # Return raw text instead of JSON
+
+    def make_conditional_request(self, url, params=None, etag=None):
+        """Sends If-None-Match when an ETag is known. Returns (raw text or None if not modified, new ETag)."""
+        headers = {"If-None-Match": etag} if etag else None
+        response = self._get_with_retries(url, params, headers=headers)
+        if response is None:
+            return None, None
+        if response.status_code == 304:
+            return None, etag
+        return response.text, response.headers.get("ETag")
+
+    def _get_with_retries(self, url, params=None, headers=None):
         for attempt in range(self.max_retries):
+            response = None
             try:
-                response = requests.get(url, headers=self.headers, params=params)
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
+                request_start = time.perf_counter()
+                try:
+                    response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                except requests.exceptions.RequestException:
+                    if self.rate_limiter:
+                        self.rate_limiter.record_response(None)
+                    raise
+                latency_seconds = time.perf_counter() - request_start
+                if self.rate_limiter:
+                    self.rate_limiter.record_response(response.status_code)
                 response.raise_for_status()
-                return response.text  # Return raw text instead of JSON
+                self._record_stats(url, params, response, latency_seconds, retries=attempt)
+                return response
             except requests.exceptions.RequestException as e:
-                logger.warning(
-                    f"Error during API request to {url} (attempt {attempt + 1}/{self.max_retries}): {e}. Retrying..."
-                )
+                status_code = response.status_code if response is not None else None
+                if status_code and status_code < 500 and status_code not in self.RETRYABLE_CLIENT_STATUS_CODES:
+                    logger.error(f"Non-retryable error during API request to {url}: {e}")
+                    raise
                 if attempt + 1 == self.max_retries:
                     logger.error(f"Failed to fetch data from {url} after {self.max_retries} retries.")
                     raise
-                time.sleep(self.retry_delay_seconds)
+                delay = self._get_backoff_delay(attempt, response)
+                logger.warning(
+                    f"Error during API request to {url} (attempt {attempt + 1}/{self.max_retries}): {e}. "
+                    f"Retrying in {delay:.2f}s..."
+                )
+                time.sleep(delay)
         return None
 
+    def log_stats_summary(self):
+        """Logs aggregated latency, volume and retry figures for every successful request."""
+        with self.stats_lock:
+            stats = list(self.request_stats)
+        if not stats:
+            return
+        latencies = sorted(s["latency_seconds"] for s in stats)
+        p95_index = min(len(latencies) - 1, math.ceil(0.95 * len(latencies)) - 1)
+        logger.info(
+            f"API requests: {len(stats)} | "
+            f"latency p50={statistics.median(latencies):.3f}s p95={latencies[p95_index]:.3f}s "
+            f"max={latencies[-1]:.3f}s | "
+            f"bytes received={sum(s['bytes_received'] for s in stats)} "
+            f"decoded={sum(s['bytes_decoded'] for s in stats)} | "
+            f"retries={sum(s['retries'] for s in stats)}"
+        )
+
+
+class NDJSONStreamWriter:
+    """Streams the records of every page into a single gzip-compressed newline-delimited JSON object.
+
+    Locally the compressed stream goes straight to disk. On S3 it is cut into parts of at least
+    ndjson_stream_part_size_mb and sent through a multipart upload on the DataSaver upload queue,
+    so only one part is buffered in memory at a time.
+    """
+
+    def __init__(self, data_saver, file_name, bronze_settings):
+        self.data_saver = data_saver
+        self.file_name = file_name
+        # S3 rejects parts smaller than 5 MB (except the last one)
+        self.part_size_bytes = max(5, bronze_settings["ndjson_stream_part_size_mb"]) * 1024 * 1024
+        self.lock = threading.Lock()
+        self.records_written = 0
+
+        self.storage = data_saver.storage
+        self.path = f"{data_saver.run_directory}/{file_name}"
+        # The local file stays open until close() or abort(), which close the exit stack
+        with contextlib.ExitStack() as exit_stack:
+            if self.storage.kind == "local":
+                self.local_file_path = self.storage.get_output_uri(self.path)
+                self.buffer = exit_stack.enter_context(open(self.local_file_path, "wb"))
+            else:
+                self.buffer = io.BytesIO()
+                self.upload_id = self.storage.client.create_multipart_upload(
+                    Bucket=self.storage.bucket, Key=self.path, ContentType="application/gzip"
+                )["UploadId"]
+                self.part_futures = []
+            self.compressor = gzip.GzipFile(
+                fileobj=self.buffer, mode="wb", compresslevel=bronze_settings["ndjson_stream_compression_level"]
+            )
+            self.exit_stack = exit_stack.pop_all()
+
+    def write_page(self, page_data_raw):
+        records = json.loads(page_data_raw)
+        lines = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        with self.lock:
+            self.compressor.write(lines)
+            self.records_written += len(records)
+            if self.storage.kind == "s3" and self.buffer.tell() >= self.part_size_bytes:
+                self._submit_buffered_part()
+
+    def _submit_buffered_part(self):
+        body = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        part_number = len(self.part_futures) + 1
+        self.part_futures.append(self.data_saver.submit_upload(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        response = self.storage.client.upload_part(
+            Bucket=self.storage.bucket,
+            Key=self.path,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        metrics.increment("storage_bytes_written", len(body))
+        logger.info(f"Uploaded part {part_number} ({len(body)} bytes) of {self.storage.get_uri(self.path)}")
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def close(self):
+        """Writes the gzip trailer and completes the upload. Only the last part may be smaller than the part size."""
+        with self.lock:
+            self.compressor.close()
+            if self.storage.kind == "local":
+                self.exit_stack.close()
+                metrics.increment("storage_bytes_written", os.path.getsize(self.local_file_path))
+                logger.info(f"Saved {self.records_written} records to {self.local_file_path}")
+                return
+            self._submit_buffered_part()
+
+        s3_client = self.storage.client
+        try:
+            parts = [future.result() for future in self.part_futures]
+            s3_client.complete_multipart_upload(
+                Bucket=self.storage.bucket,
+                Key=self.path,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            s3_client.abort_multipart_upload(Bucket=self.storage.bucket, Key=self.path, UploadId=self.upload_id)
+            raise
+        logger.info(f"Saved {self.records_written} records to {self.storage.get_uri(self.path)}")
+
+    def abort(self):
+        """Drops what was written: the partial local file is removed, the multipart upload aborted."""
+        with self.lock:
+            self.compressor.close()
+            self.exit_stack.close()
+        if self.storage.kind == "local":
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.local_file_path)
+        else:
+            self.storage.client.abort_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.path, UploadId=self.upload_id
+            )
+
+
+# Extension of the files written by ColumnarPageConverter, per output_format
+CONVERTED_FILE_EXTENSIONS = {"parquet": ".parquet", "ndjson": ".ndjson.zst"}
+
+
+class ColumnarPageConverter:
+    """Converts raw API pages into zstd-compressed Parquet or newline-delimited JSON with DuckDB.
+
+    Columns are typed against expected_bronze_schema, so a value that does not fit its declared type fails
+    the ingestion, and fields added or removed by the API are reported as schema drift.
+    """
+
+    def __init__(self, bronze_settings, global_settings):
+        self.output_format = bronze_settings["output_format"]
+        if self.output_format not in CONVERTED_FILE_EXTENSIONS:
+            raise ValueError(f"Unknown output_format: {self.output_format}. Use 'raw_json', 'parquet' or 'ndjson'.")
+        self.compression = bronze_settings["output_compression"]
+        self.expected_schema = global_settings["expected_bronze_schema"]
+        self.staging_dir = tempfile.mkdtemp(prefix="bronze-")
+
+    def converted_file_name(self, raw_file_name):
+        return os.path.splitext(raw_file_name)[0] + CONVERTED_FILE_EXTENSIONS[self.output_format]
+
+    def check_schema_drift(self, records, source_name):
+        """Compares the fields present in the records with the expected schema."""
+        actual_fields = set().union(*(record.keys() for record in records)) if records else set()
+        drift = {
+            "added_fields": sorted(actual_fields - set(self.expected_schema)),
+            "missing_fields": sorted(set(self.expected_schema) - actual_fields) if records else [],
+        }
+        if drift["added_fields"] or drift["missing_fields"]:
+            logger.warning(f"Schema drift in {source_name}: {drift}")
+            return drift
+        return None
+
+    def stage_page(self, page_data_raw, raw_file_name):
+        """Writes a raw page to the local staging directory and returns its path."""
+        staged_path = os.path.join(self.staging_dir, raw_file_name)
+        with open(staged_path, "w") as f:
+            f.write(page_data_raw)
+        return staged_path
+
+    def convert(self, source_paths, target_path):
+        """Converts staged raw pages (JSON arrays) into a single typed, compressed file."""
+        if self.output_format == "parquet":
+            copy_options = f"FORMAT parquet, COMPRESSION {self.compression}"
+        else:
+            copy_options = f"FORMAT json, COMPRESSION {self.compression}"
+        # One connection per call: conversions run concurrently on the upload workers
+        with duckdb.connect() as con:
+            try:
+                con.sql(f"""
+                    COPY (
+                        SELECT * FROM read_json({source_paths}, format = 'array', columns = {self.expected_schema})
+                    ) TO '{target_path}' ({copy_options});
+                """)
+            except duckdb.ConversionException as e:
+                logger.error(f"Values in {source_paths} do not match expected_bronze_schema: {e}")
+                raise
+        return target_path
+
+    def cleanup(self):
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
 
 class DataSaver:
-    def __init__(self, global_settings):
+    def __init__(self, global_settings, bronze_settings):
         self.run_timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
         logger.info(f"Run timestamp for DataSaver: {self.run_timestamp}")
         self.last_run_metadata_bronze_path = global_settings["last_run_metadata_bronze_path"]
+        self.page_file_name_template = global_settings["brewery_page_filename_template"]
+
+        # One pooled connection per upload worker on S3
+        self.storage = get_storage(global_settings, max_pool_connections=bronze_settings["upload_max_workers"])
+        self.run_directory = f"bronze/{self.run_timestamp}"
+        logger.info(f"Bronze data of this run goes to {self.storage.get_uri(self.run_directory)}")
 
-        self.output_env = os.environ["OUTPUT_ENV"]
-        if self.output_env == "local":
-            base_data_path = global_settings.get("local_data_path", "data")
-            # Assuming main.py is in src/bronze/
-            # os.path.join(os.path.dirname(__file__), "..", "..") is project_root/
-            project_root_for_data = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-            self.base_local_path = os.path.join(project_root_for_data, base_data_path, "bronze", self.run_timestamp)
-            os.makedirs(self.base_local_path, exist_ok=True)
-            logger.info(f"Local data directory prepared: {self.base_local_path}")
-        elif self.output_env == "s3":
-            self.s3_client = boto3.client("s3")
-            self.s3_bucket = os.environ["S3_BUCKET_NAME"]
-            self.base_s3_key_prefix = f"bronze/{self.run_timestamp}"
-            logger.info(f"Using S3 bucket: {self.s3_bucket}, base key prefix for this run: {self.base_s3_key_prefix}")
+        # Uploads run off the fetch path. The semaphore bounds how many pages wait in memory,
+        # blocking the fetch workers when storage falls behind
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=bronze_settings["upload_max_workers"], thread_name_prefix="upload"
+        )
+        self.upload_slots = threading.BoundedSemaphore(bronze_settings["upload_max_pending"])
+        self.pending_uploads = []
+        self.pending_uploads_lock = threading.Lock()
+
+        self.bronze_settings = bronze_settings
+        self.output_layout = bronze_settings.get("output_layout", "pages")
+        if self.output_layout == "ndjson_stream":
+            self.data_file_pattern = global_settings["brewery_stream_filename"]
+        elif self.output_layout == "pages":
+            self.data_file_pattern = self.page_file_name_template.format(page_number="*")
         else:
-            logger.warning(f"Unknown output_env: {self.output_env}. Data saving might not work as expected.")
+            raise ValueError(f"Unknown output_layout: {self.output_layout}. Use 'pages' or 'ndjson_stream'.")
+        # Created on the first page so a failed metadata request does not leave a dangling multipart upload
+        self.stream_writer = None
+        self.stream_writer_lock = threading.Lock()
 
-    def save_text(self, data, file_name):
-        """Saves raw text data to local disk or S3 using pre-configured paths."""
-        if self.output_env == "local":
-            local_file_path = os.path.join(self.base_local_path, file_name)
-            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-            with open(local_file_path, "w") as f:
-                f.write(data)
-            logger.info(f"Saved data to {local_file_path}")
-        elif self.output_env == "s3":
-            s3_key = f"{self.base_s3_key_prefix}/{file_name}"
-            self.s3_client.put_object(Bucket=self.s3_bucket, Key=s3_key, Body=data, ContentType="text/plain")
-            logger.info(f"Saved data to S3: s3://{self.s3_bucket}/{s3_key}")
+        # Per-page fingerprints of this run, keyed by page number
+        self.page_manifest_file_name = global_settings["page_manifest_file_name"]
+        self.page_manifest = {}
+        self.page_manifest_lock = threading.Lock()
+        self.incremental_mode = bronze_settings.get("incremental_mode", False)
+        self.incremental_reuse_strategy = bronze_settings.get("incremental_reuse_strategy", "copy")
+        if self.incremental_mode and self.output_layout != "pages":
+            logger.warning("incremental_mode only works with output_layout 'pages'. Running a full ingestion.")
+            self.incremental_mode = False
+        if self.incremental_reuse_strategy not in ("copy", "reference"):
+            raise ValueError(
+                f"Unknown incremental_reuse_strategy: {self.incremental_reuse_strategy}. Use 'copy' or 'reference'."
+            )
+        self.output_format = bronze_settings.get("output_format", "raw_json")
+        self.output_granularity = bronze_settings.get("output_granularity", "page")
+        self.keep_raw_json = bronze_settings.get("keep_raw_json", True)
+        self.converter = None
+        if self.output_format != "raw_json":
+            if self.output_layout != "pages":
+                raise ValueError("output_format 'parquet' and 'ndjson' require output_layout 'pages'.")
+            self.converter = ColumnarPageConverter(bronze_settings, global_settings)
+            if self.output_granularity == "run":
+                self.data_file_pattern = (
+                    global_settings["brewery_run_file_stem"] + CONVERTED_FILE_EXTENSIONS[self.output_format]
+                )
+                if self.incremental_mode:
+                    logger.warning(
+                        "incremental_mode does not work with output_granularity 'run'. Running a full ingestion."
+                    )
+                    self.incremental_mode = False
+            elif self.output_granularity == "page":
+                self.data_file_pattern = self.converter.converted_file_name(self.data_file_pattern)
+            else:
+                raise ValueError(f"Unknown output_granularity: {self.output_granularity}. Use 'page' or 'run'.")
+        self.previous_page_manifest = self.load_previous_page_manifest() if self.incremental_mode else {}
+
+    def submit_upload(self, function, *args):
+        """Runs function on the upload queue, waiting for a free slot if too many uploads are pending."""
+        self.upload_slots.acquire()
+        try:
+            future = self.upload_executor.submit(function, *args)
+        except Exception:
+            self.upload_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.upload_slots.release())
+        with self.pending_uploads_lock:
+            self.pending_uploads.append(future)
+        return future
+
+    def _read_bronze_text(self, relative_path):
+        """Reads a text object relative to the bronze root. Returns None if it does not exist."""
+        return self.storage.read_text(f"bronze/{relative_path}")
+
+    def load_previous_page_manifest(self):
+        """Loads the page fingerprints of the last complete run, if it wrote any."""
+        last_run_metadata_raw = self._read_bronze_text(self.last_run_metadata_bronze_path)
+        if not last_run_metadata_raw:
+            logger.info("No previous bronze run found. Running a full ingestion.")
+            return {}
+        page_manifest_path = json.loads(last_run_metadata_raw).get("page_manifest")
+        page_manifest_raw = self._read_bronze_text(page_manifest_path) if page_manifest_path else None
+        if not page_manifest_raw:
+            logger.info("Previous bronze run has no page manifest. Running a full ingestion.")
+            return {}
+        pages = json.loads(page_manifest_raw)["pages"]
+        logger.info(f"Loaded fingerprints of {len(pages)} pages from {page_manifest_path}")
+        return {int(page): entry for page, entry in pages.items()}
+
+    def get_previous_etag(self, page):
+        previous_entry = self.previous_page_manifest.get(page, {})
+        # A page stored in another format cannot be reused, so its body has to be downloaded again
+        if previous_entry.get("format", "raw_json") != self.output_format:
+            return None
+        return previous_entry.get("etag")
+
+    def _copy_bronze_object(self, source_path, target_path):
+        # Server-side copy on S3: the page body never leaves the bucket
+        self.storage.copy(f"bronze/{source_path}", f"bronze/{target_path}")
+        logger.info(f"Page unchanged, copied {source_path} to {target_path}")
+
+    def _reuse_previous_page(self, previous_entry):
+        """Makes the unchanged object of a previous run part of this run. Returns its path relative to bronze."""
+        if self.incremental_reuse_strategy == "reference":
+            return previous_entry["object_path"]
+
+        target_path = f"{self.run_timestamp}/{os.path.basename(previous_entry['object_path'])}"
+        self.submit_upload(self._copy_bronze_object, previous_entry["object_path"], target_path)
+        return target_path
+
+    def _save_converted_page(self, page_data_raw, page_file_name, converted_file_name):
+        staged_path = self.converter.stage_page(page_data_raw, page_file_name)
+        converted_path = self.converter.convert(
+            [staged_path], os.path.join(self.converter.staging_dir, converted_file_name)
+        )
+        os.remove(staged_path)
+        self.save_file(converted_path, converted_file_name)
+
+    def _write_page(self, page_data_raw, page_file_name):
+        """Queues a changed page for upload in the configured format. Returns its path relative to bronze."""
+        if self.converter is None or self.keep_raw_json:
+            self.submit_upload(self.save_text, page_data_raw, page_file_name)
+        if self.converter is None:
+            return f"{self.run_timestamp}/{page_file_name}"
+
+        if self.output_granularity == "run":
+            # Converted all at once in flush(). Staging to local disk keeps the pages out of memory
+            self.converter.stage_page(page_data_raw, page_file_name)
+            return f"{self.run_timestamp}/{page_file_name}" if self.keep_raw_json else None
+
+        converted_file_name = self.converter.converted_file_name(page_file_name)
+        self.submit_upload(self._save_converted_page, page_data_raw, page_file_name, converted_file_name)
+        return f"{self.run_timestamp}/{converted_file_name}"
+
+    def _save_page_object(self, page_data_raw, page, etag):
+        page_file_name = self.page_file_name_template.format(page_number=page)
+        previous_entry = self.previous_page_manifest.get(page)
+        if page_data_raw is None:
+            # 304 Not Modified: the API confirmed the previous body is still current
+            fingerprint = {key: previous_entry[key] for key in ("sha256", "record_count")}
+        else:
+            records = json.loads(page_data_raw)
+            fingerprint = {
+                "sha256": hashlib.sha256(page_data_raw.encode("utf-8")).hexdigest(),
+                "record_count": len(records),
+            }
+            if self.converter:
+                schema_drift = self.converter.check_schema_drift(records, page_file_name)
+                if schema_drift:
+                    fingerprint["schema_drift"] = schema_drift
+
+        changed = (
+            previous_entry is None
+            or previous_entry["sha256"] != fingerprint["sha256"]
+            or previous_entry.get("format", "raw_json") != self.output_format
+        )
+        if changed:
+            object_path = self._write_page(page_data_raw, page_file_name)
         else:
-            logger.warning(f"Unknown output_env: {self.output_env}. Data not saved.")
+            object_path = self._reuse_previous_page(previous_entry)
+
+        with self.page_manifest_lock:
+            self.page_manifest[page] = {
+                **fingerprint,
+                "object_path": object_path,
+                "format": self.output_format,
+                "etag": etag,
+                "changed": changed,
+            }
 
+    def save_page(self, page_data_raw, page, etag=None):
+        """Hands a fetched page to the upload stage according to the configured output layout.
+
+        page_data_raw is None when the API answered 304 Not Modified for the page.
+        """
+        if self.output_layout == "pages":
+            self._save_page_object(page_data_raw, page, etag)
+        elif self.output_layout == "ndjson_stream":
+            with self.stream_writer_lock:
+                if self.stream_writer is None:
+                    self.stream_writer = NDJSONStreamWriter(self, self.data_file_pattern, self.bronze_settings)
+            self.stream_writer.write_page(page_data_raw)
+
+    @metrics.timed
+    def flush(self):
+        """Waits for every pending upload and raises the first failure, if any."""
+        try:
+            if self.stream_writer:
+                self.stream_writer.close()
+            with self.pending_uploads_lock:
+                pending_uploads, self.pending_uploads = self.pending_uploads, []
+            for future in pending_uploads:
+                future.result()
+            if self.converter and self.output_granularity == "run":
+                self._save_converted_run()
+        finally:
+            self.upload_executor.shutdown(wait=True)
+            if self.converter:
+                self.converter.cleanup()
+        logger.info("All pending uploads finished.")
+
+    def _save_converted_run(self):
+        staged_pattern = os.path.join(self.converter.staging_dir, self.page_file_name_template.format(page_number="*"))
+        converted_path = self.converter.convert(
+            [staged_pattern], os.path.join(self.converter.staging_dir, self.data_file_pattern)
+        )
+        self.save_file(converted_path, self.data_file_pattern)
+
+    def abort(self):
+        """Stops the upload stage after a failed run without publishing anything."""
+        self.upload_executor.shutdown(wait=True, cancel_futures=True)
+        if self.stream_writer:
+            self.stream_writer.abort()
+        if self.converter:
+            self.converter.cleanup()
+
+    def save_file(self, local_source_path, file_name):
+        """Moves a locally produced file to its place in this run's directory."""
+        metrics.increment("storage_bytes_written", os.path.getsize(local_source_path))
+        path = f"{self.run_directory}/{file_name}"
+        self.storage.upload_file(local_source_path, path)
+        logger.info(f"Saved data to {self.storage.get_uri(path)}")
+
+    def save_text(self, data, file_name):
+        """Saves raw text data in this run's directory."""
+        metrics.increment("storage_bytes_written", len(data.encode("utf-8")))
+        path = f"{self.run_directory}/{file_name}"
+        self.storage.write_text(path, data)
+        logger.info(f"Saved data to {self.storage.get_uri(path)}")
+
+    def save_page_manifest(self):
+        """Saves the page fingerprints of this run and returns the run summary for last_run_metadata."""
+        pages = dict(sorted(self.page_manifest.items()))
+        run_fingerprint = hashlib.sha256("".join(entry["sha256"] for entry in pages.values()).encode()).hexdigest()
+        summary = {
+            "fingerprint": run_fingerprint,
+            "page_count": len(pages),
+            "changed_page_count": sum(entry["changed"] for entry in pages.values()),
+            "record_count": sum(entry["record_count"] for entry in pages.values()),
+        }
+        manifest = {**summary, "pages": {str(page): entry for page, entry in pages.items()}}
+        metrics.set_value("rows_bronze", summary["record_count"])
+        metrics.set_value("pages", summary["page_count"])
+        metrics.set_value("pages_changed", summary["changed_page_count"])
+        self.save_text(json.dumps(manifest, indent=4), self.page_manifest_file_name)
+        logger.info(
+            f"{summary['changed_page_count']} of {summary['page_count']} pages changed since the last run "
+            f"({summary['record_count']} records)"
+        )
+        return {**summary, "page_manifest": f"{self.run_timestamp}/{self.page_manifest_file_name}"}
+
+    @metrics.timed
     def save_last_run_metadata(self):
         """Saves metadata about the last run to the bronze directory."""
-        metadata = {"last_run_directory": self.run_timestamp}
-
-        if self.output_env == "local":
-            bronze_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "data", "bronze"))
-            metadata_file_path = os.path.join(bronze_dir, self.last_run_metadata_bronze_path)
-            with open(metadata_file_path, "w") as f:
-                json.dump(metadata, f, indent=4)
-            logger.info(f"Saved last run metadata to {metadata_file_path}")
-        elif self.output_env == "s3":
-            s3_key = os.path.join("bronze", self.last_run_metadata_bronze_path)
-            self.s3_client.put_object(
-                Bucket=self.s3_bucket, Key=s3_key, Body=json.dumps(metadata, indent=4), ContentType="application/json"
-            )
-            logger.info(f"Saved last run metadata to S3: s3://{self.s3_bucket}/{s3_key}")
+        metadata = {
+            "last_run_directory": self.run_timestamp,
+            "data_file_pattern": self.data_file_pattern,
+            "data_format": self.output_format,
+            "data_granularity": self.output_granularity,
+        }
+        if self.output_layout == "pages":
+            metadata.update(self.save_page_manifest())
+
+        path = os.path.join("bronze", self.last_run_metadata_bronze_path)
+        self.storage.write_json(path, metadata)
+        logger.info(f"Saved last run metadata to {self.storage.get_uri(path)}")
+
+
+def fetch_page(api_handler, data_saver, bronze_settings, page):
+    """Fetches a single page and saves it. Returns False if the API returned no data for the page."""
+    api_params = {
+        "per_page": bronze_settings["api_param_itens_per_page"],
+        "sort": bronze_settings["api_param_sort_by"],
+        "page": page,
+    }
+    previous_etag = data_saver.get_previous_etag(page)
+    page_data_raw, etag = api_handler.make_conditional_request(
+        bronze_settings["api_url"], params=api_params, etag=previous_etag
+    )
+    if page_data_raw is None and previous_etag and etag == previous_etag:
+        logger.info(f"Page {page} not modified since the last run.")
+        data_saver.save_page(None, page, etag=etag)
+        return True
+
+    if not page_data_raw:
+        if page == 1:
+            logger.error("No data found on the first page. The filters may not be working or the API may be down.")
+            raise BreweryApiError("No data found on the first page.")
+        logger.warning(f"No data found on page {page}. This might indicate an issue or end of data.")
+        return False
+
+    data_saver.save_page(page_data_raw, page, etag=etag)
+    return True
+
+
+@metrics.timed
+def fetch_pages_sequentially(api_handler, data_saver, bronze_settings, total_pages):
+    """Fetches one page at a time, waiting api_request_delay_seconds between requests."""
+    for page in range(1, total_pages + 1):
+        logger.info(f"Fetching page {page} of {total_pages}...")
+        if not fetch_page(api_handler, data_saver, bronze_settings, page):
+            break
+
+        # if page >= 3:
+        #     logger.info("Fetched 3 pages. Stopping further requests to avoid overloading the API.")
+        #     break
+
+        time.sleep(bronze_settings.get("api_request_delay_seconds", 1))
+
+
+@metrics.timed
+def fetch_pages_concurrently(api_handler, data_saver, bronze_settings, total_pages):
+    """Keeps up to api_max_concurrent_requests pages in flight. Pacing is done by the handler's rate limiter.
+
+    As in the sequential fetch, an empty page ends the catalog: the requests of the pages after it that have not
+    started are cancelled. Pages after it already in flight are still saved, as the API returned data for them.
+    """
+    max_workers = bronze_settings["api_max_concurrent_requests"]
+    logger.info(f"Fetching {total_pages} pages with up to {max_workers} concurrent requests...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch_page, api_handler, data_saver, bronze_settings, page): page
+            for page in range(1, total_pages + 1)
+        }
+        pages_done = 0
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            pages_done += 1
+            try:
+                page_has_data = future.result()
+            except Exception:
+                logger.error(f"Page {futures[future]} failed. Cancelling the remaining requests.")
+                for pending in futures:
+                    pending.cancel()
+                raise
+            if not page_has_data:
+                empty_page = futures[future]
+                cancelled_pages = [
+                    page
+                    for pending, page in futures.items()
+                    if page > empty_page and not pending.done() and pending.cancel()
+                ]
+                if cancelled_pages:
+                    logger.info(f"Cancelled the requests of the {len(cancelled_pages)} pages after page {empty_page}.")
+            if pages_done % 10 == 0 or pages_done == total_pages:
+                logger.info(f"Fetched {pages_done} of {total_pages} pages")
 
 
 def run_bronze_pipeline():
@@ -113,15 +764,21 @@ def run_bronze_pipeline():
     logger.info("Starting the Bronze pipeline...")
 
     bronze_settings, global_settings = load_all_settings()
-    data_saver = DataSaver(global_settings=global_settings)
-    api_handler = APIRequestHandler(bronze_settings=bronze_settings)
+    data_saver = DataSaver(global_settings=global_settings, bronze_settings=bronze_settings)
+    metrics.configure(
+        "bronze", global_settings.get("instrumentation"), data_saver.storage, "bronze", data_saver.run_timestamp
+    )
+    rate_limiter = None
+    if bronze_settings.get("api_fetch_mode", "sequential") == "concurrent":
+        rate_limiter = AdaptiveRateLimiter(bronze_settings=bronze_settings)
+    api_handler = APIRequestHandler(bronze_settings=bronze_settings, rate_limiter=rate_limiter)
 
     logger.info("Fetching metadata...")
     meta_url = bronze_settings["meta_url"]
     metadata_raw = api_handler.make_request(meta_url)
     if not metadata_raw:
         logger.error("Failed to fetch metadata. Exiting.")
-        raise Exception("Metadata fetch failed.")
+        raise BreweryApiError("Metadata fetch failed.")
     data_saver.save_text(data=metadata_raw, file_name=global_settings["metadata_file_name"])
 
     try:
@@ -129,40 +786,30 @@ def run_bronze_pipeline():
         total_breweries = int(metadata["total"])
     except (json.JSONDecodeError, KeyError) as e:
         logger.error(f"Failed to parse metadata JSON: {e}. Exiting.")
-        raise Exception("Metadata parsing failed.")
+        raise BreweryApiError("Metadata parsing failed.") from e
 
     logger.info(f"Total breweries found: {total_breweries}")
     items_per_page = bronze_settings["api_param_itens_per_page"]
     total_pages = math.ceil(total_breweries / items_per_page)
     logger.info(f"Total pages to fetch: {total_pages} (based on {items_per_page} items per page)")
 
-    # Main Loop - Fetch all brewery data
-    for page in range(1, total_pages + 1):
-        logger.info(f"Fetching page {page} of {total_pages}...")
-        api_params = {
-            "per_page": items_per_page,
-            "sort": bronze_settings["api_param_sort_by"],
-            "page": page,
-        }
-        page_data_raw = api_handler.make_request(bronze_settings["api_url"], params=api_params)
-
-        if not page_data_raw:
-            if page == 1:
-                logger.error("No data found on the first page. The filters may not be working or the API may be down.")
-                raise Exception("No data found on the first page.")
-            logger.warning(f"No data found on page {page}. This might indicate an issue or end of data.")
-            break
-
-        page_file_name = global_settings["brewery_page_filename_template"].format(page_number=page)
-        data_saver.save_text(data=page_data_raw, file_name=page_file_name)
-
-        # if page >= 3:
-        #     logger.info("Fetched 3 pages. Stopping further requests to avoid overloading the API.")
-        #     break
-
-        time.sleep(bronze_settings.get("api_request_delay_seconds", 1))
+    fetch_mode = bronze_settings.get("api_fetch_mode", "sequential")
+    try:
+        if fetch_mode == "concurrent":
+            fetch_pages_concurrently(api_handler, data_saver, bronze_settings, total_pages)
+        elif fetch_mode == "sequential":
+            fetch_pages_sequentially(api_handler, data_saver, bronze_settings, total_pages)
+        else:
+            raise ValueError(f"Unknown api_fetch_mode: {fetch_mode}. Use 'sequential' or 'concurrent'.")
+    except Exception:
+        data_saver.abort()
+        raise
+    data_saver.flush()
 
+    # Only reached once every page has been saved, so silver never reads a partial run
     data_saver.save_last_run_metadata()
+    api_handler.log_stats_summary()
+    metrics.finish("succeeded")
     logger.info("Bronze pipeline finished.")
 
 
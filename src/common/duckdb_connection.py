@@ -0,0 +1,132 @@
+import logging
+import os
+
+import duckdb
+
+from common.instrumentation import metrics
+from common.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+def get_duckdb_connection(global_settings, stage_name, storage=None):
+    """Opens the DuckDB connection of a stage, configured by the duckdb section of project-settings.yaml.
+
+    Every option except database_path is passed to DuckDB as is (memory_limit, threads, temp_directory, ...).
+    With database_path set, the working database is kept on disk between runs, so tables such as silver_data
+    can be reused instead of being downloaded again. The connection is set up to read and write storage
+    (common.storage), by default the backend selected by OUTPUT_ENV.
+    """
+    duckdb_settings = dict(global_settings.get("duckdb") or {})
+    database_path = duckdb_settings.pop("database_path", None)
+    config = {key: value for key, value in duckdb_settings.items() if value is not None}
+
+    if config.get("temp_directory"):
+        os.makedirs(config["temp_directory"], exist_ok=True)
+    if database_path:
+        database_path = database_path.format(stage=stage_name)
+        os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+
+    con = duckdb.connect(database_path or ":memory:", config=config)
+    (storage or get_storage(global_settings)).configure_duckdb(con)
+    metrics.enable_query_profiling(con)
+    logger.info(f"DuckDB connection for {stage_name} opened on {database_path or 'memory'} with {config}")
+    return con
+
+
+def table_exists(con, table_name):
+    return (
+        con.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?", [table_name]).fetchone()[0]
+        > 0
+    )
+
+
+def _get_loaded_partitions(con, table_name):
+    loaded_partitions = {}
+    for partition, partition_value, path in con.sql(
+        f"SELECT partition, partition_value, path FROM {table_name}__loaded_files"
+    ).fetchall():
+        loaded_partitions.setdefault(partition, {"value": partition_value, "files": []})["files"].append(path)
+    return {
+        partition: {"value": entry["value"], "files": sorted(entry["files"])}
+        for partition, entry in loaded_partitions.items()
+    }
+
+
+def mark_table_synced(con, table_name, partition_manifest, partition_column="state"):
+    """Records which manifest files the table holds, so the next sync only reloads what changed."""
+    mark_table_unsynced(con, table_name)
+    rows = [
+        (partition, entry[partition_column], path)
+        for partition, entry in partition_manifest["partitions"].items()
+        for path in entry["files"]
+    ]
+    if rows:
+        con.executemany(f"INSERT INTO {table_name}__loaded_files VALUES (?, ?, ?)", rows)
+
+
+def mark_table_unsynced(con, table_name):
+    """Call before modifying a synced table in place, so a failed run forces a full reload next time."""
+    con.sql(
+        f"CREATE OR REPLACE TABLE {table_name}__loaded_files (partition VARCHAR, partition_value VARCHAR, path VARCHAR)"
+    )
+
+
+def sync_table_with_partition_manifest(
+    con, table_name, partition_manifest, root_path, read_options, partition_column="state", storage=None
+):
+    """Makes table_name hold exactly the files listed in a partition manifest.
+
+    On a persistent database only the partitions whose files changed since the last sync are deleted and
+    read again. Otherwise, or if the table cannot be patched, the table is fully loaded. Files are read through
+    storage.get_read_paths when storage is given, so they can come from its local read-through cache.
+    Raises duckdb.IOException when the manifest lists no files and the table does not exist yet.
+    """
+    manifest_files = {
+        partition: sorted(entry["files"]) for partition, entry in partition_manifest["partitions"].items()
+    }
+
+    def read_files_sql(partitions):
+        paths = [os.path.join(root_path, path) for partition in partitions for path in manifest_files[partition]]
+        if storage is not None:
+            paths = storage.get_read_paths(paths)
+        return f"read_parquet({paths}, {read_options})"
+
+    if table_exists(con, table_name) and table_exists(con, f"{table_name}__loaded_files"):
+        loaded_partitions = _get_loaded_partitions(con, table_name)
+        changed_partitions = [
+            partition
+            for partition in set(manifest_files) | set(loaded_partitions)
+            if manifest_files.get(partition) != loaded_partitions.get(partition, {}).get("files")
+        ]
+        if loaded_partitions and not changed_partitions:
+            logger.info(f"{table_name} is up to date with the partition manifest. Nothing read from storage.")
+            return 0
+        if loaded_partitions:
+            logger.info(f"Reloading {len(changed_partitions)} changed partitions of {table_name}")
+            try:
+                con.sql("BEGIN TRANSACTION")
+                for partition in changed_partitions:
+                    if partition in loaded_partitions:
+                        con.execute(
+                            f"DELETE FROM {table_name} WHERE {partition_column} IS NOT DISTINCT FROM ?",
+                            [loaded_partitions[partition]["value"]],
+                        )
+                partitions_to_read = [partition for partition in changed_partitions if partition in manifest_files]
+                if partitions_to_read:
+                    con.sql(f"INSERT INTO {table_name} BY NAME SELECT * FROM {read_files_sql(partitions_to_read)}")
+                    metrics.record_query_profile(con, f"reload_partitions_of_{table_name}")
+                mark_table_synced(con, table_name, partition_manifest, partition_column)
+                con.sql("COMMIT")
+                return len(changed_partitions)
+            except duckdb.Error as e:
+                con.sql("ROLLBACK")
+                logger.warning(f"Could not patch {table_name} ({e}). Loading it from scratch.")
+
+    if not manifest_files:
+        raise duckdb.IOException(f"Partition manifest of {table_name} lists no files")
+    logger.info(f"Loading {table_name} from {sum(len(files) for files in manifest_files.values())} files")
+    con.sql(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM {read_files_sql(manifest_files)}")
+    metrics.record_query_profile(con, f"load_{table_name}")
+    mark_table_synced(con, table_name, partition_manifest, partition_column)
+    return len(manifest_files)
@@ -0,0 +1,135 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_OF_LATITUDE = EARTH_RADIUS_KM * math.pi / 180
+CELL_SIZE_METADATA_KEY = "cell_size_degrees"
+
+# Cell coordinates fit in 16 bits for any cell size down to 0.006 degrees
+CELL_COORDINATE_BITS = 16
+
+
+def get_cell_key_sql(latitude_column, longitude_column, cell_size_degrees):
+    """SQL of the Z-order (Morton) key of the grid cell of a point.
+
+    The bits of the cell column and row are interleaved, so points close to each other mostly get close keys.
+    A file sorted by this key keeps nearby breweries in the same row groups, whose min/max statistics let
+    DuckDB skip the others.
+    """
+    cell_x = f"CAST(floor(({longitude_column} + 180) / {cell_size_degrees}) AS BIGINT)"
+    cell_y = f"CAST(floor(({latitude_column} + 90) / {cell_size_degrees}) AS BIGINT)"
+    return f"({_spread_bits_sql(cell_x)} | ({_spread_bits_sql(cell_y)} << 1))"
+
+
+def _spread_bits_sql(value_sql):
+    """Inserts a zero bit after each of the 16 low bits of a value."""
+    value_sql = f"(({value_sql}) & 65535)"
+    for shift, mask in [(8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)]:
+        value_sql = f"(({value_sql} | ({value_sql} << {shift})) & {mask})"
+    return value_sql
+
+
+def _spread_bits(value):
+    value &= 0xFFFF
+    for shift, mask in [(8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)]:
+        value = (value | (value << shift)) & mask
+    return value
+
+
+def get_cell_key(latitude, longitude, cell_size_degrees):
+    """Python twin of get_cell_key_sql."""
+    cell_x = math.floor((longitude + 180) / cell_size_degrees)
+    cell_y = math.floor((latitude + 90) / cell_size_degrees)
+    return _spread_bits(cell_x) | (_spread_bits(cell_y) << 1)
+
+
+def get_haversine_sql(latitude, longitude, latitude_column="latitude", longitude_column="longitude"):
+    return f"""(2 * {EARTH_RADIUS_KM} * asin(sqrt(
+        pow(sin(radians({latitude_column} - {latitude}) / 2), 2)
+        + cos(radians({latitude})) * cos(radians({latitude_column}))
+        * pow(sin(radians({longitude_column} - {longitude}) / 2), 2))))"""
+
+
+def get_bounding_box(latitude, longitude, radius_km):
+    """Latitude and longitude ranges that contain every point within radius_km. The longitude range is None
+    when the box reaches a pole or crosses the antimeridian, in which case longitude is not used to prune."""
+    latitude_delta = radius_km / KM_PER_DEGREE_OF_LATITUDE
+    min_latitude = max(latitude - latitude_delta, -90.0)
+    max_latitude = min(latitude + latitude_delta, 90.0)
+    widest_latitude = max(abs(min_latitude), abs(max_latitude))
+    if widest_latitude >= 90.0:
+        return (min_latitude, max_latitude), None
+    longitude_delta = latitude_delta / math.cos(math.radians(widest_latitude))
+    if longitude - longitude_delta < -180.0 or longitude + longitude_delta > 180.0:
+        return (min_latitude, max_latitude), None
+    return (min_latitude, max_latitude), (longitude - longitude_delta, longitude + longitude_delta)
+
+
+class BreweryGeoIndex:
+    """Radius and nearest-neighbour lookups over the geo artifact written by the gold stage.
+
+    Candidates are first pruned with the Z-order key range and the bounding box of the search circle, which
+    only reads the row groups that can hold a match. Exact haversine distances are computed on what is left.
+    Every lookup runs on its own cursor, so one index can be shared by threads.
+    """
+
+    def __init__(self, con, source, cell_size_degrees):
+        self.con = con
+        self.source = source
+        self.cell_size_degrees = cell_size_degrees
+
+    @classmethod
+    def from_parquet(cls, con, path, table_name=None):
+        """Reads the cell size from the file metadata. With table_name the file is loaded in memory first."""
+        metadata = con.execute(
+            "SELECT decode(value) FROM parquet_kv_metadata(?) WHERE decode(key) = ?", [path, CELL_SIZE_METADATA_KEY]
+        ).fetchone()
+        if metadata is None:
+            raise ValueError(f"{path} has no {CELL_SIZE_METADATA_KEY} metadata. Was it written by the gold stage?")
+        if table_name is None:
+            return cls(con, f"read_parquet('{path}')", float(metadata[0]))
+        con.sql(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM read_parquet('{path}') ORDER BY cell_key")
+        return cls(con, table_name, float(metadata[0]))
+
+    def _get_pruning_sql(self, latitude, longitude, radius_km):
+        (min_latitude, max_latitude), longitude_range = get_bounding_box(latitude, longitude, radius_km)
+        conditions = [f"latitude BETWEEN {min_latitude} AND {max_latitude}"]
+        if longitude_range is not None:
+            min_longitude, max_longitude = longitude_range
+            # Morton keys grow with both coordinates, so every cell of the box lies between its corner keys
+            min_key = get_cell_key(min_latitude, min_longitude, self.cell_size_degrees)
+            max_key = get_cell_key(max_latitude, max_longitude, self.cell_size_degrees)
+            conditions.append(f"cell_key BETWEEN {min_key} AND {max_key}")
+            conditions.append(f"longitude BETWEEN {min_longitude} AND {max_longitude}")
+        return " AND ".join(conditions)
+
+    def _fetch(self, sql):
+        cursor = self.con.cursor()
+        try:
+            result = cursor.execute(sql)
+            columns = [column[0] for column in result.description]
+            return [dict(zip(columns, row)) for row in result.fetchall()]
+        finally:
+            cursor.close()
+
+    def within_radius(self, latitude, longitude, radius_km, limit=None):
+        """Breweries within radius_km of a point, closest first, with their distance_km."""
+        return self._fetch(f"""
+            SELECT * FROM (
+                SELECT * EXCLUDE (cell_key), {get_haversine_sql(latitude, longitude)} AS distance_km
+                FROM {self.source}
+                WHERE {self._get_pruning_sql(latitude, longitude, radius_km)}
+            )
+            WHERE distance_km <= {radius_km}
+            ORDER BY distance_km, id
+            {f"LIMIT {int(limit)}" if limit is not None else ""}
+        """)
+
+    def nearest(self, latitude, longitude, k, initial_radius_km=10.0):
+        """The k closest breweries. The search radius doubles until it holds k matches, which are then exactly
+        the k nearest, since anything outside the circle is farther than everything inside it."""
+        radius_km = initial_radius_km
+        while True:
+            matches = self.within_radius(latitude, longitude, radius_km, limit=k)
+            if len(matches) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+                return matches
+            radius_km *= 2
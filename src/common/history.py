@@ -0,0 +1,118 @@
+"""Point-in-time queries over the silver history (SCD Type 2).
+
+Every silver run appends the versions it closes to silver/history/, partitioned by change date, and lists each
+file in silver/history/_manifest.json with the min/max of its valid_from and valid_to. A version was current
+from valid_from (included) to valid_to (excluded), valid_from being NULL when the start is unknown (rows inserted
+before silver recorded updated_at on insert). The open versions are the rows of silver/current_values.
+
+    con = duckdb.connect()
+    read_silver_as_of(con, get_storage(global_settings), global_settings, "2025-05-01 00:00:00")
+    con.sql("SELECT state, COUNT(*) FROM silver_as_of GROUP BY state")
+
+History only covers the changes made since it was first written.
+"""
+
+import os
+from datetime import datetime
+
+HISTORY_DIRECTORY = os.path.join("silver", "history")
+HISTORY_STATISTICS_COLUMNS = ["valid_from", "valid_to"]
+
+
+def parse_timestamp(value):
+    """Parses the timestamps DuckDB prints, whose fraction of second may have fewer than 6 digits."""
+    if isinstance(value, datetime):
+        return value
+    seconds, _, fraction = value.partition(".")
+    return datetime.fromisoformat(f"{seconds}.{fraction.ljust(6, '0')}" if fraction else seconds)
+
+
+def get_history_file_entry(copy_stats, history_root, run_timestamp):
+    """Manifest entry of one file written by COPY ... (PARTITION_BY (change_date), RETURN_STATS), from the row
+    COPY returned for it. The statistics come from the Parquet footer DuckDB just wrote, so nothing is read."""
+    filename, row_count, file_size_bytes, _, column_statistics, partition_keys = copy_stats
+    entry = {
+        "path": filename[len(history_root) :].lstrip("/"),
+        "change_date": partition_keys["change_date"],
+        "run_timestamp": run_timestamp,
+        "row_count": row_count,
+        "file_size_bytes": file_size_bytes,
+    }
+    for column in HISTORY_STATISTICS_COLUMNS:
+        statistics = column_statistics[f'"{column}"']
+        # Parquet statistics skip NULLs, so a file with a NULL valid_from has no lower bound
+        entry[f"min_{column}"] = None if int(statistics.get("null_count", 0)) else statistics.get("min")
+        entry[f"max_{column}"] = statistics.get("max")
+    return entry
+
+
+def get_committed_history_files(history_manifest, partition_manifest):
+    """Files of the history manifest written by silver runs that published their partition manifest.
+
+    The history manifest is saved just before the partition manifest, so a run that failed in between leaves
+    entries newer than the version of the partition manifest. They are ignored by readers and dropped by the
+    next silver run."""
+    if history_manifest is None:
+        return []
+    committed_version = (partition_manifest or {}).get("version")
+    if committed_version is None:
+        return []
+    return [entry for entry in history_manifest["files"] if entry["run_timestamp"] <= committed_version]
+
+
+def get_history_files_as_of(history_files, as_of):
+    """Prunes the history files to the ones that may hold a version current at as_of: a file whose versions all
+    started after as_of, or all ended at or before it, is skipped without being opened."""
+    as_of = parse_timestamp(as_of)
+    return [
+        entry
+        for entry in history_files
+        if (entry["min_valid_from"] is None or parse_timestamp(entry["min_valid_from"]) <= as_of)
+        and as_of < parse_timestamp(entry["max_valid_to"])
+    ]
+
+
+def read_silver_as_of(con, storage, global_settings, as_of, table_name="silver_as_of"):
+    """Creates table_name with the silver rows as they were at as_of: the closed versions of the history that
+    were current then, plus the current rows already active at as_of. Returns the number of history files read.
+
+    Rows get valid_from and valid_to, NULL for versions that are still current."""
+    as_of = parse_timestamp(as_of)
+    current_values_path = os.path.join("silver", "current_values")
+    partition_manifest = storage.read_json(
+        os.path.join(current_values_path, global_settings["silver_partition_manifest_file_name"])
+    )
+    history_manifest = storage.read_json(
+        os.path.join(HISTORY_DIRECTORY, global_settings["silver_history_manifest_file_name"])
+    )
+    if partition_manifest is None:
+        # current_values also holds the files a silver run in progress is replacing, so it is never globbed
+        raise FileNotFoundError("No silver partition manifest. Run silver first.")
+    history_files = get_history_files_as_of(get_committed_history_files(history_manifest, partition_manifest), as_of)
+
+    current_files = storage.get_read_paths(
+        storage.get_uri(os.path.join(current_values_path, path))
+        for partition in partition_manifest["partitions"].values()
+        for path in partition["files"]
+    )
+    queries = [
+        f"""
+        SELECT *, updated_at AS valid_from, NULL::TIMESTAMP AS valid_to
+        FROM read_parquet({current_files}, hive_partitioning = true, hive_types = {{'state': 'VARCHAR'}},
+                          union_by_name = true)
+        WHERE (updated_at IS NULL OR updated_at <= $as_of) AND deleted_at IS NULL
+        """
+    ]
+    if history_files:
+        history_paths = storage.get_read_paths(
+            storage.get_uri(os.path.join(HISTORY_DIRECTORY, entry["path"])) for entry in history_files
+        )
+        # The row group statistics of valid_from and valid_to prune inside the files that are read
+        queries.append(f"""
+            SELECT * EXCLUDE (change_date)
+            FROM read_parquet({history_paths}, hive_partitioning = true, hive_types = {{'change_date': 'DATE'}},
+                              union_by_name = true)
+            WHERE (valid_from IS NULL OR valid_from <= $as_of) AND valid_to > $as_of
+        """)
+    con.execute(f"CREATE OR REPLACE TABLE {table_name} AS {' UNION ALL BY NAME '.join(queries)}", {"as_of": as_of})
+    return len(history_files)
@@ -0,0 +1,221 @@
+"""Step timings, counts, latency histograms and DuckDB query profiles of a pipeline run.
+
+Every stage uses the process-wide `metrics` object, configured once at the start of the run. The metrics are
+saved as one JSON file per run under <layer>/<metrics_directory>/ (and optionally in the Prometheus text format)
+when the process exits, so failed runs and runs without changes are measured too.
+"""
+
+import atexit
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, the defaults of the Prometheus clients plus 30 and 60 seconds
+LATENCY_BUCKETS_SECONDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Summary of each DuckDB query profile kept in the metrics file. The full operator tree is only kept on request
+QUERY_PROFILE_SUMMARY_KEYS = [
+    "latency",
+    "cpu_time",
+    "rows_returned",
+    "cumulative_rows_scanned",
+    "cumulative_cardinality",
+    "system_peak_buffer_memory",
+    "system_peak_temp_dir_size",
+]
+
+
+class RunMetrics:
+    """Collects the metrics of one run. Every method is thread-safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active_steps = threading.local()
+        self.stage = None
+        self.settings = {}
+        self.storage = None
+        self.layer = None
+        self.run_timestamp = None
+        self.started_at = None
+        self.status = None
+        self.steps = []
+        self.counters = {}
+        self.values = {}
+        self.histograms = {}
+        self.query_profiles = []
+
+    def configure(self, stage, settings, storage, layer, run_timestamp):
+        """Starts the run. settings is the instrumentation section of project-settings.yaml. The metrics are
+        saved under the layer directory of storage (common.storage)."""
+        self.stage = stage
+        self.settings = settings or {}
+        self.storage = storage
+        self.layer = layer
+        self.run_timestamp = run_timestamp
+        self.started_at = datetime.now(timezone.utc)
+        self.status = "running"
+        atexit.register(self.save)
+
+    @contextmanager
+    def step(self, name):
+        """Times the block as a step. Steps started inside another step of the same thread are named
+        parent/child."""
+        stack = getattr(self.active_steps, "stack", [])
+        self.active_steps.stack = [*stack, name]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.active_steps.stack = stack
+            with self.lock:
+                self.steps.append({"name": "/".join([*stack, name]), "seconds": round(seconds, 6)})
+
+    def timed(self, function):
+        """Decorator timing every call of the function as a step named after it."""
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with self.step(function.__name__):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_value(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def record_copy_stats(self, copy_stats):
+        """Counts the files and bytes written by a COPY ... RETURN_STATS from the rows it returned."""
+        self.increment("storage_files_written", len(copy_stats))
+        self.increment("storage_bytes_written", sum(file_size_bytes for _, _, file_size_bytes, *_ in copy_stats))
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS_SECONDS):
+        """Adds a value to a histogram, counting it in the first bucket whose upper bound holds it."""
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                name, {"buckets": list(buckets), "counts": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+            )
+            bucket_index = next(
+                (index for index, bound in enumerate(histogram["buckets"]) if value <= bound), len(buckets)
+            )
+            histogram["counts"][bucket_index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def enable_query_profiling(self, con):
+        """Turns on the DuckDB profiler of a connection or cursor (settings are per session) when
+        profile_queries is set. Profiles are kept in memory and collected by record_query_profile."""
+        if not self.settings.get("profile_queries"):
+            return
+        con.sql("SET enable_profiling = 'no_output'")
+        con.sql("SET profiling_coverage = 'ALL'")
+
+    def record_query_profile(self, con, name):
+        """Records the profile of the last query of con, the one EXPLAIN ANALYZE would print, under name."""
+        if not self.settings.get("profile_queries"):
+            return
+        profile = json.loads(con.get_profiling_information(format="json"))
+        summary = {"name": name, **{key: profile.get(key) for key in QUERY_PROFILE_SUMMARY_KEYS}}
+        if self.settings.get("keep_query_plans"):
+            summary["plan"] = profile.get("children", [])
+        with self.lock:
+            self.query_profiles.append(summary)
+
+    def show_table(self, con, query, title=None):
+        """Prints the first rows of a query to the logs when show_tables is set. Off by default because it
+        scans the whole table."""
+        if not self.settings.get("show_tables"):
+            return
+        if title:
+            logger.info(title)
+        con.sql(query).show(max_rows=self.settings.get("show_tables_max_rows", 20))
+
+    def finish(self, status):
+        self.status = status
+
+    def to_dict(self):
+        with self.lock:
+            step_totals = {}
+            for step in self.steps:
+                step_totals[step["name"]] = round(step_totals.get(step["name"], 0.0) + step["seconds"], 6)
+            return {
+                "stage": self.stage,
+                "run_timestamp": self.run_timestamp,
+                # A run that never reached finish() failed or was interrupted
+                "status": "failed" if self.status == "running" else self.status,
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "duration_seconds": (
+                    round((datetime.now(timezone.utc) - self.started_at).total_seconds(), 3)
+                    if self.started_at
+                    else None
+                ),
+                "steps": list(self.steps),
+                "step_totals": step_totals,
+                "counters": dict(self.counters),
+                "values": dict(self.values),
+                "histograms": json.loads(json.dumps(self.histograms)),
+                "query_profiles": list(self.query_profiles),
+            }
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format, e.g. for the node exporter textfile collector."""
+        run = self.to_dict()
+        labels = f'stage="{run["stage"]}"'
+        lines = [
+            "# TYPE pipeline_run_duration_seconds gauge",
+            f"pipeline_run_duration_seconds{{{labels}}} {run['duration_seconds']}",
+        ]
+        lines.append("# TYPE pipeline_step_seconds gauge")
+        for step_name, seconds in run["step_totals"].items():
+            lines.append(f'pipeline_step_seconds{{{labels},step="{step_name}"}} {seconds}')
+        for name, value in run["counters"].items():
+            metric_name = f"pipeline_{_get_metric_name(name)}_total"
+            lines += [f"# TYPE {metric_name} counter", f"{metric_name}{{{labels}}} {value}"]
+        for name, value in run["values"].items():
+            if isinstance(value, (int, float)):
+                metric_name = f"pipeline_{_get_metric_name(name)}"
+                lines += [f"# TYPE {metric_name} gauge", f"{metric_name}{{{labels}}} {value}"]
+        for name, histogram in run["histograms"].items():
+            metric_name = f"pipeline_{_get_metric_name(name)}"
+            lines.append(f"# TYPE {metric_name} histogram")
+            cumulative_count = 0
+            for bound, count in zip([*histogram["buckets"], "+Inf"], histogram["counts"]):
+                cumulative_count += count
+                lines.append(f'{metric_name}_bucket{{{labels},le="{bound}"}} {cumulative_count}')
+            lines.append(f"{metric_name}_sum{{{labels}}} {histogram['sum']}")
+            lines.append(f"{metric_name}_count{{{labels}}} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        """Writes metrics_<run_timestamp>.json (and .prom) under the metrics directory of the layer."""
+        if self.storage is None:
+            return
+        metrics_directory = f"{self.layer}/{self.settings.get('metrics_directory', '_metrics')}"
+        try:
+            self.storage.write_json(f"{metrics_directory}/metrics_{self.run_timestamp}.json", self.to_dict())
+            if self.settings.get("prometheus_text_format"):
+                self.storage.write_text(f"{metrics_directory}/metrics_{self.run_timestamp}.prom", self.to_prometheus())
+            logger.info(f"Saved run metrics to {self.storage.get_uri(metrics_directory)}")
+        except (OSError, BotoCoreError, ClientError):
+            # Metrics must never change the outcome of the run
+            logger.exception(f"Could not save run metrics to {metrics_directory}")
+
+
+def _get_metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+metrics = RunMetrics()
@@ -0,0 +1,180 @@
+"""Data quality checks of the silver and gold stages.
+
+Checks are declared per table in the data_quality section of project-settings.yaml. Every check counts the rows
+that fail it, and all the checks of a table are evaluated in one aggregate query, so a table is scanned once
+whatever the number of checks. Gold aggregates are also reconciled with the by_state / by_type counts of the
+bronze metadata file (the /breweries/meta response).
+
+    results = run_table_checks(con, "silver_new_data", [{"type": "not_null", "columns": ["id", "name"]}])
+    summary = enforce_quality_results(storage, "silver", quality_settings, run_timestamp, results)
+
+A check passes when its failing rows are at most max_failing_fraction of the rows (0 by default). Failed checks
+with severity "error" (the default) fail the stage, "warn" ones are only logged.
+"""
+
+import logging
+import os
+
+from common.instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+# SQL counting the failing rows of every check type, formatted with the column and the keys of the check
+QUALITY_CHECKS = {
+    "not_null": "COUNT(*) FILTER (WHERE {column} IS NULL)",
+    # All the rows fail when the column only holds NULLs, none otherwise
+    "not_all_null": "CASE WHEN COUNT({column}) = 0 THEN COUNT(*) ELSE 0 END",
+    "unique": "COUNT({column}) - COUNT(DISTINCT {column})",
+    "accepted_values": "COUNT(*) FILTER (WHERE {column} NOT IN ({values}))",
+    "between": "COUNT(*) FILTER (WHERE {column} NOT BETWEEN {min} AND {max})",
+    "expression": "COUNT(*) FILTER (WHERE NOT ({expression}))",
+}
+
+
+def get_sql_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def get_check_columns(con, table_name, check):
+    """Columns a check applies to. columns "*" means every column of the table but the exclude_columns, and
+    expression checks have none."""
+    columns = check.get("columns", [check["column"]] if "column" in check else [None])
+    if columns == "*":
+        excluded_columns = set(check.get("exclude_columns", []))
+        return [row[0] for row in con.sql(f"DESCRIBE {table_name}").fetchall() if row[0] not in excluded_columns]
+    return columns
+
+
+def get_check_sql(check, column):
+    if check["type"] not in QUALITY_CHECKS:
+        raise ValueError(f"Unsupported quality check type: {check['type']}. Use one of {list(QUALITY_CHECKS)}.")
+    parameters = {**check, "column": column}
+    if "values" in check:
+        parameters["values"] = ", ".join(get_sql_literal(value) for value in check["values"])
+    return QUALITY_CHECKS[check["type"]].format(**parameters)
+
+
+def get_check_result(table_name, check, column, failing_rows, rows):
+    failing_fraction = failing_rows / rows if rows else 0
+    return {
+        "table": table_name,
+        "check": check.get("name") or "_".join(part for part in [check["type"], column] if part),
+        "column": column,
+        "severity": check.get("severity", "error"),
+        "rows": rows,
+        "failing_rows": failing_rows,
+        "passed": failing_fraction <= check.get("max_failing_fraction", 0),
+    }
+
+
+@metrics.timed
+def run_table_checks(con, table_name, checks):
+    """Evaluates the checks of a table in one aggregate query. Returns one result per check and column."""
+    checked_columns = [(check, column) for check in checks for column in get_check_columns(con, table_name, check)]
+    if not checked_columns:
+        return []
+    failing_rows = ", ".join(get_check_sql(check, column) for check, column in checked_columns)
+    rows, *failing_counts = con.sql(f"SELECT COUNT(*), {failing_rows} FROM {table_name}").fetchone()
+    metrics.record_query_profile(con, f"quality_checks_of_{table_name}")
+    return [
+        get_check_result(table_name, check, column, failing_count, rows)
+        for (check, column), failing_count in zip(checked_columns, failing_counts)
+    ]
+
+
+def get_group_key_sql(value_sql):
+    # The metadata keys may not be written like the values of the data (case, spaces or underscores)
+    return f"regexp_replace(lower({value_sql}), '[^a-z0-9]', '', 'g')"
+
+
+@metrics.timed
+def reconcile_with_bronze_metadata(con, bronze_metadata, reconciliations):
+    """Compares gold aggregates with the counts of the bronze metadata file, e.g. by_state with the total_count
+    of gold_data_location per state. A group fails when its count differs by more than tolerance_fraction of the
+    metadata count, groups missing on one side counting as 0. Returns one result per reconciliation, the rows
+    being the compared groups."""
+    results = []
+    for metadata_key, reconciliation in reconciliations.items():
+        check = {"name": f"reconcile_{metadata_key}", **reconciliation}
+        if not bronze_metadata.get(metadata_key):
+            logger.warning(f"The bronze metadata file has no {metadata_key} counts to reconcile with")
+            continue
+        expected_counts = [
+            {"group": group, "count": int(count)} for group, count in bronze_metadata[metadata_key].items()
+        ]
+        tolerance_fraction = reconciliation.get("tolerance_fraction", 0)
+        rows, failing_rows, mismatches = con.execute(
+            f"""
+            WITH expected AS (
+                SELECT {get_group_key_sql("e.group")} AS group_key, SUM(e.count) AS expected
+                FROM (SELECT unnest(?::STRUCT("group" VARCHAR, count BIGINT)[]) AS e)
+                GROUP BY ALL
+            ),
+            actual AS (
+                SELECT {get_group_key_sql(reconciliation["dimension"])} AS group_key,
+                    SUM({reconciliation["measure"]}) AS actual
+                FROM {reconciliation["table"]}
+                GROUP BY ALL
+            ),
+            compared AS (
+                SELECT COALESCE(e.group_key, a.group_key) AS group_key, COALESCE(expected, 0) AS expected,
+                    COALESCE(actual, 0) AS actual
+                FROM expected e
+                FULL OUTER JOIN actual a ON e.group_key IS NOT DISTINCT FROM a.group_key
+            )
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE abs(actual - expected) > expected * ?),
+                list({{'group': group_key, 'expected': expected, 'actual': actual}} ORDER BY group_key)
+                    FILTER (WHERE abs(actual - expected) > expected * ?)
+            FROM compared
+            """,
+            [expected_counts, tolerance_fraction, tolerance_fraction],
+        ).fetchone()
+        result = get_check_result(reconciliation["table"], check, reconciliation["dimension"], failing_rows, rows)
+        # A few groups are enough to investigate
+        result["mismatched_groups"] = (mismatches or [])[:20]
+        results.append(result)
+    return results
+
+
+def save_quality_results(storage, layer, quality_settings, run_timestamp, results):
+    """Writes the results as <layer>/<results_directory>/quality_<run timestamp>.json. Returns the path of the
+    file relative to the storage root."""
+    results_key = os.path.join(
+        layer, quality_settings.get("results_directory", "_quality"), f"quality_{run_timestamp}.json"
+    )
+    storage.write_json(
+        results_key,
+        {
+            "run_timestamp": run_timestamp,
+            "passed": all(result["passed"] for result in results if result["severity"] == "error"),
+            "results": results,
+        },
+    )
+    logger.info(f"Saved quality results to {storage.get_uri(results_key)}")
+    return results_key
+
+
+def enforce_quality_results(storage, layer, quality_settings, run_timestamp, results):
+    """Saves the results, logs the failed checks and raises ValueError if one of them has severity error, before
+    the stage publishes anything. Returns the summary recorded in the run manifest."""
+    failed_checks = [result for result in results if not result["passed"]]
+    summary = {
+        "results_path": save_quality_results(storage, layer, quality_settings, run_timestamp, results),
+        "checks": len(results),
+        "failed_errors": sum(result["severity"] == "error" for result in failed_checks),
+        "failed_warnings": sum(result["severity"] != "error" for result in failed_checks),
+    }
+    metrics.set_value("quality_checks", summary)
+    for result in failed_checks:
+        log = logger.error if result["severity"] == "error" else logger.warning
+        log(
+            f"Quality check {result['check']} of {result['table']} failed: {result['failing_rows']} of "
+            f"{result['rows']} rows"
+        )
+    failed_errors = [result["check"] for result in failed_checks if result["severity"] == "error"]
+    if failed_errors:
+        raise ValueError(f"Quality checks failed: {', '.join(failed_errors)}")
+    logger.info(f"{len(results)} quality checks evaluated, no error.")
+    return summary
@@ -0,0 +1,30 @@
+import hashlib
+import json
+import logging
+import sys
+
+from common.instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+# Exit code of a stage that found nothing to do. The DAG marks the task as skipped instead of failed.
+NO_CHANGES_EXIT_CODE = 99
+
+
+def get_fingerprint(value):
+    """sha256 of a JSON-serializable value, independent of key order."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_partition_manifest_fingerprint(partition_manifest):
+    """Fingerprint of the files a partition manifest lists. Silver records it as its output fingerprint and gold
+    as its input fingerprint, so gold can tell whether silver changed without reading any data file."""
+    if partition_manifest is None:
+        return None
+    return get_fingerprint(partition_manifest["partitions"])
+
+
+def exit_without_changes(message):
+    logger.info(f"{message} Exiting with code {NO_CHANGES_EXIT_CODE}.")
+    metrics.finish("no_changes")
+    sys.exit(NO_CHANGES_EXIT_CODE)
@@ -0,0 +1,256 @@
+"""Storage of the bronze/silver/gold layout, shared by every stage.
+
+OUTPUT_ENV picks the backend: "local" keeps the layout under local_data_path (a local directory or a mounted
+volume) and "s3" in the S3_BUCKET_NAME bucket, on AWS or on an S3-compatible server (MinIO, ...) set with
+storage.endpoint_url or AWS_ENDPOINT_URL. Paths given to the backends are relative to the root of the layout,
+e.g. "silver/current_values/_manifest.json". DuckDB reads and writes the URIs returned by get_uri, and
+configure_duckdb sets up its connections for the backend.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import boto3
+import botocore.config
+from boto3.s3.transfer import TransferConfig
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+class Storage:
+    kind = None
+
+    def get_uri(self, path):
+        """URI of a path of the layout, as DuckDB reads it."""
+        return f"{self.root}/{path}" if path else self.root
+
+    def get_output_uri(self, path, is_directory=False):
+        """URI DuckDB can write to. Local parent directories (or the directory itself) are created."""
+        return self.get_uri(path)
+
+    def read_json(self, path):
+        """Reads a JSON file, or returns None if it does not exist."""
+        text = self.read_text(path)
+        return None if text is None else json.loads(text)
+
+    def write_json(self, path, value):
+        self.write_text(path, json.dumps(value, indent=4), content_type="application/json")
+
+    def get_read_paths(self, uris):
+        """URIs DuckDB should read instead of uris. Only the S3 backend with a read-through cache changes them."""
+        return list(uris)
+
+    def configure_duckdb(self, con):
+        pass
+
+
+class LocalStorage(Storage):
+    kind = "local"
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def get_uri(self, path):
+        return os.path.join(self.root, path) if path else self.root
+
+    def get_output_uri(self, path, is_directory=False):
+        uri = self.get_uri(path)
+        os.makedirs(uri if is_directory else os.path.dirname(uri), exist_ok=True)
+        return uri
+
+    def read_text(self, path):
+        try:
+            with open(self.get_uri(path), "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_text(self, path, data, content_type="text/plain"):
+        # Written next to the target and renamed over it, so a reader never sees a partly written manifest
+        uri = self.get_output_uri(path)
+        temporary_uri = f"{uri}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_uri, "w") as f:
+                f.write(data)
+            os.replace(temporary_uri, uri)
+        except BaseException:
+            if os.path.exists(temporary_uri):
+                os.remove(temporary_uri)
+            raise
+
+    def upload_file(self, local_source_path, path):
+        """Moves a locally produced file into the layout."""
+        shutil.move(local_source_path, self.get_output_uri(path))
+
+    def copy(self, source_path, target_path):
+        shutil.copyfile(self.get_uri(source_path), self.get_output_uri(target_path))
+
+    def delete(self, paths):
+        for path in paths:
+            try:
+                os.remove(self.get_uri(path))
+            except FileNotFoundError:
+                continue
+            # Like S3, a directory whose files are all deleted is gone (partitions, state directories)
+            directory = os.path.dirname(self.get_uri(path))
+            if directory != self.root and not os.listdir(directory):
+                os.rmdir(directory)
+
+    def list_files(self, prefix):
+        """Paths of the files under a directory of the layout."""
+        directory = self.get_uri(prefix)
+        return [
+            os.path.relpath(os.path.join(root, file_name), self.root)
+            for root, _, file_names in os.walk(directory)
+            for file_name in file_names
+        ]
+
+
+class S3Storage(Storage):
+    """Layout in an S3 bucket. Downloads use parallel ranged GETs and, with storage.cache_directory set, S3
+    objects read by DuckDB go through a local read-through cache."""
+
+    kind = "s3"
+
+    def __init__(self, bucket, storage_settings, max_pool_connections=10):
+        self.bucket = bucket
+        self.root = f"s3://{bucket}"
+        self.settings = storage_settings
+        self.endpoint_url = (
+            storage_settings.get("endpoint_url")
+            or os.environ.get("AWS_ENDPOINT_URL_S3")
+            or os.environ.get("AWS_ENDPOINT_URL")
+        )
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=self.endpoint_url,
+            config=botocore.config.Config(max_pool_connections=max_pool_connections),
+        )
+        part_size_bytes = storage_settings.get("download_part_size_mb", 8) * 1024 * 1024
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size_bytes,
+            multipart_chunksize=part_size_bytes,
+            max_concurrency=storage_settings.get("download_max_concurrency", 8),
+        )
+        self.cache_directory = storage_settings.get("cache_directory")
+
+    def read_text(self, path):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=path)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read().decode("utf-8")
+
+    def write_text(self, path, data, content_type="text/plain"):
+        self.client.put_object(Bucket=self.bucket, Key=path, Body=data, ContentType=content_type)
+
+    def upload_file(self, local_source_path, path):
+        self.client.upload_file(local_source_path, self.bucket, path, Config=self.transfer_config)
+        os.remove(local_source_path)
+
+    def copy(self, source_path, target_path):
+        # Server-side copy: the body never leaves S3
+        self.client.copy_object(
+            Bucket=self.bucket, Key=target_path, CopySource={"Bucket": self.bucket, "Key": source_path}
+        )
+
+    def delete(self, paths):
+        paths = list(paths)
+        for batch_start in range(0, len(paths), 1000):  # delete_objects accepts at most 1000 keys
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": path} for path in paths[batch_start : batch_start + 1000]], "Quiet": True},
+            )
+
+    def list_files(self, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        return [
+            item["Key"]
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{prefix.rstrip('/')}/")
+            for item in page.get("Contents", [])
+        ]
+
+    def configure_duckdb(self, con):
+        """Applies the httpfs settings and, for an S3-compatible server, a secret pointing DuckDB at it.
+
+        httpfs settings are set globally and secrets are shared by the whole database, so both apply to
+        every cursor of the connection."""
+        for name, value in (self.settings.get("httpfs") or {}).items():
+            if value is not None:
+                con.execute(f"SET GLOBAL {name} = ?", [value])
+        if not self.endpoint_url:
+            return
+        endpoint = urlparse(self.endpoint_url)
+        options = {
+            "ENDPOINT": endpoint.netloc,
+            "URL_STYLE": self.settings.get("url_style") or "path",
+            "USE_SSL": str(endpoint.scheme == "https").lower(),
+            "REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+            "KEY_ID": os.environ.get("AWS_ACCESS_KEY_ID", ""),
+            "SECRET": os.environ.get("AWS_SECRET_ACCESS_KEY", ""),
+        }
+        secret_options = ", ".join(f"{key} '{value.replace(chr(39), chr(39) * 2)}'" for key, value in options.items())
+        con.sql(f"CREATE OR REPLACE SECRET s3_endpoint (TYPE s3, {secret_options})")
+        logger.info(f"DuckDB S3 requests go to {endpoint.netloc}")
+
+    def get_read_paths(self, uris):
+        """Local copies of the S3 objects behind uris when cache_directory is set.
+
+        Objects are cached under their ETag, so an object rewritten under the same key (such as the gold state
+        files) is downloaded again, and everything else is only checked with a HEAD request. Globs are left to
+        DuckDB."""
+        uris = list(uris)
+        if not self.cache_directory or not all(uri.startswith(f"{self.root}/") and "*" not in uri for uri in uris):
+            return uris
+        with ThreadPoolExecutor(max_workers=self.transfer_config.max_request_concurrency) as executor:
+            cached_paths = list(executor.map(self._get_cached_path, uris))
+        self._evict_cache(keep=set(cached_paths))
+        return cached_paths
+
+    def _get_cached_path(self, uri):
+        key = uri[len(self.root) + 1 :]
+        etag = self.client.head_object(Bucket=self.bucket, Key=key)["ETag"].strip('"')
+        # The key is kept at the end of the path, so hive partitions and file extensions still apply
+        cached_path = os.path.join(self.cache_directory, self.bucket, etag, key)
+        if os.path.exists(cached_path):
+            os.utime(cached_path)
+            return cached_path
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        self.client.download_file(self.bucket, key, f"{cached_path}.part", Config=self.transfer_config)
+        os.replace(f"{cached_path}.part", cached_path)
+        return cached_path
+
+    def _evict_cache(self, keep):
+        """Deletes the least recently used files above cache_max_size_gb, except the ones in keep."""
+        max_size_bytes = self.settings.get("cache_max_size_gb", 10) * 1024**3
+        cached_files = [
+            os.path.join(root, file_name)
+            for root, _, file_names in os.walk(os.path.join(self.cache_directory, self.bucket))
+            for file_name in file_names
+        ]
+        sizes = {path: os.path.getsize(path) for path in cached_files}
+        cache_size = sum(sizes.values())
+        for path in sorted(cached_files, key=os.path.getmtime):
+            if cache_size <= max_size_bytes:
+                break
+            if path not in keep:
+                os.remove(path)
+                cache_size -= sizes[path]
+
+
+def get_storage(global_settings, max_pool_connections=10):
+    """Storage backend selected by OUTPUT_ENV, configured by the storage section of project-settings.yaml."""
+    output_env = os.environ["OUTPUT_ENV"]
+    if output_env == "local":
+        # Relative to the project root. An absolute local_data_path (a mounted volume) is used as is
+        return LocalStorage(os.path.join(PROJECT_ROOT, global_settings.get("local_data_path", "data")))
+    if output_env == "s3":
+        return S3Storage(os.environ["S3_BUCKET_NAME"], global_settings.get("storage") or {}, max_pool_connections)
+    raise ValueError(f"Unknown OUTPUT_ENV: {output_env}. Use 'local' or 's3'.")
@@ -1,76 +1,480 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-import duckdb
+import yaml
 from dotenv import load_dotenv
 
+from common.duckdb_connection import get_duckdb_connection, sync_table_with_partition_manifest
+from common.geo import CELL_SIZE_METADATA_KEY, get_cell_key_sql
+from common.instrumentation import metrics
+from common.quality import enforce_quality_results, reconcile_with_bronze_metadata, run_table_checks
+from common.run_manifest import exit_without_changes, get_fingerprint, get_partition_manifest_fingerprint
+from common.storage import get_storage
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def read_silver_layer(silver_files_path):
-    logging.info(f"Reading silver layer from: {silver_files_path}")
-    duckdb.sql(f"""
-            CREATE TABLE silver_data AS
-            SELECT * FROM read_parquet('{silver_files_path}', hive_partitioning = true); 
-        """)
-    logging.info("Silver layer data loaded successfully")
-
-
-def create_gold_tables():
-    logging.info("Creating gold_data_location table")
-    duckdb.sql("""
-            CREATE TABLE gold_data_location AS
-            SELECT 
-                --country,
-                state,
-                --city,
-                COUNT(*) AS total_count
-            FROM silver_data
-               WHERE deleted_at IS NULL
-            --GROUP BY country, state, city;
-            GROUP BY state;
-        """)
-    logging.info("Table gold_data_location created successfully")
-
-    logging.info("Creating gold_data_brewery_type table")
-    duckdb.sql("""
-            CREATE TABLE gold_data_brewery_type AS
-            SELECT 
-                brewery_type,
-                COUNT(*) AS total_count
-            FROM silver_data
-               WHERE deleted_at IS NULL
-            GROUP BY brewery_type;
+def load_all_settings():
+    """Loads all necessary configuration files."""
+    gold_settings_path = os.path.join(os.path.dirname(__file__), "settings.yaml")
+    with open(gold_settings_path, "r") as f:
+        gold_s = yaml.safe_load(f)
+
+    global_settings_path = os.path.join(os.path.dirname(__file__), "..", "config", "project-settings.yaml")
+    with open(global_settings_path, "r") as f:
+        global_s = yaml.safe_load(f)
+
+    return gold_s, global_s
+
+
+def get_silver_partition_manifest(storage, global_settings):
+    """Reads the partition manifest listing the live silver files, written by the silver stage.
+
+    Raises FileNotFoundError when there is none: current_values also holds the files a silver run in progress
+    is replacing, so it is never read with a glob.
+    """
+    manifest_key = os.path.join("silver", "current_values", global_settings["silver_partition_manifest_file_name"])
+    partition_manifest = storage.read_json(manifest_key)
+    if partition_manifest is None:
+        raise FileNotFoundError(f"No silver partition manifest at {storage.get_uri(manifest_key)}. Run silver first.")
+    return partition_manifest
+
+
+def get_last_run_metadata(storage, global_settings, layer):
+    """Reads the run manifest of a layer, or None if it was never written."""
+    return storage.read_json(os.path.join(layer, global_settings[f"last_run_metadata_{layer}_path"]))
+
+
+def get_bronze_metadata(storage, global_settings, last_silver_run_metadata):
+    """Reads the /breweries/meta response saved by the bronze run the last silver run read, or None."""
+    bronze_run_directory = last_silver_run_metadata.get("bronze_run_directory")
+    if not bronze_run_directory:
+        return None
+    return storage.read_json(os.path.join("bronze", bronze_run_directory, global_settings["metadata_file_name"]))
+
+
+def save_last_gold_run_metadata(storage, global_settings, metadata):
+    path = os.path.join("gold", global_settings["last_run_metadata_gold_path"])
+    storage.write_json(path, metadata)
+    logger.info(f"Saved last gold run metadata to {storage.get_uri(path)}")
+
+
+def get_row_counts(con, table_names):
+    row_counts = {table_name: con.sql(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0] for table_name in table_names}
+    for table_name, row_count in row_counts.items():
+        metrics.set_value(f"rows_{table_name}", row_count)
+    return row_counts
+
+
+@metrics.timed
+def read_silver_layer(con, storage, partition_manifest, silver_root_path):
+    read_options = "hive_partitioning = true, hive_types = {'state': 'VARCHAR'}, union_by_name = true"
+    # On a persistent working database only the partitions changed by the last silver run are read again
+    sync_table_with_partition_manifest(
+        con, "silver_data", partition_manifest, silver_root_path, read_options, storage=storage
+    )
+    logger.info("Silver layer data loaded successfully")
+
+
+def get_measure_sql(measure, signed):
+    """SQL of a measure over silver rows, or its delta over change set rows when signed."""
+    if measure["function"] == "count":
+        return "SUM(__sign)" if signed else "COUNT(*)"
+    if measure["function"] == "sum":
+        return f"SUM(__sign * {measure['column']})" if signed else f"SUM({measure['column']})"
+    raise ValueError(f"Unsupported gold measure function: {measure['function']}. Use count or sum.")
+
+
+def get_measure_cast(measure):
+    # Counts stay BIGINT whether they come from COUNT(*) or from summed deltas
+    return "::BIGINT" if measure["function"] == "count" else ""
+
+
+@metrics.timed
+def compute_gold_aggregates(con, source_table, aggregates, signed=False, table_suffix=""):
+    """Computes every declared aggregate in a single scan of source_table with GROUPING SETS.
+
+    Each aggregate gets its own measure columns, filtered with FILTER (WHERE ...), plus a hidden __row_count
+    used to drop groups with no rows, as a plain GROUP BY with a WHERE clause would. Results are split into
+    one <table_name>__state table per aggregate. With signed=True the source is the silver change set and the
+    results are deltas.
+    """
+    all_dimensions = list(dict.fromkeys(dim for aggregate in aggregates.values() for dim in aggregate["dimensions"]))
+    grouping_sets = list(dict.fromkeys(f"({', '.join(aggregate['dimensions'])})" for aggregate in aggregates.values()))
+    measure_columns = []
+    for aggregate_name, aggregate in aggregates.items():
+        filter_sql = f"FILTER (WHERE {aggregate.get('filter') or 'true'})"
+        row_count = "SUM(__sign)" if signed else "COUNT(*)"
+        measure_columns.append(f'{row_count} {filter_sql} AS "{aggregate_name}__row_count"')
+        for measure in aggregate["measures"]:
+            measure_columns.append(
+                f'{get_measure_sql(measure, signed)} {filter_sql} AS "{aggregate_name}__{measure["name"]}"'
+            )
+
+    logger.info(f"Computing {len(aggregates)} gold aggregates in one scan of {source_table}")
+    con.sql(f"""
+        CREATE OR REPLACE TABLE gold_grouping_sets AS
+        SELECT {", ".join(all_dimensions)},
+            GROUPING({", ".join(all_dimensions)}) AS __grouping_id,
+            {", ".join(measure_columns)}
+        FROM {source_table}
+        GROUP BY GROUPING SETS ({", ".join(grouping_sets)});
+    """)
+    metrics.record_query_profile(con, f"grouping_sets_of_{source_table}")
+
+    for aggregate_name, aggregate in aggregates.items():
+        # GROUPING() sets the bit of every dimension that is not grouped, the first dimension being the highest bit
+        grouping_id = sum(
+            1 << (len(all_dimensions) - 1 - position)
+            for position, dim in enumerate(all_dimensions)
+            if dim not in aggregate["dimensions"]
+        )
+        measures = ", ".join(
+            f'"{aggregate_name}__{measure["name"]}"{get_measure_cast(measure)} AS {measure["name"]}'
+            for measure in aggregate["measures"]
+        )
+        con.sql(f"""
+            CREATE OR REPLACE TABLE {aggregate["table_name"]}__state{table_suffix} AS
+            SELECT {", ".join(aggregate["dimensions"])}, {measures},
+                "{aggregate_name}__row_count"::BIGINT AS __row_count
+            FROM gold_grouping_sets
+            WHERE __grouping_id = {grouping_id}
+            {"" if signed else f'AND "{aggregate_name}__row_count" > 0'};
         """)
-    logging.info("Table gold_data_brewery_type created successfully")
 
-    duckdb.sql("SELECT * FROM gold_data_location order by state").show()
-    duckdb.sql("SELECT * FROM gold_data_brewery_type order by brewery_type").show()
+
+@metrics.timed
+def create_gold_tables(con, aggregates):
+    compute_gold_aggregates(con, "silver_data", aggregates)
+    publish_gold_tables(con, aggregates)
 
 
-def export_gold_tables(gold_files_path):
-    logging.info(f"Exporting gold tables to: {gold_files_path}")
-    duckdb.sql(f"""
-            COPY (SELECT * FROM gold_data_location) TO '{gold_files_path}/location.parquet' (FORMAT PARQUET);
+@metrics.timed
+def publish_gold_tables(con, aggregates):
+    """The published tables are the aggregate states without their hidden row count."""
+    for aggregate in aggregates.values():
+        con.sql(f"""
+            CREATE OR REPLACE TABLE {aggregate["table_name"]} AS
+            SELECT * EXCLUDE (__row_count) FROM {aggregate["table_name"]}__state;
         """)
-    duckdb.sql(f"""
-            COPY (SELECT * FROM gold_data_brewery_type) TO '{gold_files_path}/brewery_type.parquet' (FORMAT PARQUET);
+        logger.info(f"Table {aggregate['table_name']} created successfully")
+        metrics.show_table(
+            con, f"SELECT * FROM {aggregate['table_name']} ORDER BY {', '.join(aggregate['dimensions'])}"
+        )
+
+
+def is_gold_up_to_date(last_gold_run_metadata, silver_fingerprint, definitions_fingerprint):
+    """True when the last gold run read the same silver files (same partition manifest) with the same aggregate
+    and geo index definitions, so this run would write the same files."""
+    return bool(last_gold_run_metadata) and (
+        last_gold_run_metadata.get("input_fingerprint") == silver_fingerprint
+        and last_gold_run_metadata.get("definitions_fingerprint") == definitions_fingerprint
+    )
+
+
+def get_change_set_problem(
+    last_gold_run_metadata, last_silver_run_metadata, silver_fingerprint, definitions_fingerprint, gold_settings
+):
+    """Returns why the silver change set cannot be applied to the last gold aggregates, or None if it can.
+
+    The change set is a delta between two silver states, so it only applies when the silver run that wrote it
+    started from the silver files gold consumed last, and ended on the files silver lists now.
+    """
+    if not last_gold_run_metadata:
+        return "no previous gold run"
+    if not last_gold_run_metadata.get("state_path"):
+        return "the last gold run recorded no state path"
+    if last_gold_run_metadata.get("definitions_fingerprint") != definitions_fingerprint:
+        return "the gold definitions changed since the last gold run"
+    if not last_silver_run_metadata.get("change_set_path"):
+        return "the last silver run wrote no change set"
+    if last_silver_run_metadata.get("input_fingerprint") != last_gold_run_metadata.get("input_fingerprint"):
+        return "silver changed more than once since the last gold run"
+    if last_silver_run_metadata.get("output_fingerprint") != silver_fingerprint:
+        return "the silver change set does not match the current silver files"
+    if last_gold_run_metadata.get("runs_since_full_recompute", 0) + 1 >= gold_settings["full_recompute_every_n_runs"]:
+        return "periodic full recompute"
+    return None
+
+
+@metrics.timed
+def apply_silver_change_set(con, storage, change_set_path, previous_state_path, aggregates, table_suffix=""):
+    """Builds the aggregate states from the states of the last gold run, read from the state_path its run
+    manifest points to, plus the deltas of the silver change set, without reading silver. Groups whose row count
+    reaches zero are dropped, as a full recompute would."""
+    change_set_files = storage.get_read_paths([change_set_path])
+    con.sql(f"CREATE OR REPLACE TABLE silver_change_set AS SELECT * FROM read_parquet({change_set_files})")
+    logger.info(f"Applying {con.sql('SELECT COUNT(*) FROM silver_change_set').fetchone()[0]} change set rows")
+    compute_gold_aggregates(con, "silver_change_set", aggregates, signed=True, table_suffix="__delta")
+    for aggregate in aggregates.values():
+        dimensions = ", ".join(aggregate["dimensions"])
+        state_files = storage.get_read_paths([f"{previous_state_path}/{aggregate['file_name']}"])
+        measures = ", ".join(
+            f"SUM({measure['name']}){get_measure_cast(measure)} AS {measure['name']}"
+            for measure in aggregate["measures"]
+        )
+        con.sql(f"""
+            CREATE OR REPLACE TABLE {aggregate["table_name"]}__state{table_suffix} AS
+            SELECT {dimensions}, {measures}, SUM(__row_count)::BIGINT AS __row_count
+            FROM (
+                SELECT * FROM read_parquet({state_files})
+                UNION ALL BY NAME
+                SELECT * FROM {aggregate["table_name"]}__state__delta
+            )
+            GROUP BY {dimensions}
+            HAVING SUM(__row_count) <> 0;
         """)
+
+
+@metrics.timed
+def validate_incremental_gold_tables(con, aggregates):
+    """A negative row count means the change set removed rows the last aggregates never counted."""
+    for aggregate in aggregates.values():
+        negative_groups = con.sql(
+            f"SELECT COUNT(*) FROM {aggregate['table_name']}__state WHERE __row_count < 0"
+        ).fetchone()[0]
+        if negative_groups:
+            raise ValueError(
+                f"{negative_groups} groups of {aggregate['table_name']} have a negative count after the change set"
+            )
+
+
+@metrics.timed
+def count_mismatches_with_incremental_tables(con, aggregates):
+    """Compares the fully recomputed aggregates with the ones the change set would have produced."""
+    mismatches = {}
+    for aggregate in aggregates.values():
+        table_name = aggregate["table_name"]
+        join_condition = " AND ".join(f"f.{dim} IS NOT DISTINCT FROM i.{dim}" for dim in aggregate["dimensions"])
+        differences = " OR ".join(
+            f"ROUND(f.{column}, 6) IS DISTINCT FROM ROUND(i.{column}, 6)"
+            for column in [*(measure["name"] for measure in aggregate["measures"]), "__row_count"]
+        )
+        mismatches[table_name] = con.sql(f"""
+            SELECT COUNT(*)
+            FROM {table_name}__state f
+            FULL OUTER JOIN {table_name}__state_incremental i ON {join_condition}
+            WHERE {differences}
+        """).fetchone()[0]
+        if mismatches[table_name]:
+            logger.warning(f"{mismatches[table_name]} groups of {table_name} differ from the incremental result")
+    return mismatches
+
+
+def get_geo_index_rows_sql(source_table, geo_index_settings, row_filter):
+    """Active breweries with valid coordinates and the Z-order key of their grid cell."""
+    cell_key = get_cell_key_sql("latitude", "longitude", geo_index_settings["cell_size_degrees"])
+    return f"""
+        SELECT {", ".join(geo_index_settings["columns"])}, {cell_key} AS cell_key
+        FROM {source_table}
+        WHERE latitude BETWEEN -90 AND 90
+            AND longitude BETWEEN -180 AND 180
+            AND {row_filter}
+    """
+
+
+@metrics.timed
+def create_geo_index_table(con, geo_index_settings):
+    con.sql(f"""
+        CREATE OR REPLACE TABLE gold_brewery_geo AS
+        {get_geo_index_rows_sql("silver_data", geo_index_settings, "deleted_at IS NULL")};
+    """)
+    metrics.record_query_profile(con, "create_geo_index")
+    logger.info("Table gold_brewery_geo created successfully")
+
+
+@metrics.timed
+def apply_change_set_to_geo_index(con, storage, geo_index_settings, previous_state_path):
+    """Drops every brewery of the change set from the geo index of the last gold run (its copy under the state
+    path) and adds back their new active versions (__sign = 1). Soft-deleted breweries only have a -1 row, so
+    they are not added back."""
+    geo_index_files = storage.get_read_paths([f"{previous_state_path}/{geo_index_settings['file_name']}"])
+    con.sql(f"""
+        CREATE OR REPLACE TABLE gold_brewery_geo AS
+        SELECT g.*
+        FROM read_parquet({geo_index_files}) g
+        ANTI JOIN silver_change_set c ON g.id = c.id
+        UNION ALL BY NAME
+        {get_geo_index_rows_sql("silver_change_set", geo_index_settings, "__sign = 1")};
+    """)
+    metrics.record_query_profile(con, "update_geo_index")
+    logger.info("Table gold_brewery_geo updated from the silver change set")
+
+
+def get_gold_exports(aggregates, geo_index_settings, gold_files_path, gold_state_path):
+    """COPY statements of every gold artifact, by name. gold_state_path is the state directory of this run: the
+    next incremental run starts from it once the run manifest points to it."""
+    exports = {}
+    for aggregate in aggregates.values():
+        exports[f"export_{aggregate['table_name']}"] = f"""
+            COPY (SELECT * FROM {aggregate["table_name"]})
+            TO '{gold_files_path}/{aggregate["file_name"]}' (FORMAT PARQUET, RETURN_STATS);
+        """
+        exports[f"export_{aggregate['table_name']}__state"] = f"""
+            COPY (SELECT * FROM {aggregate["table_name"]}__state)
+            TO '{gold_state_path}/{aggregate["file_name"]}' (FORMAT PARQUET, RETURN_STATS);
+        """
+    if geo_index_settings["enabled"]:
+        # Sorted by cell key in small row groups, so a lookup only reads the row groups around its search area.
+        # The cell size travels with the file, which is all common.geo needs to query it
+        exports["export_gold_brewery_geo"] = f"""
+            COPY (SELECT * FROM gold_brewery_geo ORDER BY cell_key, id)
+            TO '{gold_files_path}/{geo_index_settings["file_name"]}'
+            (FORMAT PARQUET, ROW_GROUP_SIZE {geo_index_settings["row_group_size"]},
+             KV_METADATA {{{CELL_SIZE_METADATA_KEY}: '{geo_index_settings["cell_size_degrees"]}'}}, RETURN_STATS);
+        """
+        # The published file may be newer than the state of the last successful run, so the next incremental
+        # run starts from this copy
+        exports["export_gold_brewery_geo__state"] = f"""
+            COPY (SELECT * FROM gold_brewery_geo)
+            TO '{gold_state_path}/{geo_index_settings["file_name"]}' (FORMAT PARQUET, RETURN_STATS);
+        """
+    return exports
+
+
+def delete_previous_gold_states(storage, state_directory, state_key):
+    """Deletes the state directories of earlier runs, including the ones of failed runs no run manifest points
+    to. Only called once the run manifest points to state_key."""
+    stale_files = [path for path in storage.list_files(state_directory) if not path.startswith(f"{state_key}/")]
+    if stale_files:
+        storage.delete(stale_files)
+        logger.info(f"Deleted {len(stale_files)} gold state files of earlier runs")
+
+
+@metrics.timed
+def check_gold_quality(con, storage, quality_settings, bronze_metadata, run_timestamp):
+    """Runs the quality checks of the gold tables and reconciles them with the bronze metadata. Raises ValueError
+    before anything is exported if a check with severity error fails."""
+    results = [
+        result
+        for table_name, checks in (quality_settings.get("gold") or {}).items()
+        for result in run_table_checks(con, table_name, checks)
+    ]
+    if bronze_metadata is None:
+        logger.warning("No bronze metadata file found. Gold is not reconciled with it.")
+    else:
+        results.extend(
+            reconcile_with_bronze_metadata(con, bronze_metadata, quality_settings.get("reconciliation") or {})
+        )
+    return enforce_quality_results(storage, "gold", quality_settings, run_timestamp, results)
+
+
+@metrics.timed
+def export_gold_tables(con, exports, gold_files_path, max_workers):
+    """Runs the gold exports in parallel, each COPY on its own cursor."""
+    logger.info(f"Exporting gold tables to: {gold_files_path}")
+
+    def export(export_name, copy_sql):
+        cursor = con.cursor()
+        try:
+            metrics.enable_query_profiling(cursor)
+            # Pool threads do not share the step stack of export_gold_tables
+            with metrics.step(f"export_gold_tables/{export_name}"):
+                metrics.record_copy_stats(cursor.sql(copy_sql).fetchall())
+            metrics.record_query_profile(cursor, export_name)
+        finally:
+            cursor.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(export, export_name, copy_sql) for export_name, copy_sql in exports.items()]
+        for future in futures:
+            future.result()
     logger.info("Gold tables created and exported successfully.")
 
 
 def run_gold_pipeline():
-    silver_files_path = os.path.join(
-        "s3://", os.environ["S3_BUCKET_NAME"], "silver", "current_values", "*", "*.parquet"
+    gold_settings, global_settings = load_all_settings()
+    aggregates = gold_settings["aggregates"]
+    geo_index_settings = gold_settings["geo_index"]
+    storage = get_storage(global_settings)
+    silver_root_path = storage.get_uri(os.path.join("silver", "current_values"))
+    gold_files_path = storage.get_output_uri("gold", is_directory=True)
+    definitions_fingerprint = get_fingerprint([aggregates, geo_index_settings])
+
+    run_timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    metrics.configure("gold", global_settings.get("instrumentation"), storage, "gold", run_timestamp)
+    # Every run writes its states to its own directory, so a failed run never changes the states the next
+    # incremental run starts from, which are the ones the last run manifest points to
+    state_directory = os.path.join("gold", gold_settings["state_directory"])
+    state_key = os.path.join(state_directory, run_timestamp)
+    gold_state_path = storage.get_output_uri(state_key, is_directory=True)
+
+    partition_manifest = get_silver_partition_manifest(storage, global_settings)
+    silver_fingerprint = get_partition_manifest_fingerprint(partition_manifest)
+    last_gold_run_metadata = get_last_run_metadata(storage, global_settings, "gold")
+    if is_gold_up_to_date(last_gold_run_metadata, silver_fingerprint, definitions_fingerprint):
+        exit_without_changes("Silver files and gold definitions unchanged since the last gold run.")
+    last_silver_run_metadata = get_last_run_metadata(storage, global_settings, "silver") or {}
+    change_set_problem = get_change_set_problem(
+        last_gold_run_metadata, last_silver_run_metadata, silver_fingerprint, definitions_fingerprint, gold_settings
     )
-    gold_files_path = os.path.join("s3://", os.environ["S3_BUCKET_NAME"], "gold")
+    change_set_path = previous_state_path = None
+    if last_silver_run_metadata.get("change_set_path"):
+        change_set_path = storage.get_uri(last_silver_run_metadata["change_set_path"])
+    if (last_gold_run_metadata or {}).get("state_path"):
+        previous_state_path = storage.get_uri(last_gold_run_metadata["state_path"])
 
-    read_silver_layer(silver_files_path)
-    create_gold_tables()
-    export_gold_tables(gold_files_path)
+    con = get_duckdb_connection(global_settings, "gold", storage)
+    gold_run_metadata = {
+        "run_timestamp": run_timestamp,
+        "silver_run_timestamp": last_silver_run_metadata.get("run_timestamp"),
+        "input_fingerprint": silver_fingerprint,
+        "definitions_fingerprint": definitions_fingerprint,
+        "change_count": last_silver_run_metadata.get("change_count"),
+        "state_path": state_key,
+    }
+    if change_set_problem is None:
+        logger.info("Updating gold tables from the silver change set")
+        apply_silver_change_set(con, storage, change_set_path, previous_state_path, aggregates)
+        validate_incremental_gold_tables(con, aggregates)
+        publish_gold_tables(con, aggregates)
+        if geo_index_settings["enabled"]:
+            apply_change_set_to_geo_index(con, storage, geo_index_settings, previous_state_path)
+        gold_run_metadata["mode"] = "incremental"
+        gold_run_metadata["runs_since_full_recompute"] = last_gold_run_metadata.get("runs_since_full_recompute", 0) + 1
+        row_count_tables = [aggregate["table_name"] for aggregate in aggregates.values()]
+    else:
+        logger.info(f"Recomputing gold tables from the whole silver layer: {change_set_problem}")
+        read_silver_layer(con, storage, partition_manifest, silver_root_path)
+        create_gold_tables(con, aggregates)
+        if geo_index_settings["enabled"]:
+            create_geo_index_table(con, geo_index_settings)
+        gold_run_metadata["mode"] = "full"
+        gold_run_metadata["runs_since_full_recompute"] = 0
+        if change_set_problem == "periodic full recompute":
+            # The full recompute doubles as a check of the incremental path
+            apply_silver_change_set(
+                con, storage, change_set_path, previous_state_path, aggregates, table_suffix="_incremental"
+            )
+            gold_run_metadata["incremental_mismatches"] = count_mismatches_with_incremental_tables(con, aggregates)
+        row_count_tables = ["silver_data", *(aggregate["table_name"] for aggregate in aggregates.values())]
+    if geo_index_settings["enabled"]:
+        row_count_tables.append("gold_brewery_geo")
+    quality_settings = global_settings.get("data_quality") or {}
+    if quality_settings.get("enabled"):
+        gold_run_metadata["quality"] = check_gold_quality(
+            con,
+            storage,
+            quality_settings,
+            get_bronze_metadata(storage, global_settings, last_silver_run_metadata),
+            run_timestamp,
+        )
+    export_gold_tables(
+        con,
+        get_gold_exports(aggregates, geo_index_settings, gold_files_path, gold_state_path),
+        gold_files_path,
+        gold_settings["export_max_workers"],
+    )
+    gold_run_metadata["row_counts"] = get_row_counts(con, row_count_tables)
+    save_last_gold_run_metadata(storage, global_settings, gold_run_metadata)
+    delete_previous_gold_states(storage, state_directory, state_key)
+    con.close()
+    metrics.finish("succeeded")
 
 
 if __name__ == "__main__":
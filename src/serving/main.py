@@ -0,0 +1,407 @@
+import contextlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import duckdb
+import yaml
+from botocore.exceptions import BotoCoreError, ClientError
+from dotenv import load_dotenv
+
+from common.duckdb_connection import get_duckdb_connection
+from common.geo import BreweryGeoIndex
+from common.storage import get_storage
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def load_all_settings():
+    """Loads all necessary configuration files. The gold settings tell which aggregates gold exports."""
+    serving_settings_path = os.path.join(os.path.dirname(__file__), "settings.yaml")
+    with open(serving_settings_path, "r") as f:
+        serving_s = yaml.safe_load(f)
+
+    gold_settings_path = os.path.join(os.path.dirname(__file__), "..", "gold", "settings.yaml")
+    with open(gold_settings_path, "r") as f:
+        gold_s = yaml.safe_load(f)
+
+    global_settings_path = os.path.join(os.path.dirname(__file__), "..", "config", "project-settings.yaml")
+    with open(global_settings_path, "r") as f:
+        global_s = yaml.safe_load(f)
+
+    return serving_s, gold_s, global_s
+
+
+class ResultCache:
+    """LRU cache of serialized responses whose entries also expire after ttl_seconds."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class ServingSnapshot:
+    """One loaded version of the served data. Requests keep a reference to the snapshot they started on, so a
+    reload never changes the data under a running query."""
+
+    def __init__(self, con, version, database_path, aggregate_tables, geo_index):
+        self.con = con
+        self.version = version
+        self.database_path = database_path
+        self.aggregate_tables = aggregate_tables
+        self.geo_index = geo_index
+        # Requests running on the snapshot, and whether a newer one replaced it. Both are guarded by the lock of
+        # the store, which closes a replaced snapshot once its last request finishes
+        self.active_requests = 0
+        self.replaced = False
+
+    def query(self, sql, params=None):
+        cursor = self.con.cursor()
+        try:
+            result = cursor.execute(sql, params or [])
+            columns = [column[0] for column in result.description]
+            return [dict(zip(columns, row)) for row in result.fetchall()]
+        finally:
+            cursor.close()
+
+    def close(self):
+        """Closes the connection and deletes its database file, with the write-ahead log DuckDB keeps next to it."""
+        self.con.close()
+        if self.database_path:
+            for path in (self.database_path, f"{self.database_path}.wal"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+
+class ServingStore:
+    """Loads the gold tables and the active silver rows into DuckDB and swaps in a new snapshot whenever the
+    gold run manifest reports a new run."""
+
+    def __init__(self, serving_settings, gold_settings, global_settings):
+        self.serving_settings = serving_settings
+        self.gold_settings = gold_settings
+        self.global_settings = global_settings
+        # The bronze/silver/gold layout: the local data directory with OUTPUT_ENV=local, else the bucket
+        self.storage = get_storage(global_settings)
+        self.snapshot = None
+        self.reload_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.on_reload = []
+
+    def get_data_version(self):
+        """Version of the data gold last published, from its run manifest. None before the first gold run."""
+        gold_run_metadata = self.storage.read_json(
+            os.path.join("gold", self.global_settings["last_run_metadata_gold_path"])
+        )
+        if gold_run_metadata is None:
+            return None
+        return f"{gold_run_metadata['run_timestamp']}-{(gold_run_metadata.get('input_fingerprint') or '')[:12]}"
+
+    def get_silver_files_to_read(self):
+        silver_root = self.storage.get_uri(os.path.join("silver", "current_values"))
+        partition_manifest = self.storage.read_json(
+            os.path.join("silver", "current_values", self.global_settings["silver_partition_manifest_file_name"])
+        )
+        if partition_manifest is None:
+            # current_values also holds the files a silver run in progress is replacing, so it is never globbed
+            raise FileNotFoundError("No silver partition manifest. Run silver first.")
+        return self.storage.get_read_paths(
+            os.path.join(silver_root, path)
+            for partition in partition_manifest["partitions"].values()
+            for path in partition["files"]
+        )
+
+    def get_connection(self, version):
+        database_path = self.serving_settings["database_path"]
+        if database_path:
+            database_path = database_path.format(version=version)
+            if os.path.exists(database_path):
+                os.remove(database_path)  # Left over by a load that did not finish
+        duckdb_settings = {**self.global_settings.get("duckdb", {}), "database_path": database_path}
+        con = get_duckdb_connection({**self.global_settings, "duckdb": duckdb_settings}, "serving", self.storage)
+        return con, database_path
+
+    def load(self, version):
+        logger.info(f"Loading served data version {version}")
+        start = time.perf_counter()
+        con, database_path = self.get_connection(version)
+        gold_root = self.storage.get_uri("gold")
+
+        silver_files = self.get_silver_files_to_read()
+        con.sql(f"""
+            CREATE TABLE breweries AS
+            SELECT {", ".join(self.serving_settings["silver_columns"])}
+            FROM read_parquet({silver_files}, hive_partitioning = true, hive_types = {{'state': 'VARCHAR'}},
+                              union_by_name = true)
+            WHERE deleted_at IS NULL
+            ORDER BY state, city;
+        """)
+        for column in self.serving_settings["indexed_columns"]:
+            con.sql(f"CREATE INDEX breweries_{column}_idx ON breweries ({column});")
+
+        aggregate_tables = {}
+        for aggregate_name, aggregate in self.gold_settings["aggregates"].items():
+            con.sql(f"""
+                CREATE TABLE {aggregate["table_name"]} AS
+                SELECT * FROM read_parquet('{os.path.join(gold_root, aggregate["file_name"])}')
+                ORDER BY {", ".join(aggregate["dimensions"])};
+            """)
+            aggregate_tables[aggregate_name] = aggregate["table_name"]
+
+        geo_index = None
+        if self.gold_settings["geo_index"]["enabled"]:
+            geo_index = BreweryGeoIndex.from_parquet(
+                con, os.path.join(gold_root, self.gold_settings["geo_index"]["file_name"]), table_name="brewery_geo"
+            )
+
+        row_count = con.sql("SELECT COUNT(*) FROM breweries").fetchone()[0]
+        logger.info(f"Loaded {row_count} breweries of version {version} in {time.perf_counter() - start:.2f} s")
+        return ServingSnapshot(con, version, database_path, aggregate_tables, geo_index)
+
+    def refresh_if_changed(self):
+        """Loads and swaps in the data of a new gold run. Returns True if the served version changed."""
+        with self.reload_lock:
+            version = self.get_data_version()
+            if version is None or (self.snapshot is not None and self.snapshot.version == version):
+                return False
+            snapshot = self.load(version)
+            with self.snapshot_lock:
+                previous_snapshot, self.snapshot = self.snapshot, snapshot
+                if previous_snapshot is not None:
+                    previous_snapshot.replaced = True
+                    # Otherwise the last request running on it closes it
+                    close_previous_snapshot = previous_snapshot.active_requests == 0
+            for callback in self.on_reload:
+                callback()
+            if previous_snapshot is not None and close_previous_snapshot:
+                previous_snapshot.close()
+            return True
+
+    @contextlib.contextmanager
+    def use_snapshot(self):
+        """The current snapshot (None before the first gold run), kept open until the block ends even if a reload
+        replaces it meanwhile."""
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            if snapshot is not None:
+                snapshot.active_requests += 1
+        try:
+            yield snapshot
+        finally:
+            if snapshot is not None:
+                with self.snapshot_lock:
+                    snapshot.active_requests -= 1
+                    close_snapshot = snapshot.replaced and snapshot.active_requests == 0
+                if close_snapshot:
+                    snapshot.close()
+
+    def watch_run_manifest(self):
+        """Checks the gold run manifest in the background and reloads when a new run is published."""
+
+        def watch():
+            while True:
+                time.sleep(self.serving_settings["manifest_check_interval_seconds"])
+                try:
+                    self.refresh_if_changed()
+                except (duckdb.Error, OSError, BotoCoreError, ClientError):
+                    logger.exception("Could not refresh served data, still serving the previous version")
+
+        threading.Thread(target=watch, name="run-manifest-watcher", daemon=True).start()
+
+
+class BadRequest(Exception):
+    pass
+
+
+def get_float_parameter(query, name, default=None):
+    if name not in query:
+        if default is None:
+            raise BadRequest(f"Missing parameter: {name}")
+        return default
+    try:
+        value = float(query[name])
+    except ValueError:
+        raise BadRequest(f"Parameter {name} must be a number")
+    if not math.isfinite(value):
+        raise BadRequest(f"Parameter {name} must be a finite number")
+    return value
+
+
+def get_positive_parameter(query, name, default=None):
+    value = get_float_parameter(query, name, default)
+    if value <= 0:
+        raise BadRequest(f"Parameter {name} must be positive")
+    return value
+
+
+def get_count_parameter(query, name, default=None):
+    """Row counts (limit, k) are positive integers."""
+    value = get_positive_parameter(query, name, default)
+    if value != int(value):
+        raise BadRequest(f"Parameter {name} must be an integer")
+    return int(value)
+
+
+def get_brewery_id(value):
+    # ids are UUIDs: anything else would fail the cast of the query instead of matching nothing
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        raise BadRequest(f"Brewery id {value} is not a UUID")
+
+
+# Parsers of the /breweries filters on columns that are not VARCHAR, raising BadRequest for values of another type
+FILTER_PARSERS = {"id": get_brewery_id}
+
+
+def route_request(snapshot, serving_settings, path, query):
+    """Answers a GET request from a snapshot, the one its cache key was built from. Returns the JSON-serializable
+    response body."""
+    if snapshot is None:
+        raise LookupError("No gold run published yet")
+    max_results = serving_settings["max_results"]
+    limit = min(get_count_parameter(query, "limit", max_results), max_results)
+    parts = [part for part in path.split("/") if part]
+
+    if parts == ["health"]:
+        return {"version": snapshot.version}
+    if parts == ["breweries"]:
+        filters = {
+            column: FILTER_PARSERS.get(column, str)(query[column])
+            for column in serving_settings["indexed_columns"]
+            if column in query
+        }
+        where = " AND ".join(f"{column} = ?" for column in filters) or "true"
+        return snapshot.query(
+            f"SELECT * FROM breweries WHERE {where} ORDER BY name, id LIMIT {limit}", list(filters.values())
+        )
+    if parts == ["breweries", "near"]:
+        if snapshot.geo_index is None:
+            raise LookupError("The geo index is disabled in the gold settings")
+        latitude = get_float_parameter(query, "latitude")
+        longitude = get_float_parameter(query, "longitude")
+        if "k" in query:
+            return snapshot.geo_index.nearest(latitude, longitude, min(get_count_parameter(query, "k"), limit))
+        return snapshot.geo_index.within_radius(
+            latitude, longitude, get_positive_parameter(query, "radius_km"), limit=limit
+        )
+    if len(parts) == 2 and parts[0] == "breweries":
+        rows = snapshot.query("SELECT * FROM breweries WHERE id = ?", [get_brewery_id(parts[1])])
+        if not rows:
+            raise LookupError(f"Brewery {parts[1]} not found")
+        return rows[0]
+    if len(parts) == 2 and parts[0] == "aggregates":
+        if parts[1] not in snapshot.aggregate_tables:
+            raise LookupError(f"Unknown aggregate {parts[1]}. Available: {sorted(snapshot.aggregate_tables)}")
+        return snapshot.query(f"SELECT * FROM {snapshot.aggregate_tables[parts[1]]}")
+    raise LookupError(f"Unknown path {path}")
+
+
+def get_json_body(result):
+    return json.dumps(result, default=str).encode("utf-8")
+
+
+def get_request_handler(store, cache):
+    class ServingRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            # The snapshot is taken once, so a cached result always comes from the version of its key, and stays
+            # open until the response body is built
+            with store.use_snapshot() as snapshot:
+                status, body, cache_status = self.get_response(snapshot, url, query)
+            self.send_body(status, body, cache_status)
+
+        def get_response(self, snapshot, url, query):
+            # The version is part of the key, so a reload never serves results of the previous data
+            cache_key = (snapshot.version if snapshot else None, url.path, tuple(sorted(query.items())))
+            body = cache.get(cache_key)
+            if body is not None:
+                return 200, body, "HIT"
+            try:
+                result = route_request(snapshot, store.serving_settings, url.path, query)
+            except BadRequest as e:
+                return 400, get_json_body({"error": str(e)}), "MISS"
+            except LookupError as e:
+                return 404, get_json_body({"error": str(e)}), "MISS"
+            except duckdb.Error:
+                logger.exception(f"Query of {self.path} failed")
+                return 500, get_json_body({"error": "Internal error"}), "MISS"
+            if url.path.rstrip("/") == "/health":
+                return 200, get_json_body({**result, "cache": cache.stats()}), "MISS"
+            body = get_json_body(result)
+            cache.put(cache_key, body)
+            return 200, body, "MISS"
+
+        def send_body(self, status, body, cache_status):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Cache", cache_status)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return ServingRequestHandler
+
+
+def run_serving_api():
+    serving_settings, gold_settings, global_settings = load_all_settings()
+    store = ServingStore(serving_settings, gold_settings, global_settings)
+    cache = ResultCache(serving_settings["cache_max_entries"], serving_settings["cache_ttl_seconds"])
+    store.on_reload.append(cache.clear)
+    if not store.refresh_if_changed():
+        logger.warning("No gold run published yet. Requests return 404 until one is.")
+    store.watch_run_manifest()
+
+    server = ThreadingHTTPServer(
+        (serving_settings["host"], serving_settings["port"]), get_request_handler(store, cache)
+    )
+    logger.info(f"Serving on {serving_settings['host']}:{serving_settings['port']}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    run_serving_api()
@@ -1,85 +1,244 @@
-import json
 import logging
+import multiprocessing
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
-import boto3
 import duckdb
 import yaml
 from dotenv import load_dotenv
 
+from common.duckdb_connection import get_duckdb_connection, mark_table_unsynced, sync_table_with_partition_manifest
+from common.history import HISTORY_DIRECTORY, get_committed_history_files, get_history_file_entry
+from common.instrumentation import metrics
+from common.quality import enforce_quality_results, run_table_checks
+from common.run_manifest import exit_without_changes, get_partition_manifest_fingerprint
+from common.storage import LocalStorage, get_storage
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# Options of the silver_parquet settings passed to COPY ... (FORMAT parquet)
+PARQUET_WRITE_OPTIONS = [
+    "compression",
+    "compression_level",
+    "row_group_size",
+    "row_group_size_bytes",
+    "dictionary_size_limit",
+    "string_dictionary_page_size_limit",
+    "parquet_version",
+]
+# SQL of the cleaning rules of settings.yaml. {value} is the column, or the result of the previous rule
+CLEANING_RULES = {
+    "trim": "trim({value})",
+    "collapse_whitespace": r"trim(regexp_replace({value}, '\s+', ' ', 'g'))",
+    "lowercase": "lower({value})",
+    "uppercase": "upper({value})",
+    "empty_as_null": "nullif({value}, '')",
+    "digits_only": "nullif(regexp_replace({value}, '[^0-9]', '', 'g'), '')",
+    "postal_code": r"regexp_replace(upper({value}), '^(\d{5})[ -]?(\d{4})$', '\1-\2')",
+    "latitude_range": "CASE WHEN {value} BETWEEN -90 AND 90 THEN {value} END",
+    "longitude_range": "CASE WHEN {value} BETWEEN -180 AND 180 THEN {value} END",
+}
+# Type changes the "widen" schema evolution policy applies in place: a column can move from its type to any type
+# listed for it. Silver files written with the narrower type are read as the wider one (union_by_name)
+TYPE_WIDENINGS = {
+    "TINYINT": ["SMALLINT", "INTEGER", "BIGINT", "DOUBLE", "VARCHAR"],
+    "SMALLINT": ["INTEGER", "BIGINT", "DOUBLE", "VARCHAR"],
+    "INTEGER": ["BIGINT", "DOUBLE", "VARCHAR"],
+    "BIGINT": ["VARCHAR"],
+    "FLOAT": ["DOUBLE", "VARCHAR"],
+    "DOUBLE": ["VARCHAR"],
+    "BOOLEAN": ["VARCHAR"],
+    "DATE": ["TIMESTAMP", "VARCHAR"],
+    "TIMESTAMP": ["VARCHAR"],
+    "UUID": ["VARCHAR"],
+}
+# Widenings between these types keep the JSON of the values, and so the row hashes of the rows
+INTEGER_TYPES = ["TINYINT", "SMALLINT", "INTEGER", "BIGINT"]
+QUARANTINE_DIRECTORY = os.path.join("silver", "_quarantine")
+
 
 def load_all_settings():
     """Loads all necessary configuration files."""
-    # silver_settings_path = os.path.join(os.path.dirname(__file__), "settings.yaml")
-    # with open(silver_settings_path, "r") as f:
-    #     silver_s = yaml.safe_load(f)
+    silver_settings_path = os.path.join(os.path.dirname(__file__), "settings.yaml")
+    with open(silver_settings_path, "r") as f:
+        silver_s = yaml.safe_load(f)
 
     global_settings_path = os.path.join(os.path.dirname(__file__), "..", "config", "project-settings.yaml")
     with open(global_settings_path, "r") as f:
         global_s = yaml.safe_load(f)
 
-    return global_s
+    return silver_s, global_s
 
 
-def validate_table_schema(table_name, expected_schema):
-    schema_changed = False
-    actual_columns = duckdb.sql(f"""
-        SELECT column_name, data_type 
-        FROM information_schema.columns 
-        WHERE table_name = '{table_name}'
-        ORDER BY ordinal_position
-    """).fetchall()
+def get_cleaning_rules(silver_settings, bronze_schema):
+    """Rules of every cleaned column, from the cleaning section of settings.yaml. Empty when cleaning is
+    disabled. Raises ValueError on columns missing from bronze and on unknown rules."""
+    cleaning_settings = silver_settings.get("cleaning") or {}
+    if not cleaning_settings.get("enabled", True):
+        return {}
+    cleaning_rules = {column: rules for column, rules in (cleaning_settings.get("columns") or {}).items() if rules}
+    for column, rules in cleaning_rules.items():
+        if column not in bronze_schema or column == "id":
+            raise ValueError(f"Cannot clean {column}: not a column of expected_bronze_schema")
+        unknown_rules = [rule for rule in rules if rule not in CLEANING_RULES]
+        if unknown_rules:
+            raise ValueError(f"Unknown cleaning rules for {column}: {unknown_rules}")
+    return cleaning_rules
+
+
+def get_cleaning_steps(column, rules):
+    """SQL expressions of the value of column after each rule. The last one is the cleaned value."""
+    steps = []
+    for rule in rules:
+        # replace instead of format: the rules contain regex braces
+        steps.append(CLEANING_RULES[rule].replace("{value}", steps[-1] if steps else column))
+    return steps
+
+
+def get_bronze_data_query(bronze_read_function, cleaning_rules, str_row_hash):
+    """Bronze rows with their cleaned columns and row hash, computed in the same pass as the read."""
+    cleaned_columns = "".join(
+        f"{get_cleaning_steps(column, rules)[-1]} AS {column}_clean, " for column, rules in cleaning_rules.items()
+    )
+    # The row hash refers to the cleaned columns defined before it in the same SELECT
+    return f"SELECT *, {cleaned_columns}{str_row_hash} AS row_hash FROM {bronze_read_function}"
+
+
+@metrics.timed
+def count_cleaning_rule_hits(con, cleaning_rules):
+    """Counts the bronze rows every cleaning rule changed, in one aggregate over bronze_data. Returns
+    {"<column>.<rule>": count}."""
+    rule_names, aggregates = [], []
+    for column, rules in cleaning_rules.items():
+        steps = [column, *get_cleaning_steps(column, rules)]
+        for rule, value_before, value_after in zip(rules, steps, steps[1:]):
+            rule_names.append(f"{column}.{rule}")
+            aggregates.append(f"COUNT(*) FILTER (WHERE {value_before} IS DISTINCT FROM {value_after})")
+    if not aggregates:
+        return {}
+    return dict(zip(rule_names, con.sql(f"SELECT {', '.join(aggregates)} FROM bronze_data").fetchone()))
+
+
+def record_cleaning_rule_hits(cleaning_rule_hits):
+    metrics.set_value("cleaning_rule_hits", cleaning_rule_hits)
+    hits = {rule: count for rule, count in cleaning_rule_hits.items() if count}
+    if hits:
+        logger.info(f"Cleaning rules applied to bronze rows: {hits}")
+
+
+def get_schema_evolution_policy(silver_settings):
+    """The schema_evolution section of settings.yaml. Every change fails when it is not set."""
+    return {
+        "new_columns": "fail",
+        "type_changes": "fail",
+        "missing_columns": "fail",
+        **(silver_settings.get("schema_evolution") or {}),
+    }
+
+
+def get_query_schema(con, query):
+    """Column types of a query. DESCRIBE only binds it, which reads the Parquet footers or a sample of the JSON
+    files, not the data."""
+    return {row[0]: row[1] for row in con.sql(f"DESCRIBE {query}").fetchall()}
+
+
+def is_castable_without_change(from_type, to_type):
+    return from_type == to_type or to_type in TYPE_WIDENINGS.get(from_type, [])
+
+
+@metrics.timed
+def evolve_bronze_schema(bronze_source_schema, known_schema, policy, typed_source):
+    """Applies the schema evolution policy to the columns of the bronze files, before anything is loaded.
+    known_schema holds the bronze columns of silver. JSON files have no types of their own (typed_source False):
+    their known columns are read with the silver type, and only new columns take the type inferred from the
+    sample. Returns the evolved schema and the changes of this run. Quarantined columns are not part of the
+    evolved schema. Raises ValueError on the changes the policy does not allow."""
+    schema, changes, errors = dict(known_schema), [], []
+    for column, source_type in bronze_source_schema.items():
+        known_type = known_schema.get(column)
+        if known_type is None:
+            # Columns only holding NULLs in the sample of a JSON file have no type yet
+            source_type = "VARCHAR" if source_type == "NULL" else source_type
+            if policy["new_columns"] == "add":
+                schema[column] = source_type
+                changes.append({"column": column, "change": "added", "type": source_type})
+            elif policy["new_columns"] == "quarantine":
+                changes.append({"column": column, "change": "quarantined", "type": source_type})
+            else:
+                errors.append(f"new column {column} {source_type}")
+        elif not typed_source or is_castable_without_change(source_type, known_type):
+            continue
+        elif policy["type_changes"] == "widen" and source_type in TYPE_WIDENINGS.get(known_type, []):
+            schema[column] = source_type
+            changes.append({"column": column, "change": "widened", "from": known_type, "to": source_type})
+        else:
+            errors.append(f"{column} changed from {known_type} to {source_type}")
+    for column in known_schema.keys() - bronze_source_schema.keys():
+        if policy["missing_columns"] == "null":
+            changes.append({"column": column, "change": "missing"})
+        else:
+            errors.append(f"missing column {column}")
+
+    if errors:
+        raise ValueError(f"Bronze schema does not match silver ({policy}): {'; '.join(errors)}")
+    if changes:
+        logger.warning(f"Bronze schema changed: {changes}")
+    else:
+        logger.info("Bronze schema validation passed.")
+    return schema, changes
 
-    actual_schema = {col[0]: col[1] for col in actual_columns}
 
-    missing_columns = set(expected_schema.keys()) - set(actual_schema.keys())
-    added_columns = set(actual_schema.keys()) - set(expected_schema.keys())
-    type_mismatches = {}
-    for col_name in expected_schema.keys():
-        if expected_schema.get(col_name) != actual_schema.get(col_name):
-            type_mismatches[col_name] = {
-                "expected": expected_schema.get(col_name),
-                "actual": actual_schema.get(col_name),
+def save_evolved_schema(storage_manager, silver_schema_state, bronze_schema, schema_changes, run_timestamp):
+    """Saves the schema when this run added or widened columns. Only done once the silver files are written, so
+    a failed run evolves the schema again, and recomputes the row hashes of a widening, on the next one."""
+    evolved_columns = [change for change in schema_changes if change["change"] in ("added", "widened")]
+    if evolved_columns:
+        storage_manager.save_silver_schema(
+            {
+                "columns": bronze_schema,
+                "changes": [
+                    *silver_schema_state["changes"],
+                    *({**change, "run_timestamp": run_timestamp} for change in evolved_columns),
+                ],
             }
+        )
 
-    if missing_columns:
-        logger.warning(f"Colunas faltando em {table_name}: {missing_columns}")
-        schema_changed = True
-    if added_columns:
-        logger.warning(f"Colunas adicionais em {table_name}: {added_columns}")
-        schema_changed = True
-    if type_mismatches:
-        logger.warning(f"Tipos de dados diferentes em {table_name}: {type_mismatches}")
-        schema_changed = True
-
-    if schema_changed:
+
+@metrics.timed
+def validate_silver_files_schema(silver_files_schema, silver_schema, optional_columns):
+    """Checks the schema of the silver files, from their footers, against the silver schema before they are
+    loaded. optional_columns may be missing from older files (derived and added columns), and columns written
+    with a type the schema widened since are read with the wider one. Raises ValueError otherwise."""
+    unknown_columns = sorted(silver_files_schema.keys() - silver_schema.keys())
+    missing_columns = sorted(silver_schema.keys() - silver_files_schema.keys() - set(optional_columns))
+    type_mismatches = {
+        column: {"expected": data_type, "actual": silver_files_schema[column]}
+        for column, data_type in silver_schema.items()
+        if column in silver_files_schema and not is_castable_without_change(silver_files_schema[column], data_type)
+    }
+    if unknown_columns or missing_columns or type_mismatches:
         raise ValueError(
-            f"""Schema changed for {table_name}. 
-            Added columns to source: {list(added_columns)}
-            Missing columns from source: {list(missing_columns)}
-            Type mismatches: {type_mismatches}"""
+            f"Schema of the silver files does not match silver. Unknown columns: {unknown_columns}, "
+            f"missing columns: {missing_columns}, type mismatches: {type_mismatches}"
         )
-
-    logger.info(f"Schema validation for {table_name} passed.")
-    duckdb.sql(f"SELECT * FROM {table_name}").show()
-    return None
+    logger.info("Schema validation of the silver files passed.")
 
 
-def test_bronze_silver_sync(silver_table_name="silver_data", bronze_table_name="bronze_data"):
+def test_bronze_silver_sync(con, silver_table_name="silver_data", bronze_table_name="bronze_data"):
     """
     Test function to validate bronze and silver data synchronization logic.
     """
     # Test scenario 1: Remove some records from silver to test INSERT
-    duckdb.sql(f"DELETE FROM {silver_table_name} WHERE id IN (SELECT id FROM {silver_table_name} LIMIT 2)")
+    con.sql(f"DELETE FROM {silver_table_name} WHERE id IN (SELECT id FROM {silver_table_name} LIMIT 2)")
     logger.info("Removed 2 records from silver to test INSERT")
 
     # Test scenario 2: Update some fields in silver to test UPDATE
-    duckdb.sql(f"""
+    con.sql(f"""
         UPDATE {silver_table_name} 
         SET name = 'TEST_UPDATED_' || name,
             state = 'TEST_STATE_' || state,
@@ -88,11 +247,11 @@ def test_bronze_silver_sync(silver_table_name="silver_data", bronze_table_name="
     logger.info("Updated 2 records in silver to test UPDATE")
 
     # Test scenario 3: Remove some records from bronze to test SOFT DELETE
-    duckdb.sql(f"DELETE FROM {bronze_table_name} WHERE id IN (SELECT id FROM {silver_table_name} LIMIT 2 OFFSET 5)")
+    con.sql(f"DELETE FROM {bronze_table_name} WHERE id IN (SELECT id FROM {silver_table_name} LIMIT 2 OFFSET 5)")
     logger.info("Removed 2 records from bronze to test SOFT DELETE")
 
     # Test scenario 4: Mark some records as deleted in silver to test REINSTATEMENT
-    duckdb.sql(f"""
+    con.sql(f"""
         UPDATE {silver_table_name} 
         SET deleted_at = CURRENT_TIMESTAMP,
             updated_at = CURRENT_TIMESTAMP
@@ -101,177 +260,973 @@ def test_bronze_silver_sync(silver_table_name="silver_data", bronze_table_name="
     logger.info("Marked 3 records as deleted in silver to test REINSTATEMENT")
 
 
-class S3Manager:
-    def __init__(self, global_settings):
-        self.s3_client = boto3.client("s3")
-        self.bucket_name = os.environ["S3_BUCKET_NAME"]
+class SilverStorageManager:
+    """Run manifests and partition manifests of the bronze and silver layers, on the storage of the pipeline."""
+
+    def __init__(self, storage, global_settings):
+        self.storage = storage
         self.last_run_metadata_bronze_path = global_settings["last_run_metadata_bronze_path"]
+        self.last_run_metadata_silver_path = global_settings["last_run_metadata_silver_path"]
+        self.silver_partition_manifest_file_name = global_settings["silver_partition_manifest_file_name"]
+        self.silver_history_manifest_file_name = global_settings["silver_history_manifest_file_name"]
+        self.silver_schema_file_name = global_settings["silver_schema_file_name"]
+
+    def get_last_bronze_run_metadata(self):
+        """Get the metadata written by the last complete bronze run."""
+        last_bronze_run_metadata = self.storage.read_json(os.path.join("bronze", self.last_run_metadata_bronze_path))
+        if last_bronze_run_metadata is None:
+            raise FileNotFoundError(f"No bronze run found in {self.storage.get_uri('bronze')}")
+        return last_bronze_run_metadata
+
+    def get_bronze_page_manifest(self, page_manifest_path):
+        """Get the per-page fingerprints written by an incremental bronze run."""
+        return self.storage.read_json(os.path.join("bronze", page_manifest_path))
+
+    def get_last_silver_run_metadata(self):
+        """Get the metadata of the last successful silver run, or None on the first run."""
+        return self.storage.read_json(os.path.join("silver", self.last_run_metadata_silver_path))
+
+    def save_last_silver_run_metadata(self, metadata):
+        path = os.path.join("silver", self.last_run_metadata_silver_path)
+        self.storage.write_json(path, metadata)
+        logger.info(f"Saved last silver run metadata to {self.storage.get_uri(path)}")
 
     def get_last_bronze_run_directory(self):
-        """Get the last bronze run directory from S3."""
-        s3_client = boto3.client("s3")
-        s3_key = os.path.join("bronze", self.last_run_metadata_bronze_path)
-        response = s3_client.get_object(Bucket=self.bucket_name, Key=s3_key)
-        last_run_metadata = json.loads(response["Body"].read().decode("utf-8"))
-        last_run_directory = last_run_metadata["last_run_directory"]
+        """Get the last bronze run directory."""
+        last_run_directory = self.get_last_bronze_run_metadata()["last_run_directory"]
         last_run_complete_directory = os.path.join("bronze", last_run_directory)
         return last_run_complete_directory
 
-    def delete_silver_files(self):
-        """Delete all files in the silver directory."""
-        s3_client = boto3.client("s3")
-        prefix = os.path.join("silver", "current_values")
-        while True:
-            response = s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix)
-            if "Contents" in response:
-                s3_client.delete_objects(
-                    Bucket=self.bucket_name,
-                    Delete={
-                        "Objects": [{"Key": obj["Key"]} for obj in response["Contents"]],
-                        "Quiet": False,
-                    },
-                )
-            else:
-                break
+    def get_silver_partition_manifest(self):
+        """Get the manifest listing the live files of every silver partition, or None if it was never written."""
+        return self.storage.read_json(
+            os.path.join("silver", "current_values", self.silver_partition_manifest_file_name)
+        )
 
+    def save_silver_partition_manifest(self, manifest):
+        """A single write replaces the manifest, so readers switch to the new files all at once."""
+        path = os.path.join("silver", "current_values", self.silver_partition_manifest_file_name)
+        self.storage.write_json(path, manifest)
+        logger.info(f"Saved silver partition manifest to {self.storage.get_uri(path)}")
+
+    def get_silver_schema(self):
+        """Get the schema evolved by earlier runs (see evolve_bronze_schema), or None if it never changed."""
+        return self.storage.read_json(os.path.join("silver", self.silver_schema_file_name))
+
+    def save_silver_schema(self, silver_schema):
+        path = os.path.join("silver", self.silver_schema_file_name)
+        self.storage.write_json(path, silver_schema)
+        logger.info(f"Saved silver schema to {self.storage.get_uri(path)}")
+
+    def get_silver_history_manifest(self):
+        """Get the manifest listing the files of silver/history, or None if no version was closed yet."""
+        return self.storage.read_json(os.path.join(HISTORY_DIRECTORY, self.silver_history_manifest_file_name))
+
+    def save_silver_history_manifest(self, manifest):
+        path = os.path.join(HISTORY_DIRECTORY, self.silver_history_manifest_file_name)
+        self.storage.write_json(path, manifest)
+        logger.info(f"Saved silver history manifest to {self.storage.get_uri(path)}")
+
+    def delete_silver_history_files(self, relative_paths):
+        """Delete files given relative to silver/history."""
+        self.storage.delete([os.path.join(HISTORY_DIRECTORY, path) for path in relative_paths])
+        logger.info(f"Deleted {len(relative_paths)} silver history files of an unpublished run")
+
+    def delete_previous_change_sets(self, change_set_key):
+        """Deletes the change sets of earlier runs, including the ones of failed runs. Gold only applies the change
+        set of the last silver run, so they are never read again once the run manifest points to change_set_key."""
+        stale_keys = [
+            key for key in self.storage.list_files(os.path.join("silver", "changes")) if key != change_set_key
+        ]
+        if stale_keys:
+            self.storage.delete(stale_keys)
+            logger.info(f"Deleted {len(stale_keys)} silver change sets of earlier runs")
+
+    def delete_silver_files(self, relative_paths):
+        """Delete files given relative to silver/current_values."""
+        self.storage.delete([os.path.join("silver", "current_values", path) for path in relative_paths])
+        logger.info(f"Deleted {len(relative_paths)} superseded silver files")
 
-def read_data_from_bronze_and_silver(bronze_files_path, silver_files_path_to_read):
-    logging.info(f"Last run complete directory: {bronze_files_path}")
-    duckdb.sql(f"""
-            CREATE TABLE bronze_data AS
-            SELECT * FROM read_json('{bronze_files_path}'); 
-        """)
 
+def get_bronze_read_function(bronze_data_format, bronze_files_to_read, read_schema=None):
+    """Builds the DuckDB table function that reads the bronze files in the format they were landed in. JSON files
+    are read with the types of read_schema when given, otherwise DuckDB infers them from a sample."""
+    if bronze_data_format == "parquet":
+        # Pages kept from earlier runs may predate a column, or hold a narrower type of it
+        return f"read_parquet({bronze_files_to_read}, union_by_name = true)"
+    # Passing the schema keeps all-NULL columns from being inferred as JSON
+    columns = f", columns = {read_schema}" if read_schema else ""
+    if bronze_data_format == "ndjson":
+        return f"read_json({bronze_files_to_read}, format = 'newline_delimited'{columns})"
+    return f"read_json({bronze_files_to_read}{columns})"
+
+
+def get_silver_files_query(storage, partition_manifest, silver_files_path_to_write):
+    """Query over every file of the partition manifest, or None when silver has no file yet. union_by_name reads
+    files written before a column existed, or with a narrower type, by name."""
+    if not partition_manifest["partitions"]:
+        return None
+    silver_paths = storage.get_read_paths(
+        os.path.join(silver_files_path_to_write, path)
+        for partition in partition_manifest["partitions"].values()
+        for path in partition["files"]
+    )
+    return f"""
+        SELECT * FROM read_parquet({silver_paths}, hive_partitioning = true,
+                                   hive_types = {{'state': 'VARCHAR'}}, union_by_name = true)
+    """
+
+
+def get_bronze_source_query(bronze_read_function, bronze_schema, bronze_source_schema):
+    """Bronze rows with the columns and types of the evolved schema: columns missing from the files are NULL and
+    quarantined columns are left out."""
+    columns = ", ".join(
+        f"CAST({column} AS {data_type}) AS {column}"
+        if column in bronze_source_schema
+        else f"NULL::{data_type} AS {column}"
+        for column, data_type in bronze_schema.items()
+    )
+    return f"(SELECT {columns} FROM {bronze_read_function})"
+
+
+@metrics.timed
+def export_quarantined_columns(con, storage, bronze_read_function, schema_changes, run_timestamp):
+    """Writes the ids and values of the new bronze columns the policy quarantined, for the rows that have a value
+    in one of them. Returns the path of the file relative to the storage root, or None."""
+    columns = [change["column"] for change in schema_changes if change["change"] == "quarantined"]
+    if not columns:
+        return None
+    quarantine_key = os.path.join(QUARANTINE_DIRECTORY, f"quarantine_{run_timestamp}.parquet")
+    copy_stats = con.sql(f"""
+        COPY (
+            SELECT id, {", ".join(columns)} FROM {bronze_read_function}
+            WHERE {" OR ".join(f"{column} IS NOT NULL" for column in columns)}
+        ) TO '{storage.get_output_uri(quarantine_key)}' (FORMAT parquet, RETURN_STATS);
+    """).fetchall()
+    metrics.record_copy_stats(copy_stats)
+    logger.info(
+        f"Quarantined {copy_stats[0][1]} rows of the new columns {columns} to {storage.get_uri(quarantine_key)}"
+    )
+    return quarantine_key
+
+
+@metrics.timed
+def get_silver_partition_manifest(con, storage_manager, silver_files_path_to_write):
+    """Loads the silver partition manifest. Silver layers written before the manifest existed are listed once
+    with a glob, which also gives the state value behind every partition directory."""
+    partition_manifest = storage_manager.get_silver_partition_manifest()
+    if partition_manifest is not None:
+        return partition_manifest
+
+    partition_manifest = {"version": None, "partitions": {}, "superseded_files": []}
     try:
-        duckdb.sql(f"""
-            CREATE TABLE silver_data AS
-            SELECT * FROM read_parquet('{silver_files_path_to_read}', hive_partitioning = true);
+        existing_files = con.sql(f"""
+            SELECT DISTINCT filename, state
+            FROM read_parquet('{silver_files_path_to_write}/*/*.parquet', hive_partitioning = true,
+                              hive_types = {{'state': 'VARCHAR'}}, filename = true)
+        """).fetchall()
+    except duckdb.IOException:
+        return partition_manifest
+    for filename, state in existing_files:
+        add_file_to_partition_manifest(partition_manifest, silver_files_path_to_write, filename, state)
+    logger.info(f"Built silver partition manifest from {len(existing_files)} existing files")
+    return partition_manifest
+
+
+def add_file_to_partition_manifest(partition_manifest, silver_files_path_to_write, filename, state):
+    relative_path = filename[len(silver_files_path_to_write) :].lstrip("/")
+    partition = partition_manifest["partitions"].setdefault(
+        os.path.dirname(relative_path), {"state": state, "files": []}
+    )
+    partition["files"].append(relative_path)
+
+
+def get_row_hash_expression(columns_to_hash, cleaned_columns=(), added_columns=()):
+    """Builds the SQL expression of the per-row content hash. JSON keeps NULL and '' apart, and md5 is stable
+    across DuckDB versions, which matters because the hash is persisted in the silver files. Cleaned columns are
+    hashed by their <column>_clean value under the name of the column, so the hash of a row whose values were
+    already clean does not change when cleaning is turned on. Columns added by schema evolution only count when
+    one of them has a value, so adding a column does not change the hash of the rows without one."""
+    struct_fields = ", ".join(
+        f"{col} := {col}_clean" if col in cleaned_columns else f"{col} := {col}"
+        for col in columns_to_hash
+        if col not in added_columns
+    )
+    if not added_columns:
+        return f"md5(to_json(struct_pack({struct_fields})))"
+    added_fields = ", ".join(f"{col} := {col}" for col in added_columns)
+    no_added_value = " AND ".join(f"{col} IS NULL" for col in added_columns)
+    return (
+        f"md5(to_json(struct_pack({struct_fields}))::VARCHAR "
+        f"|| CASE WHEN {no_added_value} THEN '' ELSE to_json(struct_pack({added_fields}))::VARCHAR END)"
+    )
+
+
+@metrics.timed
+def read_data_from_bronze_and_silver(
+    con,
+    storage,
+    bronze_read_function,
+    partition_manifest,
+    silver_files_path_to_write,
+    silver_schema,
+    str_row_hash,
+    cleaning_rules,
+    recompute_row_hash,
+):
+    logger.info(f"Reading bronze data with {bronze_read_function[:200]}")
+    con.sql(f"""
+            CREATE OR REPLACE TABLE bronze_data AS
+            {get_bronze_data_query(bronze_read_function, cleaning_rules, str_row_hash)};
         """)
-    except duckdb.duckdb.IOException:
-        logging.info("No existing silver data found. Creating new silver data.")
-        duckdb.sql("""
-            CREATE TABLE silver_data AS
+    metrics.record_query_profile(con, "load_bronze_data")
+
+    try:
+        # On a persistent working database only the partitions changed since the last run are read again.
+        # union_by_name: files written before a column existed, or with a narrower type, are read by name
+        sync_table_with_partition_manifest(
+            con,
+            "silver_data",
+            partition_manifest,
+            silver_files_path_to_write,
+            "hive_partitioning = true, hive_types = {'state': 'VARCHAR'}, union_by_name = true",
+            storage=storage,
+        )
+        conform_silver_data(con, silver_schema)
+        backfill_silver_derived_columns(con, str_row_hash, cleaning_rules, recompute_row_hash)
+    except duckdb.IOException:
+        logger.info("No existing silver data found. Creating new silver data.")
+        con.sql("""
+            CREATE OR REPLACE TABLE silver_data AS
             SELECT *
             FROM bronze_data
             LIMIT 0;""")
-        duckdb.sql("""
+        con.sql("""
             ALTER TABLE silver_data ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
             ALTER TABLE silver_data ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
             ALTER TABLE silver_data ADD COLUMN deleted_at TIMESTAMP DEFAULT NULL;
+            CREATE OR REPLACE TABLE silver_states_to_backfill (state VARCHAR);
         """)
 
 
-def get_diff_between_bronze_and_silver(str_columns_to_select, str_columns_to_compare):
-    duckdb.sql(f"""
-        CREATE TABLE silver_bronze_diff AS
-        SELECT COALESCE(b.id, s.id) AS id
-            ,{str_columns_to_select}
-            ,(CASE WHEN s.id IS NULL THEN true ELSE false END) AS __new_record
-            ,(CASE WHEN b.id IS NULL AND s.deleted_at IS NULL THEN true ELSE false END) AS __deleted_record
-            ,(CASE WHEN b.id IS NOT NULL AND s.deleted_at IS NOT NULL THEN true ELSE false END) AS __reinserted_record
-            ,(CASE WHEN b.id IS NOT NULL AND s.id IS NOT NULL AND s.deleted_at IS NULL THEN true ELSE false END) AS __updated_record
+def conform_silver_data(con, silver_schema):
+    """Adds the columns of the silver schema that no loaded file had and widens the ones loaded with a narrower
+    type, which only changes the working table."""
+    silver_types = {row[0]: row[1] for row in con.sql("DESCRIBE silver_data").fetchall()}
+    statements = [
+        f"ALTER TABLE silver_data ADD COLUMN {column} {data_type};"
+        if column not in silver_types
+        else f"ALTER TABLE silver_data ALTER COLUMN {column} SET DATA TYPE {data_type};"
+        for column, data_type in silver_schema.items()
+        if silver_types.get(column) != data_type
+    ]
+    if statements:
+        mark_table_unsynced(con, "silver_data")
+    for statement in statements:
+        con.sql(statement)
+
+
+@metrics.timed
+def backfill_silver_derived_columns(con, str_row_hash, cleaning_rules, recompute_row_hash=False):
+    """Computes row_hash and the cleaned columns of silver rows written before they existed, and cleans again
+    the rows whose cleaned values do not match the current rules. Their row_hash is recomputed too, so a change
+    of the rules is not taken for a change of the data. Their partitions are rewritten by this run (see
+    get_touched_states), so this is only done once. recompute_row_hash recomputes it for every row, after a
+    column was widened to a type whose values hash differently. A persistent silver_data is marked unsynced
+    before it is modified, so a run failing before its partitions are rewritten reloads it from the files."""
+    if recompute_row_hash:
+        mark_table_unsynced(con, "silver_data")
+        con.sql("UPDATE silver_data SET row_hash = NULL;")
+    cleaned_values = {
+        f"{column}_clean": get_cleaning_steps(column, rules)[-1] for column, rules in cleaning_rules.items()
+    }
+    outdated_condition = " OR ".join(f"{name} IS DISTINCT FROM {value}" for name, value in cleaned_values.items())
+    con.sql(f"""
+        CREATE OR REPLACE TABLE silver_states_to_backfill AS
+        SELECT DISTINCT state FROM silver_data WHERE row_hash IS NULL {f"OR {outdated_condition}" if cleaned_values else ""}
+    """)
+    states_to_backfill = con.sql("SELECT COUNT(*) FROM silver_states_to_backfill").fetchone()[0]
+    if not states_to_backfill:
+        return
+    mark_table_unsynced(con, "silver_data")
+    if cleaned_values:
+        assignments = ", ".join(f"{name} = {value}" for name, value in cleaned_values.items())
+        con.sql(f"UPDATE silver_data SET {assignments}, row_hash = NULL WHERE {outdated_condition};")
+    con.sql(f"UPDATE silver_data SET row_hash = {str_row_hash} WHERE row_hash IS NULL;")
+    logger.info(f"Backfilled row_hash and cleaned columns in {states_to_backfill} silver partitions")
+
+
+def get_bronze_files_to_read(storage_manager, last_bronze_run_metadata):
+    """Lists the bronze data files of the last run. Incremental runs list them in their page manifest,
+    because unchanged pages may still live in the directory of an earlier run."""
+    storage = storage_manager.storage
+    bronze_root = storage.get_uri("bronze")
+    page_manifest_path = last_bronze_run_metadata.get("page_manifest")
+    if page_manifest_path and last_bronze_run_metadata.get("data_granularity", "page") == "page":
+        page_manifest = storage_manager.get_bronze_page_manifest(page_manifest_path)
+        return storage.get_read_paths(
+            os.path.join(bronze_root, entry["object_path"]) for entry in page_manifest["pages"].values()
+        )
+
+    # Runs written before data_file_pattern existed always used one file per page
+    bronze_data_file_pattern = last_bronze_run_metadata.get("data_file_pattern", "breweries_page_*.json")
+    return [os.path.join(bronze_root, last_bronze_run_metadata["last_run_directory"], bronze_data_file_pattern)]
+
+
+def bronze_run_already_processed(last_bronze_run_metadata, last_silver_run_metadata):
+    """True if silver already holds the exact content of this bronze run, based on the bronze fingerprint."""
+    bronze_fingerprint = last_bronze_run_metadata.get("fingerprint")
+    if not bronze_fingerprint or not last_silver_run_metadata:
+        return False
+    return last_silver_run_metadata.get("bronze_fingerprint") == bronze_fingerprint
+
+
+@metrics.timed
+def create_silver_merge_view(con, columns_to_merge, merged_at):
+    """Defines silver_merge, the new version of every silver row, as a single FULL OUTER JOIN of bronze and
+    silver: unchanged rows keep their silver version, new, updated and reinstated rows take the bronze values and
+    active rows missing from bronze are soft deleted. Nothing is materialized and silver_data is not modified:
+    the change set and the export each stream the view once. With the quality checks on, silver_new_data is
+    materialized once after the change set instead, and the checks and the export read it.
+
+    __change is what the run does to the row (NULL if nothing) and __previous is its silver version as a struct.
+    silver_new_data is the same rows without them. Content changes are detected with one hash comparison per id
+    instead of comparing every column, and rows already soft-deleted in silver and still missing from bronze are
+    not changes."""
+    merged_at = f"TIMESTAMP '{merged_at}'"
+    str_merged_columns = ",\n            ".join(
+        f"(CASE WHEN b.id IS NULL THEN s.{col} ELSE b.{col} END) AS {col}" for col in columns_to_merge
+    )
+    con.sql(f"""
+        CREATE OR REPLACE VIEW silver_merge AS
+        SELECT
+            (CASE
+                WHEN s.id IS NULL THEN 'inserted'
+                WHEN b.id IS NULL THEN (CASE WHEN s.deleted_at IS NULL THEN 'deleted' END)
+                WHEN s.deleted_at IS NOT NULL THEN 'reinserted'
+                WHEN b.row_hash IS DISTINCT FROM s.row_hash THEN 'updated'
+            END) AS __change,
+            COALESCE(b.id, s.id) AS id,
+            {str_merged_columns},
+            (CASE WHEN s.id IS NULL THEN {merged_at} ELSE s.created_at END) AS created_at,
+            (CASE WHEN __change IS NULL THEN s.updated_at ELSE {merged_at} END) AS updated_at,
+            (CASE WHEN b.id IS NULL THEN COALESCE(s.deleted_at, {merged_at}) END) AS deleted_at,
+            s AS __previous
         FROM bronze_data b
-        FULL OUTER JOIN silver_data s ON b.id = s.id
-        WHERE 
-            b.id IS NULL 
-            OR s.id IS NULL 
-            OR (b.id IS NOT NULL AND s.deleted_at IS NOT NULL)
-            OR ({str_columns_to_compare})
+        FULL OUTER JOIN silver_data s ON b.id = s.id;
+
+        CREATE OR REPLACE VIEW silver_new_data AS SELECT * EXCLUDE (__change, __previous) FROM silver_merge;
     """)
 
-    logger.info("Diff between bronze and silver:")
-    duckdb.sql("SELECT * FROM silver_bronze_diff").show()
-
-    if duckdb.sql("SELECT COUNT(*) FROM silver_bronze_diff").fetchone()[0] == 0:
-        logger.info("No changes detected between bronze and silver data. Exiting.")
-        exit(0)
-
-
-def update_silver_data_duckdb_table(str_columns_to_select, str_columns_to_update):
-    duckdb.sql(f"""
-            -- Insert new records into silver
-            INSERT INTO silver_data
-            (id, {str_columns_to_select.replace("b.", "")})
-            SELECT b.id, {str_columns_to_select}
-            FROM silver_bronze_diff b
-            WHERE b.__new_record = true;
-
-            -- Update existing records in silver
-            UPDATE silver_data
-            SET updated_at = CURRENT_TIMESTAMP,
-                {str_columns_to_update}
-            FROM silver_bronze_diff b
-            WHERE silver_data.id = b.id
-            AND b.__updated_record = true;
-
-            -- Soft delete records in silver
-            UPDATE silver_data
-            SET updated_at = CURRENT_TIMESTAMP,
-                deleted_at = CURRENT_TIMESTAMP
-            FROM silver_bronze_diff b
-            WHERE silver_data.id = b.id
-            AND b.__deleted_record = true
-            AND silver_data.deleted_at IS NULL;
-
-            -- Reinserted records in silver
-            UPDATE silver_data
-            SET updated_at = CURRENT_TIMESTAMP,
-                deleted_at = NULL,
-                {str_columns_to_update}
-            FROM silver_bronze_diff b
-            WHERE silver_data.id = b.id
-            AND b.__reinserted_record = true;
 
+@metrics.timed
+def collect_silver_change_set(con, silver_columns):
+    """Signed change set read by gold to update its aggregates without scanning silver, collected in one pass
+    over silver_merge.
+
+    The previous active version of every changed row gets __sign = -1 and its new active version __sign = 1.
+    Soft deletes only get the -1 row and inserts and reinstatements only get the +1 row, so SUM(__sign) per group
+    is the count delta of the run. __change and __previous_state are only used by the run and not exported.
+    Returns the number of changed rows.
+    """
+    str_versioned_columns = ", ".join(
+        f"(CASE WHEN v.__sign = -1 THEN m.__previous.{col} ELSE m.{col} END) AS {col}" for col in silver_columns
+    )
+    con.sql(f"""
+        CREATE OR REPLACE TABLE silver_change_set AS
+        SELECT v.__sign, {str_versioned_columns}, m.__change, m.__previous.state AS __previous_state
+        FROM (SELECT * FROM silver_merge WHERE __change IS NOT NULL) m
+        CROSS JOIN (VALUES (-1), (1)) v(__sign)
+        WHERE (v.__sign = -1 AND m.__change IN ('updated', 'deleted'))
+            OR (v.__sign = 1 AND m.__change IN ('inserted', 'updated', 'reinserted'))
     """)
+    metrics.record_query_profile(con, "collect_silver_change_set")
+    metrics.show_table(con, "SELECT * FROM silver_change_set", "Change set between bronze and silver:")
 
+    return con.sql("SELECT COUNT(DISTINCT id) FROM silver_change_set").fetchone()[0]
 
-def export_silver_data_to_storage(s3_manager, silver_files_path_to_write):
-    # DuckDB COPY command does not delete old files, sometimes overwriting only is not enough
-    logging.info(f"Deleting old files from {silver_files_path_to_write}")
-    s3_manager.delete_silver_files()
-    logging.info("Old Files deleted")
 
-    duckdb.sql(f"""
-        COPY silver_data TO '{silver_files_path_to_write}'
-        (FORMAT parquet, PARTITION_BY (state), OVERWRITE_OR_IGNORE);
-        """)
+@metrics.timed
+def get_touched_states(con):
+    """Collects the state partitions that the change set changes: the state of every version it adds or removes,
+    plus the previous state of reinstated rows, whose soft-deleted version is replaced."""
+    con.sql("""
+        CREATE OR REPLACE TABLE silver_touched_states AS
+        SELECT state FROM silver_change_set
+        UNION
+        SELECT __previous_state FROM silver_change_set WHERE __change = 'reinserted'
+        UNION
+        SELECT state FROM silver_states_to_backfill;
+    """)
+    return [row[0] for row in con.sql("SELECT state FROM silver_touched_states").fetchall()]
+
+
+def merge_bronze_into_silver(con, silver_columns, columns_to_merge, merged_at):
+    """Defines the merged silver rows and collects the change set of the run. Returns the touched states."""
+    create_silver_merge_view(con, columns_to_merge, merged_at)
+    collect_silver_change_set(con, silver_columns)
+    return get_touched_states(con)
+
+
+@metrics.timed
+def materialize_silver_new_data(con):
+    """Replaces the silver_new_data view with a temporary table of the merged rows, so the quality checks and the
+    export read them without running the merge again. Being temporary, it is never written to a persistent
+    working database."""
+    con.sql("""
+        CREATE TEMP TABLE silver_merged_rows AS SELECT * FROM silver_new_data;
+        DROP VIEW silver_new_data;
+        ALTER TABLE silver_merged_rows RENAME TO silver_new_data;
+    """)
+    metrics.record_query_profile(con, "materialize_silver_new_data")
+
+
+@metrics.timed
+def export_silver_change_set(con, storage, run_timestamp):
+    """Writes the change set of this run. Returns its path relative to the storage root."""
+    change_set_key = os.path.join("silver", "changes", f"change_set_{run_timestamp}.parquet")
+    written_files = con.sql(f"""
+        COPY (SELECT * EXCLUDE (__change, __previous_state) FROM silver_change_set)
+        TO '{storage.get_output_uri(change_set_key)}' (FORMAT parquet, RETURN_STATS);
+    """).fetchall()
+    metrics.record_query_profile(con, "export_silver_change_set")
+    metrics.record_copy_stats(written_files)
+    logger.info(f"Silver change set written to {change_set_key}")
+    return change_set_key
+
+
+@metrics.timed
+def collect_silver_history(con, merged_at):
+    """Versions closed by this run (SCD Type 2). They are the active versions the change set removes
+    (__sign = -1): each one was current from its updated_at until merged_at, the time of the change. valid_from
+    is NULL for rows inserted by silver runs that did not record updated_at. Returns how many versions were
+    closed."""
+    con.sql(f"""
+        CREATE OR REPLACE VIEW silver_history_versions AS
+        SELECT * EXCLUDE (__sign, __change, __previous_state), updated_at AS valid_from,
+            TIMESTAMP '{merged_at}' AS valid_to, CAST(TIMESTAMP '{merged_at}' AS DATE) AS change_date
+        FROM silver_change_set
+        WHERE __sign = -1
+    """)
+    return con.sql("SELECT COUNT(*) FROM silver_history_versions").fetchone()[0]
+
+
+def get_parquet_write_options(parquet_settings):
+    """COPY options of the silver Parquet files, from the silver_parquet section of project-settings.yaml."""
+    options = ""
+    for name in PARQUET_WRITE_OPTIONS:
+        value = (parquet_settings or {}).get(name)
+        if value is not None:
+            options += f", {name.upper()} {repr(value) if isinstance(value, str) else value}"
+    return options
+
+
+@metrics.timed
+def add_partitions_to_compact(con, storage, silver_files_path_to_write, partition_manifest, compaction_settings):
+    """Adds to silver_touched_states the partitions made of several small files, so the export rewrites each
+    of them as a single file. Only the footers of the partitions with more than one file are read.
+    Returns the added states."""
+    compaction_settings = compaction_settings or {}
+    touched_states = {row[0] for row in con.sql("SELECT state FROM silver_touched_states").fetchall()}
+    candidate_files = {
+        os.path.join(silver_files_path_to_write, path): partition["state"]
+        for partition in partition_manifest["partitions"].values()
+        if partition["state"] not in touched_states and len(partition["files"]) > 1
+        for path in partition["files"]
+    }
+    if not candidate_files:
+        return []
+
+    read_paths = storage.get_read_paths(candidate_files)
+    file_states = dict(zip(read_paths, candidate_files.values()))
+    small_file_size_bytes = compaction_settings.get("small_file_size_mb", 16) * 1024 * 1024
+    small_file_counts = {}
+    for file_name, file_size_bytes in con.sql(
+        f"SELECT file_name, file_size_bytes FROM parquet_file_metadata({read_paths})"
+    ).fetchall():
+        if file_size_bytes < small_file_size_bytes:
+            state = file_states[file_name]
+            small_file_counts[state] = small_file_counts.get(state, 0) + 1
+    states_to_compact = sorted(
+        (state for state, count in small_file_counts.items() if count >= compaction_settings.get("min_small_files", 2)),
+        key=lambda state: (-small_file_counts[state], str(state)),
+    )[: compaction_settings.get("max_partitions_per_run", 20)]
+    if states_to_compact:
+        con.execute("INSERT INTO silver_touched_states SELECT unnest(?::VARCHAR[])", [states_to_compact])
+        logger.info(f"Compacting {len(states_to_compact)} partitions made of small files")
+    metrics.set_value("compacted_partitions", len(states_to_compact))
+    return states_to_compact
+
+
+@metrics.timed
+def export_silver_history(
+    con, storage_manager, partition_manifest, closed_version_count, run_timestamp, parquet_settings=None
+):
+    """Appends the closed versions to silver/history, partitioned by change date, and lists the new files in
+    the history manifest with the min/max of valid_from and valid_to used by the as-of queries.
+
+    Files are never rewritten. Must run before the partition manifest is swapped: until then the entries of this
+    run are not committed (see common.history.get_committed_history_files)."""
+    history_manifest = storage_manager.get_silver_history_manifest() or {"files": []}
+    committed_files = get_committed_history_files(history_manifest, partition_manifest)
+    uncommitted_paths = [entry["path"] for entry in history_manifest["files"] if entry not in committed_files]
+    if closed_version_count == 0 and not uncommitted_paths:
+        return
+
+    new_files = []
+    if closed_version_count:
+        history_root = storage_manager.storage.get_output_uri(HISTORY_DIRECTORY, is_directory=True)
+        written_files = con.sql(f"""
+            COPY (SELECT * FROM silver_history_versions ORDER BY valid_to, id)
+            TO '{history_root}'
+            (FORMAT parquet, PARTITION_BY (change_date), OVERWRITE_OR_IGNORE,
+             FILENAME_PATTERN 'history_{run_timestamp}_{{i}}', RETURN_STATS{get_parquet_write_options(parquet_settings)});
+        """).fetchall()
+        metrics.record_query_profile(con, "export_silver_history")
+        metrics.record_copy_stats(written_files)
+        new_files = [get_history_file_entry(copy_stats, history_root, run_timestamp) for copy_stats in written_files]
+        logger.info(f"Appended {closed_version_count} closed versions to silver history")
+
+    storage_manager.save_silver_history_manifest({"files": committed_files + new_files})
+    if uncommitted_paths:
+        storage_manager.delete_silver_history_files(uncommitted_paths)
+
+
+@metrics.timed
+def export_silver_data_to_storage(
+    con, storage_manager, silver_files_path_to_write, partition_manifest, run_timestamp, parquet_settings=None
+):
+    """Rewrites only the touched state partitions and then swaps the partition manifest. The merged rows are
+    streamed from silver_new_data straight into the partitioned Parquet writer, sorted within each partition by
+    the sort_by columns of parquet_settings.
+
+    New files get run-specific names, so nothing a reader may be using is overwritten. Files replaced by this
+    run are deleted right after the manifest swap, and are listed in the manifest as superseded_files until then,
+    so the next run deletes them if this one fails in between. Readers only ever read the files of the manifest.
+    silver_data is left as it was loaded, so a persistent working database reloads the touched partitions on the
+    next run.
+    """
+    touched_states = {row[0] for row in con.sql("SELECT state FROM silver_touched_states").fetchall()}
+    logger.info(f"Rewriting {len(touched_states)} touched state partitions")
+
+    # Sorting by state first also has the partitions written one after the other, each to a single file
+    sort_by = ", ".join(["state", *(parquet_settings or {}).get("sort_by", [])])
+    written_files = con.sql(f"""
+        COPY (
+            SELECT s.*
+            FROM silver_new_data s
+            SEMI JOIN silver_touched_states t ON s.state IS NOT DISTINCT FROM t.state
+            ORDER BY {sort_by}
+        ) TO '{silver_files_path_to_write}'
+        (FORMAT parquet, PARTITION_BY (state), OVERWRITE_OR_IGNORE,
+         FILENAME_PATTERN 'data_{run_timestamp}_{{i}}', RETURN_STATS{get_parquet_write_options(parquet_settings)});
+        """).fetchall()
+    metrics.record_query_profile(con, "export_silver_partitions")
+    metrics.record_copy_stats(written_files)
+    new_files = [filename for filename, *_ in written_files]
     # If you want to set location as country, state and city, you can use the following line
     # (FORMAT parquet, PARTITION_BY (country, state, city), OVERWRITE_OR_IGNORE);
+    logger.info(f"Data upload finished. {len(new_files)} files written.")
+
+    new_manifest = {
+        "version": run_timestamp,
+        "partitions": {
+            directory: partition
+            for directory, partition in partition_manifest["partitions"].items()
+            if partition["state"] not in touched_states
+        },
+        "superseded_files": [
+            path
+            for partition in partition_manifest["partitions"].values()
+            if partition["state"] in touched_states
+            for path in partition["files"]
+        ],
+    }
+    if new_files:
+        written_partitions = con.sql(f"""
+            SELECT DISTINCT filename, state
+            FROM read_parquet({new_files}, hive_partitioning = true, hive_types = {{'state': 'VARCHAR'}},
+                              filename = true)
+        """).fetchall()
+        for filename, state in written_partitions:
+            add_file_to_partition_manifest(new_manifest, silver_files_path_to_write, filename, state)
+
+    storage_manager.save_silver_partition_manifest(new_manifest)
+    superseded_files = partition_manifest["superseded_files"] + new_manifest["superseded_files"]
+    if superseded_files:
+        storage_manager.delete_silver_files(superseded_files)
+    metrics.show_table(con, "SELECT COUNT(*) as Number_of_Records_in_Silver_Data FROM silver_new_data")
+    return new_manifest
+
+
+def get_run_counts(con):
+    """Row and change counts recorded in the silver run manifest."""
+    inserted, updated, deleted, reinserted = con.sql("""
+        SELECT COUNT(DISTINCT id) FILTER (__change = 'inserted'), COUNT(DISTINCT id) FILTER (__change = 'updated'),
+               COUNT(DISTINCT id) FILTER (__change = 'deleted'), COUNT(DISTINCT id) FILTER (__change = 'reinserted')
+        FROM silver_change_set
+    """).fetchone()
+    # silver_data still holds the rows as they were before the merge
+    silver_rows, silver_active_rows = con.sql(
+        "SELECT COUNT(*), COUNT(*) FILTER (deleted_at IS NULL) FROM silver_data"
+    ).fetchone()
+    counts = {
+        "row_counts": {
+            "bronze": con.sql("SELECT COUNT(*) FROM bronze_data").fetchone()[0],
+            "silver": silver_rows + inserted,
+            "silver_active": silver_active_rows + inserted + reinserted - deleted,
+        },
+        "change_count": inserted + updated + deleted + reinserted,
+        "changes": {"inserted": inserted, "updated": updated, "deleted": deleted, "reinserted": reinserted},
+    }
+    record_run_counts(counts)
+    return counts
+
+
+def record_run_counts(counts):
+    for table_name, row_count in counts["row_counts"].items():
+        metrics.set_value(f"rows_{table_name}", row_count)
+    for change, row_count in counts["changes"].items():
+        metrics.set_value(f"rows_{change}", row_count)
+
 
-    logging.info("Data upload finished.")
-    duckdb.sql("SELECT COUNT(*) as Number_of_Records_in_Silver_Data FROM silver_data").show()
+def merge_run_counts(shard_run_counts):
+    """Adds up the run counts of the shards."""
+    counts = {"row_counts": {}, "change_count": 0, "changes": {}}
+    for run_counts in shard_run_counts:
+        counts["change_count"] += run_counts["change_count"]
+        for key in ("row_counts", "changes"):
+            for name, value in run_counts[key].items():
+                counts[key][name] = counts[key].get(name, 0) + value
+    return counts
+
+
+def get_shard_settings(global_settings):
+    """The silver_sharding section of project-settings.yaml. A shard_count of 1 merges in the stage's own
+    connection."""
+    return {"shard_count": 1, "max_workers": 1, **(global_settings.get("silver_sharding") or {})}
+
+
+@metrics.timed
+def split_into_shards(con, source_query, shard_count, shard_directory):
+    """Writes the rows of source_query to shard_directory split by hash(id) % shard_count, in one streaming
+    pass. Returns the files of every shard, taken from the rows COPY ... RETURN_STATS returns."""
+    written_files = con.sql(f"""
+        COPY (SELECT *, hash(id) % {shard_count} AS __shard FROM ({source_query}))
+        TO '{shard_directory}' (FORMAT parquet, PARTITION_BY (__shard), RETURN_STATS);
+    """).fetchall()
+    shard_files = {shard: [] for shard in range(shard_count)}
+    for filename, *_, partition_keys in written_files:
+        shard_files[int(partition_keys["__shard"])].append(filename)
+    return shard_files
+
+
+def process_silver_shard(
+    shard,
+    shard_files,
+    global_settings,
+    table_schemas,
+    str_row_hash,
+    cleaning_rules,
+    recompute_row_hash,
+    columns_to_merge,
+    merged_at,
+    shard_directory,
+):
+    """Merge of one shard, run in a worker process by its own DuckDB connection, limited to the
+    worker_memory_limit and worker_threads of silver_sharding.
+
+    Writes the merged silver rows, the change set and the closed versions of the shard to shard_directory and
+    returns their paths with the touched states and run counts of the shard."""
+    shard_settings = get_shard_settings(global_settings)
+    duckdb_settings = {
+        **(global_settings.get("duckdb") or {}),
+        "database_path": None,
+        "memory_limit": shard_settings.get("worker_memory_limit"),
+        "threads": shard_settings.get("worker_threads"),
+    }
+    if duckdb_settings.get("temp_directory"):
+        # DuckDB processes running at the same time must not share a spill directory
+        duckdb_settings["temp_directory"] = os.path.join(duckdb_settings["temp_directory"], f"shard_{shard}")
+    con = get_duckdb_connection(
+        {**global_settings, "duckdb": duckdb_settings}, f"silver shard {shard}", LocalStorage(shard_directory)
+    )
+    for table_name, files in shard_files.items():
+        columns = ", ".join(f"{name} {data_type}" for name, data_type in table_schemas[table_name].items())
+        con.sql(f"CREATE TABLE {table_name} ({columns})")
+        if files:
+            # The shard is in the directory name, not in the files
+            con.sql(f"INSERT INTO {table_name} BY NAME SELECT * FROM read_parquet({files}, hive_partitioning = false)")
+
+    backfill_silver_derived_columns(con, str_row_hash, cleaning_rules, recompute_row_hash)
+    cleaning_rule_hits = count_cleaning_rule_hits(con, cleaning_rules)
+    touched_states = merge_bronze_into_silver(con, list(table_schemas["silver_data"]), columns_to_merge, merged_at)
+    result = {
+        "touched_states": touched_states,
+        "cleaning_rule_hits": cleaning_rule_hits,
+        "closed_version_count": collect_silver_history(con, merged_at),
+        "run_counts": get_run_counts(con),
+        "files": {},
+    }
+    for table_name in ("silver_new_data", "silver_change_set", "silver_history_versions"):
+        path = os.path.join(shard_directory, f"{table_name}_{shard}.parquet")
+        con.sql(f"COPY (SELECT * FROM {table_name}) TO '{path}' (FORMAT parquet)")
+        result["files"][table_name] = path
+    con.close()
+    return result
+
+
+@metrics.timed
+def merge_bronze_into_silver_in_shards(
+    con,
+    global_settings,
+    bronze_read_function,
+    silver_files_query,
+    table_schemas,
+    str_row_hash,
+    cleaning_rules,
+    recompute_row_hash,
+    columns_to_merge,
+    merged_at,
+    shard_directory,
+):
+    """Partitioned execution of the merge, for catalogs larger than one connection handles well.
+
+    Bronze and silver are split by hash(id) into local shard files, so all versions of an id land in the same
+    shard, and the shards are merged in parallel by worker processes with bounded memory. silver_new_data,
+    silver_change_set and silver_history_versions then become views over the files of the workers, so the
+    exports are the same as in the single connection mode. Returns the run counts, the number of closed
+    versions and the cleaning rule hits."""
+    shard_settings = get_shard_settings(global_settings)
+    shard_count = shard_settings["shard_count"]
+
+    # The schemas were checked before the merge. The workers load the shards by name into typed tables
+    con.sql(
+        f"CREATE OR REPLACE VIEW bronze_data AS {get_bronze_data_query(bronze_read_function, cleaning_rules, str_row_hash)}"
+    )
+    shard_files = {
+        "bronze_data": split_into_shards(
+            con, "SELECT * FROM bronze_data", shard_count, os.path.join(shard_directory, "bronze")
+        ),
+        "silver_data": {shard: [] for shard in range(shard_count)},
+    }
+    if silver_files_query is not None:
+        con.sql(f"CREATE OR REPLACE VIEW silver_data AS {silver_files_query}")
+        shard_files["silver_data"] = split_into_shards(
+            con, "SELECT * FROM silver_data", shard_count, os.path.join(shard_directory, "silver")
+        )
+
+    max_workers = min(shard_settings["max_workers"], shard_count)
+    logger.info(f"Merging {shard_count} shards with {max_workers} worker processes")
+    # spawn: forking a process whose DuckDB threads may hold locks is not safe
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(
+                process_silver_shard,
+                shard,
+                {table_name: files[shard] for table_name, files in shard_files.items()},
+                global_settings,
+                table_schemas,
+                str_row_hash,
+                cleaning_rules,
+                recompute_row_hash,
+                columns_to_merge,
+                merged_at,
+                shard_directory,
+            )
+            for shard in range(shard_count)
+        ]
+        shard_results = [future.result() for future in futures]
+
+    # The rows of a state are spread over all shards, so a state touched by one shard is rewritten from all of them
+    touched_states = {state for result in shard_results for state in result["touched_states"]}
+    con.execute(
+        "CREATE OR REPLACE TABLE silver_touched_states AS SELECT unnest(?::VARCHAR[]) AS state", [list(touched_states)]
+    )
+    for table_name in ("silver_new_data", "silver_change_set", "silver_history_versions"):
+        files = [result["files"][table_name] for result in shard_results]
+        con.sql(f"CREATE OR REPLACE VIEW {table_name} AS SELECT * FROM read_parquet({files})")
+
+    run_counts = merge_run_counts(result["run_counts"] for result in shard_results)
+    record_run_counts(run_counts)
+    cleaning_rule_hits = {
+        rule: sum(result["cleaning_rule_hits"][rule] for result in shard_results)
+        for rule in shard_results[0]["cleaning_rule_hits"]
+    }
+    return run_counts, sum(result["closed_version_count"] for result in shard_results), cleaning_rule_hits
 
 
 def run_silver_pipeline():
     # Setting up constant values
 
     # File paths
-    global_settings = load_all_settings()
-    s3_manager = S3Manager(global_settings)
-    last_run_complete_directory = s3_manager.get_last_bronze_run_directory()
-    bronze_files_path = os.path.join(
-        "s3://", os.environ["S3_BUCKET_NAME"], last_run_complete_directory, "breweries_page_*.json"
-    )
-    silver_files_path_to_write = os.path.join("s3://", os.environ["S3_BUCKET_NAME"], "silver", "current_values")
-    silver_files_path_to_read = os.path.join(silver_files_path_to_write, "*", "*.parquet")
+    silver_settings, global_settings = load_all_settings()
+    run_timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    storage = get_storage(global_settings)
+    metrics.configure("silver", global_settings.get("instrumentation"), storage, "silver", run_timestamp)
+    storage_manager = SilverStorageManager(storage, global_settings)
+    last_bronze_run_metadata = storage_manager.get_last_bronze_run_metadata()
+    if bronze_run_already_processed(last_bronze_run_metadata, storage_manager.get_last_silver_run_metadata()):
+        exit_without_changes("Bronze content unchanged since the last silver run (same page fingerprints).")
+    bronze_files_to_read = get_bronze_files_to_read(storage_manager, last_bronze_run_metadata)
+    silver_files_path_to_write = storage.get_output_uri(os.path.join("silver", "current_values"), is_directory=True)
+    # Run manifest read by the next silver run (skip check) and by gold (input fingerprint and change set)
+    last_silver_run_metadata = {
+        "run_timestamp": run_timestamp,
+        "bronze_run_directory": last_bronze_run_metadata["last_run_directory"],
+        "bronze_fingerprint": last_bronze_run_metadata.get("fingerprint"),
+    }
 
-    # Schemas
-    bronze_schema = global_settings["expected_bronze_schema"]
-    silver_schema = {**bronze_schema, "created_at": "TIMESTAMP", "updated_at": "TIMESTAMP", "deleted_at": "TIMESTAMP"}
-    columns_to_compare = [key for key in bronze_schema.keys() if key not in ["id"]]
-    str_columns_to_select = ", ".join([f"b.{col}" for col in columns_to_compare])
-    str_columns_to_compare = " OR ".join([f"b.{col} IS DISTINCT FROM s.{col}" for col in columns_to_compare])
-    str_columns_to_update = ", ".join([f"{col} = b.{col}" for col in columns_to_compare])
+    # Settings
+    expected_bronze_schema = global_settings["expected_bronze_schema"]
+    cleaning_rules = get_cleaning_rules(silver_settings, expected_bronze_schema)
+    shard_settings = get_shard_settings(global_settings)
+    parquet_settings = global_settings.get("silver_parquet") or {}
+    quality_settings = global_settings.get("data_quality") or {}
 
     # Main pipeline
-    read_data_from_bronze_and_silver(bronze_files_path, silver_files_path_to_read)
-    validate_table_schema("bronze_data", bronze_schema)
-    validate_table_schema("silver_data", silver_schema)
-    get_diff_between_bronze_and_silver(str_columns_to_select, str_columns_to_compare)
-    update_silver_data_duckdb_table(str_columns_to_select, str_columns_to_update)
-    export_silver_data_to_storage(s3_manager, silver_files_path_to_write)
-
-    logging.info("Silver data written to S3. Pipeline completed successfully.")
+    connection_settings = global_settings
+    if shard_settings["shard_count"] > 1:
+        # Shards are built from the silver files on every run, so a persistent working database is not used
+        connection_settings = {**global_settings, "duckdb": {**global_settings["duckdb"], "database_path": None}}
+    con = get_duckdb_connection(connection_settings, "silver", storage)
+    partition_manifest = get_silver_partition_manifest(con, storage_manager, silver_files_path_to_write)
+    last_silver_run_metadata["input_fingerprint"] = get_partition_manifest_fingerprint(partition_manifest)
+
+    # Schemas, checked and evolved from the Parquet footers or a sample of the JSON files before anything is loaded
+    bronze_data_format = last_bronze_run_metadata.get("data_format", "raw_json")
+    bronze_source_schema = get_query_schema(
+        con, f"SELECT * FROM {get_bronze_read_function(bronze_data_format, bronze_files_to_read)}"
+    )
+    silver_schema_state = storage_manager.get_silver_schema() or {"columns": {}, "changes": []}
+    bronze_schema, schema_changes = evolve_bronze_schema(
+        bronze_source_schema,
+        {**expected_bronze_schema, **silver_schema_state["columns"]},
+        get_schema_evolution_policy(silver_settings),
+        typed_source=bronze_data_format == "parquet",
+    )
+    last_silver_run_metadata["schema_changes"] = schema_changes
+    added_columns = [column for column in bronze_schema if column not in expected_bronze_schema]
+    cleaned_schema = {f"{column}_clean": bronze_schema[column] for column in cleaning_rules}
+    bronze_table_schema = {**bronze_schema, **cleaned_schema, "row_hash": "VARCHAR"}
+    silver_schema = {
+        **bronze_table_schema,
+        "created_at": "TIMESTAMP",
+        "updated_at": "TIMESTAMP",
+        "deleted_at": "TIMESTAMP",
+    }
+    silver_files_query = get_silver_files_query(storage, partition_manifest, silver_files_path_to_write)
+    if silver_files_query is not None:
+        validate_silver_files_schema(
+            get_query_schema(con, silver_files_query), silver_schema, ["row_hash", *cleaned_schema, *added_columns]
+        )
+    # Other widenings change the JSON of the values, e.g. a DOUBLE turned VARCHAR is hashed as a string, so every
+    # row hash is recomputed and every partition rewritten once
+    recompute_row_hash = any(
+        change["change"] == "widened" and not {change["from"], change["to"]} <= set(INTEGER_TYPES)
+        for change in schema_changes
+    )
+    columns_to_compare = [key for key in bronze_schema if key not in ["id"]]
+    str_row_hash = get_row_hash_expression(columns_to_compare, cleaning_rules, added_columns)
+    columns_to_merge = [*columns_to_compare, *cleaned_schema, "row_hash"]
+    # JSON files are read with the evolved types, and quarantined columns with the ones inferred from the sample
+    bronze_files_read_function = get_bronze_read_function(
+        bronze_data_format,
+        bronze_files_to_read,
+        {column: bronze_schema.get(column, data_type) for column, data_type in bronze_source_schema.items()},
+    )
+    last_silver_run_metadata["quarantine_path"] = export_quarantined_columns(
+        con, storage, bronze_files_read_function, schema_changes, run_timestamp
+    )
+    bronze_read_function = get_bronze_source_query(bronze_files_read_function, bronze_schema, bronze_source_schema)
+    # Time of the inserts, updates and soft deletes of this run, and valid_to of the versions it closes
+    merged_at = datetime.now()
+    shard_directory = None
+    if shard_settings["shard_count"] > 1:
+        # Removed when the run ends, also when it exits early or fails
+        shard_directory = tempfile.TemporaryDirectory(
+            prefix=f"silver_{run_timestamp}_", dir=shard_settings.get("shard_directory")
+        )
+        run_counts, closed_version_count, cleaning_rule_hits = merge_bronze_into_silver_in_shards(
+            con,
+            global_settings,
+            bronze_read_function,
+            silver_files_query,
+            {"bronze_data": bronze_table_schema, "silver_data": silver_schema},
+            str_row_hash,
+            cleaning_rules,
+            recompute_row_hash,
+            columns_to_merge,
+            merged_at,
+            shard_directory.name,
+        )
+    else:
+        read_data_from_bronze_and_silver(
+            con,
+            storage,
+            bronze_read_function,
+            partition_manifest,
+            silver_files_path_to_write,
+            silver_schema,
+            str_row_hash,
+            cleaning_rules,
+            recompute_row_hash,
+        )
+        cleaning_rule_hits = count_cleaning_rule_hits(con, cleaning_rules)
+        merge_bronze_into_silver(con, list(silver_schema), columns_to_merge, merged_at)
+        closed_version_count = collect_silver_history(con, merged_at)
+        run_counts = get_run_counts(con)
+        if quality_settings.get("enabled"):
+            materialize_silver_new_data(con)
+    record_cleaning_rule_hits(cleaning_rule_hits)
+    last_silver_run_metadata["cleaning_rule_hits"] = cleaning_rule_hits
+    if quality_settings.get("enabled"):
+        quality_results = [
+            result
+            for table_name, checks in (quality_settings.get("silver") or {}).items()
+            for result in run_table_checks(con, table_name, checks)
+        ]
+        last_silver_run_metadata["quality"] = enforce_quality_results(
+            storage, "silver", quality_settings, run_timestamp, quality_results
+        )
+    # Partitions whose row_hash or cleaned columns were backfilled are written even without changes
+    if run_counts["change_count"] == 0 and not con.sql("SELECT COUNT(*) FROM silver_touched_states").fetchone()[0]:
+        save_evolved_schema(storage_manager, silver_schema_state, bronze_schema, schema_changes, run_timestamp)
+        storage_manager.save_last_silver_run_metadata(
+            {
+                **last_silver_run_metadata,
+                **run_counts,
+                "output_fingerprint": get_partition_manifest_fingerprint(partition_manifest),
+            }
+        )
+        con.close()
+        exit_without_changes("No changes detected between bronze and silver data.")
+    last_silver_run_metadata["change_set_path"] = export_silver_change_set(con, storage, run_timestamp)
+    last_silver_run_metadata["closed_version_count"] = closed_version_count
+    export_silver_history(
+        con, storage_manager, partition_manifest, closed_version_count, run_timestamp, parquet_settings
+    )
+    last_silver_run_metadata["compacted_partitions"] = add_partitions_to_compact(
+        con, storage, silver_files_path_to_write, partition_manifest, parquet_settings.get("compaction")
+    )
+    new_partition_manifest = export_silver_data_to_storage(
+        con, storage_manager, silver_files_path_to_write, partition_manifest, run_timestamp, parquet_settings
+    )
+    save_evolved_schema(storage_manager, silver_schema_state, bronze_schema, schema_changes, run_timestamp)
+    storage_manager.save_last_silver_run_metadata(
+        {
+            **last_silver_run_metadata,
+            **run_counts,
+            "output_fingerprint": get_partition_manifest_fingerprint(new_partition_manifest),
+        }
+    )
+    storage_manager.delete_previous_change_sets(last_silver_run_metadata["change_set_path"])
+    con.close()
+    if shard_directory is not None:
+        shard_directory.cleanup()
+    metrics.finish("succeeded")
+
+    logger.info(f"Silver data written to {storage.get_uri('silver')}. Pipeline completed successfully.")
 
 
 if __name__ == "__main__":
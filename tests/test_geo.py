@@ -0,0 +1,90 @@
+import math
+import random
+
+import duckdb
+import pytest
+
+from common.geo import CELL_SIZE_METADATA_KEY, EARTH_RADIUS_KM, BreweryGeoIndex, get_cell_key_sql
+
+CELL_SIZE_DEGREES = 0.25
+# Dense areas, the antimeridian and the poles, where the bounding box stops pruning on longitude
+SEARCH_POINTS = [(30.27, -97.74), (0.0, 0.0), (45.0, 179.9), (-33.9, -179.95), (89.5, 10.0), (-89.9, -120.0)]
+
+
+def get_distance_km(latitude_1, longitude_1, latitude_2, longitude_2):
+    """Haversine distance, the brute force reference of the index."""
+    sin_latitude = math.sin(math.radians(latitude_2 - latitude_1) / 2)
+    sin_longitude = math.sin(math.radians(longitude_2 - longitude_1) / 2)
+    a = sin_latitude**2 + math.cos(math.radians(latitude_1)) * math.cos(math.radians(latitude_2)) * sin_longitude**2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+@pytest.fixture(scope="module")
+def breweries():
+    generator = random.Random(7)
+    points = [(generator.uniform(-90, 90), generator.uniform(-180, 180)) for _ in range(3000)]
+    # Clusters around the search points, so radius lookups have matches to rank
+    for latitude, longitude in SEARCH_POINTS:
+        for _ in range(200):
+            points.append(
+                (
+                    max(-90.0, min(90.0, latitude + generator.gauss(0, 1))),
+                    (longitude + generator.gauss(0, 1) + 180) % 360 - 180,
+                )
+            )
+    return [(f"{position:05d}", latitude, longitude) for position, (latitude, longitude) in enumerate(points)]
+
+
+@pytest.fixture(scope="module")
+def geo_index(breweries, tmp_path_factory):
+    """The index over a file written like the gold export: sorted by cell key in small row groups."""
+    con = duckdb.connect()
+    con.sql("CREATE TABLE breweries (id VARCHAR, latitude DOUBLE, longitude DOUBLE)")
+    con.executemany("INSERT INTO breweries VALUES (?, ?, ?)", breweries)
+    path = str(tmp_path_factory.mktemp("gold") / "breweries_geo.parquet")
+    con.sql(f"""
+        COPY (
+            SELECT *, {get_cell_key_sql("latitude", "longitude", CELL_SIZE_DEGREES)} AS cell_key
+            FROM breweries
+            ORDER BY cell_key, id
+        ) TO '{path}' (FORMAT parquet, ROW_GROUP_SIZE 128, KV_METADATA {{{CELL_SIZE_METADATA_KEY}: '{CELL_SIZE_DEGREES}'}})
+    """)
+    yield BreweryGeoIndex.from_parquet(con, path)
+    con.close()
+
+
+def get_brute_force_distances(breweries, latitude, longitude):
+    return sorted(
+        (get_distance_km(latitude, longitude, brewery_latitude, brewery_longitude), id)
+        for id, brewery_latitude, brewery_longitude in breweries
+    )
+
+
+@pytest.mark.parametrize("latitude, longitude", SEARCH_POINTS)
+@pytest.mark.parametrize("radius_km", [5, 50, 300])
+def test_within_radius_matches_brute_force(breweries, geo_index, latitude, longitude, radius_km):
+    expected = [
+        id for distance, id in get_brute_force_distances(breweries, latitude, longitude) if distance <= radius_km
+    ]
+
+    matches = geo_index.within_radius(latitude, longitude, radius_km)
+
+    assert [match["id"] for match in matches] == expected
+    assert all(match["distance_km"] <= radius_km for match in matches)
+
+
+@pytest.mark.parametrize("latitude, longitude", SEARCH_POINTS)
+@pytest.mark.parametrize("k", [1, 10, 100])
+def test_nearest_matches_brute_force(breweries, geo_index, latitude, longitude, k):
+    expected = [id for _, id in get_brute_force_distances(breweries, latitude, longitude)[:k]]
+
+    assert [match["id"] for match in geo_index.nearest(latitude, longitude, k)] == expected
+
+
+def test_unknown_cell_size_is_rejected(tmp_path):
+    con = duckdb.connect()
+    path = str(tmp_path / "no_metadata.parquet")
+    con.sql(f"COPY (SELECT 1 AS id) TO '{path}' (FORMAT parquet)")
+
+    with pytest.raises(ValueError, match=CELL_SIZE_METADATA_KEY):
+        BreweryGeoIndex.from_parquet(con, path)
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import duckdb
+import pytest
+
+from common.storage import LocalStorage
+from gold.main import apply_silver_change_set, compute_gold_aggregates, count_mismatches_with_incremental_tables
+from silver.main import collect_silver_change_set, create_silver_merge_view
+
+AGGREGATES = {
+    "location": {
+        "table_name": "gold_data_location",
+        "file_name": "location.parquet",
+        "dimensions": ["state"],
+        "measures": [{"name": "total_count", "function": "count"}],
+        "filter": "deleted_at IS NULL",
+    },
+    "brewery_type": {
+        "table_name": "gold_data_brewery_type",
+        "file_name": "brewery_type.parquet",
+        "dimensions": ["brewery_type"],
+        "measures": [
+            {"name": "total_count", "function": "count"},
+            {"name": "total_latitude", "function": "sum", "column": "latitude"},
+        ],
+        "filter": "deleted_at IS NULL",
+    },
+}
+COLUMNS_TO_MERGE = ["brewery_type", "state", "latitude", "row_hash"]
+SILVER_COLUMNS = ["id", *COLUMNS_TO_MERGE, "created_at", "updated_at", "deleted_at"]
+
+
+@pytest.fixture
+def con():
+    """1000 silver rows, some of them soft deleted, and a bronze catalog that inserts, updates, deletes and
+    reinstates breweries, moving some of them to another state or type. Every large brewery is deleted."""
+    con = duckdb.connect()
+    con.sql("""
+        SELECT setseed(0.5);
+        CREATE TABLE silver_data AS
+        SELECT i::VARCHAR AS id, ['micro', 'brewpub', 'large'][1 + i % 3] AS brewery_type,
+            ['Texas', 'Ohio', 'Maine', 'Utah'][1 + i % 4] AS state, random() * 90 AS latitude,
+            i::VARCHAR AS row_hash, TIMESTAMP '2025-01-01' AS created_at, TIMESTAMP '2025-01-01' AS updated_at,
+            CASE WHEN i % 17 = 0 THEN TIMESTAMP '2025-01-02' END AS deleted_at
+        FROM range(1000) t(i);
+
+        CREATE TABLE bronze_data AS
+        SELECT id,
+            CASE WHEN id::INT % 5 = 0 THEN 'nano' ELSE brewery_type END AS brewery_type,
+            CASE WHEN id::INT % 7 = 0 THEN 'Iowa' ELSE state END AS state,
+            CASE WHEN id::INT % 11 = 0 THEN latitude / 2 ELSE latitude END AS latitude,
+            CASE WHEN id::INT % 5 = 0 OR id::INT % 7 = 0 OR id::INT % 11 = 0 THEN row_hash || 'b' ELSE row_hash END
+                AS row_hash
+        FROM silver_data
+        WHERE id::INT % 13 <> 0 AND brewery_type <> 'large' AND (deleted_at IS NULL OR id::INT % 2 = 0)
+        UNION ALL
+        SELECT i::VARCHAR, 'micro', 'Alaska', 61.2, i::VARCHAR FROM range(1000, 1100) t(i);
+    """)
+    yield con
+    con.close()
+
+
+def test_change_set_applied_to_the_last_states_equals_a_full_recompute(con, tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    previous_state_path = str(tmp_path / "state")
+    change_set_path = str(tmp_path / "change_set.parquet")
+    compute_gold_aggregates(con, "silver_data", AGGREGATES)
+    (tmp_path / "state").mkdir()
+    for aggregate in AGGREGATES.values():
+        con.sql(
+            f"COPY {aggregate['table_name']}__state TO '{previous_state_path}/{aggregate['file_name']}' (FORMAT parquet)"
+        )
+
+    create_silver_merge_view(con, COLUMNS_TO_MERGE, datetime(2025, 1, 3))
+    collect_silver_change_set(con, SILVER_COLUMNS)
+    con.sql(f"COPY (SELECT * EXCLUDE (__change, __previous_state) FROM silver_change_set) TO '{change_set_path}'")
+    apply_silver_change_set(con, storage, change_set_path, previous_state_path, AGGREGATES, table_suffix="_incremental")
+    compute_gold_aggregates(con, "silver_new_data", AGGREGATES)
+
+    assert count_mismatches_with_incremental_tables(con, AGGREGATES) == {
+        "gold_data_location": 0,
+        "gold_data_brewery_type": 0,
+    }
+    # Groups emptied by the change set are dropped, as a full recompute never creates them
+    brewery_types = con.sql("SELECT brewery_type FROM gold_data_brewery_type__state_incremental").fetchall()
+    assert sorted(row[0] for row in brewery_types) == ["brewpub", "micro", "nano"]
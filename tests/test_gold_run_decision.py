@@ -0,0 +1,41 @@
+from gold.main import get_change_set_problem, is_gold_up_to_date
+
+GOLD_SETTINGS = {"full_recompute_every_n_runs": 7}
+LAST_GOLD_RUN_METADATA = {
+    "input_fingerprint": "silver-1",
+    "definitions_fingerprint": "definitions-1",
+    "state_path": "gold/_state/20250101-000000",
+    "runs_since_full_recompute": 1,
+}
+LAST_SILVER_RUN_METADATA = {
+    "input_fingerprint": "silver-1",
+    "output_fingerprint": "silver-2",
+    "change_set_path": "silver/changes/change_set_20250102-000000.parquet",
+}
+
+
+def test_unchanged_silver_and_definitions_skip_the_run():
+    assert is_gold_up_to_date(LAST_GOLD_RUN_METADATA, "silver-1", "definitions-1")
+
+
+def test_changed_definitions_recompute_from_unchanged_silver():
+    assert not is_gold_up_to_date(LAST_GOLD_RUN_METADATA, "silver-1", "definitions-2")
+    assert (
+        get_change_set_problem(LAST_GOLD_RUN_METADATA, {}, "silver-1", "definitions-2", GOLD_SETTINGS)
+        == "the gold definitions changed since the last gold run"
+    )
+
+
+def test_first_gold_run_is_never_skipped():
+    assert not is_gold_up_to_date(None, "silver-1", "definitions-1")
+    assert get_change_set_problem(None, {}, "silver-1", "definitions-1", GOLD_SETTINGS) == "no previous gold run"
+
+
+def test_changed_silver_is_applied_incrementally():
+    assert not is_gold_up_to_date(LAST_GOLD_RUN_METADATA, "silver-2", "definitions-1")
+    assert (
+        get_change_set_problem(
+            LAST_GOLD_RUN_METADATA, LAST_SILVER_RUN_METADATA, "silver-2", "definitions-1", GOLD_SETTINGS
+        )
+        is None
+    )
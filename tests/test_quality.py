@@ -0,0 +1,86 @@
+import duckdb
+import pytest
+
+from common.quality import run_table_checks
+
+
+@pytest.fixture
+def con():
+    con = duckdb.connect()
+    con.sql("""
+        CREATE TABLE breweries AS
+        SELECT * FROM (VALUES
+            (1, 'Brewery A', 'micro', 30.2, NULL),
+            (2, 'Brewery B', 'nano', 95.0, NULL),
+            (2, NULL, 'unknown', -10.0, NULL),
+            (4, 'Brewery D', 'micro', NULL, NULL)
+        ) t(id, name, brewery_type, latitude, deleted_at)
+    """)
+    yield con
+    con.close()
+
+
+def get_failing_rows(results):
+    return {result["check"]: result["failing_rows"] for result in results}
+
+
+def test_every_check_counts_its_failing_rows(con):
+    checks = [
+        {"type": "unique", "column": "id"},
+        {"type": "not_null", "columns": ["id", "name"]},
+        {"type": "accepted_values", "column": "brewery_type", "values": ["micro", "nano"]},
+        {"type": "between", "column": "latitude", "min": -90, "max": 90},
+        {"name": "positive_id", "type": "expression", "expression": "id > 1"},
+    ]
+
+    results = run_table_checks(con, "breweries", checks)
+
+    assert get_failing_rows(results) == {
+        "unique_id": 1,
+        "not_null_id": 0,
+        "not_null_name": 1,
+        "accepted_values_brewery_type": 1,
+        # NULL is neither in nor out of range, as in SQL
+        "between_latitude": 1,
+        "positive_id": 1,
+    }
+    assert all(result["rows"] == 4 and result["table"] == "breweries" for result in results)
+
+
+def test_all_columns_check_skips_excluded_columns(con):
+    results = run_table_checks(
+        con, "breweries", [{"type": "not_all_null", "columns": "*", "exclude_columns": ["deleted_at"]}]
+    )
+
+    assert get_failing_rows(results) == {
+        "not_all_null_id": 0,
+        "not_all_null_name": 0,
+        "not_all_null_brewery_type": 0,
+        "not_all_null_latitude": 0,
+    }
+    assert get_failing_rows(run_table_checks(con, "breweries", [{"type": "not_all_null", "column": "deleted_at"}])) == {
+        "not_all_null_deleted_at": 4
+    }
+
+
+def test_checks_pass_within_their_tolerance(con):
+    checks = [
+        {"type": "not_null", "column": "name", "max_failing_fraction": 0.25},
+        {"type": "unique", "column": "id", "severity": "warn"},
+    ]
+
+    results = run_table_checks(con, "breweries", checks)
+
+    assert [(result["check"], result["passed"], result["severity"]) for result in results] == [
+        ("not_null_name", True, "error"),
+        ("unique_id", False, "warn"),
+    ]
+
+
+def test_unknown_check_type_is_rejected(con):
+    with pytest.raises(ValueError, match="Unsupported quality check type"):
+        run_table_checks(con, "breweries", [{"type": "regex", "column": "name"}])
+
+
+def test_no_checks_reads_nothing(con):
+    assert run_table_checks(con, "missing_table", []) == []
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import uuid
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import duckdb
+import pytest
+
+from common.geo import BreweryGeoIndex, get_cell_key_sql
+from serving.main import BadRequest, ResultCache, ServingSnapshot, ServingStore, get_request_handler, route_request
+
+BREWERY_ID = "5128df48-79fc-4f0f-8b52-d06be54d0cec"
+SERVING_SETTINGS = {"max_results": 10, "indexed_columns": ["id", "state", "city", "brewery_type"]}
+
+
+@pytest.fixture
+def empty_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("OUTPUT_ENV", "local")
+    return ServingStore(SERVING_SETTINGS, {}, {"local_data_path": str(tmp_path)})
+
+
+@pytest.fixture
+def store(empty_store):
+    """A store serving two breweries, one aggregate and the geo index, without reading any storage."""
+    con = duckdb.connect()
+    con.sql(f"""
+        CREATE TABLE breweries AS
+        SELECT * FROM (VALUES
+            ('{BREWERY_ID}'::UUID, 'Austin Brewery', 'micro', 'Austin', 'Texas', 30.27, -97.74),
+            ('{uuid.uuid4()}'::UUID, 'Dallas Brewery', 'brewpub', 'Dallas', 'Texas', 32.78, -96.80)
+        ) t(id, name, brewery_type, city, state, latitude, longitude);
+        CREATE TABLE gold_data_location AS SELECT state, COUNT(*) AS total_count FROM breweries GROUP BY state;
+        CREATE TABLE brewery_geo AS
+        SELECT *, {get_cell_key_sql("latitude", "longitude", 0.25)} AS cell_key FROM breweries;
+    """)
+    snapshot = ServingSnapshot(
+        con, "v1", None, {"location": "gold_data_location"}, BreweryGeoIndex(con, "brewery_geo", 0.25)
+    )
+    empty_store.snapshot = snapshot
+    yield empty_store
+    con.close()
+
+
+def test_brewery_by_id(store):
+    assert route_request(store.snapshot, SERVING_SETTINGS, f"/breweries/{BREWERY_ID}", {})["name"] == "Austin Brewery"
+
+
+def test_breweries_are_filtered_and_limited(store):
+    assert [
+        row["city"]
+        for row in route_request(store.snapshot, SERVING_SETTINGS, "/breweries", {"state": "Texas", "limit": "1"})
+    ] == ["Austin"]
+    assert len(route_request(store.snapshot, SERVING_SETTINGS, "/breweries", {"limit": "1000"})) == 2
+    assert [
+        row["city"] for row in route_request(store.snapshot, SERVING_SETTINGS, "/breweries", {"id": BREWERY_ID})
+    ] == ["Austin"]
+
+
+def test_nearest_breweries(store):
+    query = {"latitude": "32.7", "longitude": "-96.8", "k": "1"}
+
+    assert [row["city"] for row in route_request(store.snapshot, SERVING_SETTINGS, "/breweries/near", query)] == [
+        "Dallas"
+    ]
+
+
+@pytest.mark.parametrize(
+    "path, query",
+    [
+        ("/breweries/not-a-uuid", {}),
+        ("/breweries", {"id": "not-a-uuid"}),
+        ("/breweries", {"limit": "-1"}),
+        ("/breweries", {"limit": "0"}),
+        ("/breweries", {"limit": "2.5"}),
+        ("/breweries", {"limit": "inf"}),
+        ("/breweries", {"limit": "ten"}),
+        ("/breweries/near", {"latitude": "30", "longitude": "-97", "k": "-1"}),
+        ("/breweries/near", {"latitude": "30", "longitude": "-97", "radius_km": "0"}),
+        ("/breweries/near", {"latitude": "30", "longitude": "-97", "radius_km": "nan"}),
+        ("/breweries/near", {"latitude": "30", "radius_km": "10"}),
+    ],
+)
+def test_bad_requests(store, path, query):
+    with pytest.raises(BadRequest):
+        route_request(store.snapshot, SERVING_SETTINGS, path, query)
+
+
+@pytest.mark.parametrize("path", ["/breweries/00000000-0000-0000-0000-000000000000", "/aggregates/unknown", "/unknown"])
+def test_not_found(store, path):
+    with pytest.raises(LookupError):
+        route_request(store.snapshot, SERVING_SETTINGS, path, {})
+
+
+def test_nothing_is_served_before_the_first_gold_run():
+    with pytest.raises(LookupError):
+        route_request(None, SERVING_SETTINGS, "/health", {})
+
+
+@pytest.fixture
+def server_url(store):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), get_request_handler(store, ResultCache(16, 60)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def get_response(url):
+    try:
+        with urlopen(url) as response:
+            return response.status, json.load(response)
+    except HTTPError as e:
+        return e.code, json.load(e)
+
+
+@pytest.mark.parametrize(
+    "path, status",
+    [
+        (f"/breweries/{BREWERY_ID}", 200),
+        ("/breweries/not-a-uuid", 400),
+        ("/breweries?id=not-a-uuid", 400),
+        ("/breweries?limit=-1", 400),
+        ("/breweries/near?latitude=30&longitude=-97&k=-1", 400),
+        ("/breweries/00000000-0000-0000-0000-000000000000", 404),
+    ],
+)
+def test_http_status(server_url, path, status):
+    response_status, body = get_response(server_url + path)
+
+    assert response_status == status
+    assert status == 200 or "error" in body
+
+
+def test_failed_query_returns_a_json_500(store, server_url):
+    store.snapshot.con.sql("DROP TABLE gold_data_location")
+
+    assert get_response(f"{server_url}/aggregates/location") == (500, {"error": "Internal error"})
+
+
+def replace_snapshot(store, monkeypatch):
+    """Has the next refresh load a new version. Returns the snapshot it replaces."""
+    previous_snapshot = store.snapshot
+    monkeypatch.setattr(store, "get_data_version", lambda: "v2")
+    monkeypatch.setattr(store, "load", lambda version: ServingSnapshot(duckdb.connect(), version, None, {}, None))
+    return previous_snapshot
+
+
+@pytest.fixture
+def file_store(empty_store, tmp_path):
+    """A store whose snapshot is kept in a database file, as with database_path set."""
+    database_path = tmp_path / "v1.duckdb"
+    empty_store.snapshot = ServingSnapshot(duckdb.connect(str(database_path)), "v1", str(database_path), {}, None)
+    (tmp_path / "v1.duckdb.wal").touch()
+    return empty_store
+
+
+def test_reload_closes_the_previous_snapshot_and_its_files(file_store, monkeypatch):
+    previous_snapshot = replace_snapshot(file_store, monkeypatch)
+
+    assert file_store.refresh_if_changed()
+
+    assert file_store.snapshot.version == "v2"
+    assert not os.path.exists(previous_snapshot.database_path)
+    assert not os.path.exists(f"{previous_snapshot.database_path}.wal")
+    with pytest.raises(duckdb.ConnectionException):
+        previous_snapshot.query("SELECT 1")
+
+
+def test_replaced_snapshot_stays_open_until_its_last_request_ends(file_store, monkeypatch):
+    previous_snapshot = replace_snapshot(file_store, monkeypatch)
+
+    with file_store.use_snapshot() as snapshot:
+        assert file_store.refresh_if_changed()
+        assert snapshot.query("SELECT 42 AS answer") == [{"answer": 42}]
+        assert os.path.exists(snapshot.database_path)
+
+    assert snapshot is previous_snapshot
+    assert not os.path.exists(snapshot.database_path)
+    with pytest.raises(duckdb.ConnectionException):
+        snapshot.query("SELECT 1")
@@ -0,0 +1,40 @@
+import duckdb
+import pytest
+
+from common.duckdb_connection import mark_table_synced
+from silver.main import backfill_silver_derived_columns
+
+STR_ROW_HASH = "md5(concat_ws('|', name, name_clean))"
+PARTITION_MANIFEST = {"partitions": {"state=Texas": {"state": "Texas", "files": ["state=Texas/data_0.parquet"]}}}
+
+
+@pytest.fixture
+def con():
+    """A synced silver_data whose rows were cleaned with the trim rule."""
+    con = duckdb.connect()
+    con.sql(f"""
+        CREATE TABLE silver_data AS
+        SELECT 'Texas' AS state, '  Brewery  ' AS name, 'Brewery' AS name_clean, NULL::VARCHAR AS row_hash;
+        UPDATE silver_data SET row_hash = {STR_ROW_HASH};
+    """)
+    mark_table_synced(con, "silver_data", PARTITION_MANIFEST)
+    yield con
+    con.close()
+
+
+def get_loaded_file_count(con):
+    return con.sql("SELECT COUNT(*) FROM silver_data__loaded_files").fetchone()[0]
+
+
+def test_unchanged_rows_stay_synced(con):
+    backfill_silver_derived_columns(con, STR_ROW_HASH, {"name": ["trim"]})
+
+    assert get_loaded_file_count(con) == 1
+
+
+def test_backfilled_table_is_marked_unsynced(con):
+    backfill_silver_derived_columns(con, STR_ROW_HASH, {"name": ["trim", "uppercase"]})
+
+    assert con.sql("SELECT name_clean FROM silver_data").fetchall() == [("BREWERY",)]
+    # A run failing before the partition is rewritten reloads it instead of keeping the backfilled rows
+    assert get_loaded_file_count(con) == 0
@@ -0,0 +1,127 @@
+from datetime import datetime
+
+import duckdb
+import pytest
+
+from silver.main import collect_silver_change_set, create_silver_merge_view, materialize_silver_new_data
+
+COLUMNS_TO_MERGE = ["name", "state", "row_hash"]
+SILVER_COLUMNS = ["id", *COLUMNS_TO_MERGE, "created_at", "updated_at", "deleted_at"]
+CREATED_AT = datetime(2025, 1, 1)
+DELETED_AT = datetime(2025, 1, 2)
+MERGED_AT = datetime(2025, 1, 3)
+
+
+@pytest.fixture
+def con():
+    """Silver and bronze rows covering every change the merge detects, one id per case."""
+    con = duckdb.connect()
+    con.sql("""
+        CREATE TABLE silver_data (id VARCHAR, name VARCHAR, state VARCHAR, row_hash VARCHAR, created_at TIMESTAMP,
+                                  updated_at TIMESTAMP, deleted_at TIMESTAMP);
+        CREATE TABLE bronze_data (id VARCHAR, name VARCHAR, state VARCHAR, row_hash VARCHAR);
+    """)
+    con.executemany(
+        "INSERT INTO silver_data VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            ["unchanged", "Brewery", "Texas", "h1", CREATED_AT, CREATED_AT, None],
+            ["updated", "Old name", "Texas", "h2", CREATED_AT, CREATED_AT, None],
+            ["deleted", "Brewery", "Ohio", "h3", CREATED_AT, CREATED_AT, None],
+            ["reinserted", "Brewery", "Ohio", "h4", CREATED_AT, DELETED_AT, DELETED_AT],
+            ["still_deleted", "Brewery", "Iowa", "h5", CREATED_AT, DELETED_AT, DELETED_AT],
+        ],
+    )
+    con.executemany(
+        "INSERT INTO bronze_data VALUES (?, ?, ?, ?)",
+        [
+            ["unchanged", "Brewery", "Texas", "h1"],
+            ["updated", "New name", "Utah", "h2b"],
+            ["reinserted", "Brewery", "Maine", "h4"],
+            ["inserted", "Brewery", "Texas", "h6"],
+        ],
+    )
+    create_silver_merge_view(con, COLUMNS_TO_MERGE, MERGED_AT)
+    yield con
+    con.close()
+
+
+def get_merged_rows(con):
+    columns = ["__change", "name", "state", "created_at", "updated_at", "deleted_at"]
+    rows = con.sql(f"SELECT id, {', '.join(columns)} FROM silver_merge").fetchall()
+    return {row[0]: dict(zip(columns, row[1:])) for row in rows}
+
+
+def test_merge_view_detects_every_change(con):
+    merged_rows = get_merged_rows(con)
+
+    assert {id: row["__change"] for id, row in merged_rows.items()} == {
+        "unchanged": None,
+        "updated": "updated",
+        "deleted": "deleted",
+        "reinserted": "reinserted",
+        "still_deleted": None,
+        "inserted": "inserted",
+    }
+
+
+def test_merge_view_versions_rows(con):
+    merged_rows = get_merged_rows(con)
+
+    assert merged_rows["unchanged"]["updated_at"] == CREATED_AT
+    assert merged_rows["updated"] == {
+        "__change": "updated",
+        "name": "New name",
+        "state": "Utah",
+        "created_at": CREATED_AT,
+        "updated_at": MERGED_AT,
+        "deleted_at": None,
+    }
+    # Soft deletes keep their last values
+    assert merged_rows["deleted"]["name"] == "Brewery"
+    assert merged_rows["deleted"]["deleted_at"] == MERGED_AT
+    assert merged_rows["reinserted"]["deleted_at"] is None
+    assert merged_rows["reinserted"]["state"] == "Maine"
+    assert merged_rows["still_deleted"]["deleted_at"] == DELETED_AT
+    assert merged_rows["inserted"]["created_at"] == MERGED_AT
+
+
+def test_silver_new_data_has_the_silver_columns(con):
+    assert con.sql("SELECT * FROM silver_new_data").columns == SILVER_COLUMNS
+
+
+def test_change_set_signs(con):
+    changed_rows = collect_silver_change_set(con, SILVER_COLUMNS)
+    change_set = con.sql(
+        "SELECT id, __sign, state, __change, __previous_state FROM silver_change_set ORDER BY id, __sign"
+    ).fetchall()
+
+    assert changed_rows == 4
+    assert change_set == [
+        ("deleted", -1, "Ohio", "deleted", "Ohio"),
+        ("inserted", 1, "Texas", "inserted", None),
+        ("reinserted", 1, "Maine", "reinserted", "Ohio"),
+        ("updated", -1, "Texas", "updated", "Texas"),
+        ("updated", 1, "Utah", "updated", "Texas"),
+    ]
+
+
+def test_change_set_sums_to_the_active_row_delta(con):
+    collect_silver_change_set(con, SILVER_COLUMNS)
+    count_delta = con.sql("""
+        SELECT
+            (SELECT COUNT(*) FROM silver_new_data WHERE deleted_at IS NULL)
+            - (SELECT COUNT(*) FROM silver_data WHERE deleted_at IS NULL)
+    """).fetchone()[0]
+
+    assert con.sql("SELECT SUM(__sign) FROM silver_change_set").fetchone()[0] == count_delta
+
+
+def test_materialized_silver_new_data_keeps_the_merged_rows(con):
+    merged_rows = con.sql("SELECT * FROM silver_new_data ORDER BY id").fetchall()
+
+    materialize_silver_new_data(con)
+
+    assert con.sql("SELECT * FROM silver_new_data ORDER BY id").fetchall() == merged_rows
+    assert con.sql(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = 'silver_new_data'"
+    ).fetchall() == [("LOCAL TEMPORARY",)]